@@ -0,0 +1,350 @@
+"""Versioned JSON API over the same tables as the HTML views.
+
+Batch endpoints take a list of objects and apply it with one set-based
+statement (INSERT ... SELECT FROM jsonb_to_recordset), so N items cost one
+HTTP request and one database round trip. Constraint violations are
+answered with the same messages as the forms: 409 for unique/foreign-key
+conflicts, 400 for values the database rejects.
+"""
+from datetime import date
+from decimal import Decimal
+
+import psycopg
+from flask import Blueprint
+from flask import jsonify
+from flask import request
+from flask import url_for
+from psycopg.types.json import Jsonb
+
+from db import catalogue
+from db import delete_supplier
+from db import execute
+from db import fetch_page
+from db import get_api_order
+from db import get_job
+from db import get_supplier
+from jobs import enqueue
+from queries import API_CUSTOMERS
+from queries import API_CUSTOMERS_CREATE
+from queries import API_ORDER_ADD_LINES
+from queries import API_ORDER_CREATE
+from queries import API_ORDER_LISTING
+from queries import API_ORDER_PAY
+from queries import API_ORDERS
+from queries import API_PRODUCT_LISTING
+from queries import API_PRODUCT_UPDATE
+from queries import API_PRODUCTS
+from queries import API_PRODUCTS_CREATE
+from queries import API_SUPPLIER_LISTING
+from queries import API_SUPPLIERS
+from queries import API_SUPPLIERS_CREATE
+from queries import constraint_error
+from queries import CUSTOMER_BY_NO
+from queries import CUSTOMER_LISTING
+from views import customer_delete_job
+from views import product_delete_job
+
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(APIError)
+def api_error(e):
+    return jsonify(error=e.message), e.status
+
+
+@api.errorhandler(psycopg.IntegrityError)
+def integrity_error(e):
+    return jsonify(error=constraint_error(e)), 409
+
+
+@api.errorhandler(psycopg.DataError)
+def data_error(e):
+    return jsonify(error=constraint_error(e), detail=e.diag.message_primary), 400
+
+
+def record(row):
+    """Turn a result row into a JSON-friendly dict."""
+
+    if row is None:
+        raise APIError("Not found.", 404)
+    item = {}
+    for key, value in row._asdict().items():
+        if isinstance(value, date):
+            value = value.isoformat()
+        elif isinstance(value, Decimal):
+            value = str(value)
+        item[key] = value
+    return item
+
+
+def listing(query, key, cast=str):
+    """Serve one keyset page of a listing (see db.fetch_page)."""
+
+    page = fetch_page(query, key, cast)
+    return jsonify(
+        items=[record(row) for row in page.rows],
+        prev=page.prev_cursor,
+        next=page.next_cursor,
+    )
+
+
+def items(*required):
+    """Return the request body as a list of objects, checking `required` keys.
+
+    A single object is accepted as a batch of one.
+    """
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = [body]
+    if not isinstance(body, list) or not body or not all(isinstance(i, dict) for i in body):
+        raise APIError("The body is required to be an object or a non-empty list of objects.")
+    for i, item in enumerate(body):
+        for key in required:
+            if item.get(key) in (None, ""):
+                raise APIError(f"Item {i}: {key} is required.")
+    return body
+
+
+def positive_quantities(lines):
+    for i, line in enumerate(lines):
+        qty = line.get("qty")
+        if not isinstance(qty, int) or isinstance(qty, bool) or qty <= 0:
+            raise APIError(f"Item {i}: qty is required to be a positive integer.")
+
+
+def numbers(name):
+    values = request.args.getlist(name)
+    if not all(value.isascii() and value.isdigit() for value in values):
+        raise APIError(f"{name} is required to be an integer.")
+    return [int(value) for value in values]
+
+
+def accepted(job_id):
+    """Answer 202 with the background job doing the work and where to poll it."""
+
+    location = url_for("api.job", job_id=job_id)
+    return jsonify(job=job_id, status=location), 202, {"Location": location}
+
+
+# Products
+
+
+@api.route("/products", methods=("GET",))
+def products():
+    """List products, or fetch many at once with ?sku=A&sku=B."""
+
+    skus = request.args.getlist("sku")
+    if skus:
+        rows = execute(API_PRODUCTS, {"skus": skus})
+        return jsonify(items=[record(row) for row in rows])
+
+    return listing(API_PRODUCT_LISTING, "sku")
+
+
+@api.route("/products/<sku>", methods=("GET",))
+def product(sku):
+    return jsonify(record(catalogue.product(sku)))
+
+
+@api.route("/products", methods=("POST",))
+def create_products():
+    """Create one product or a batch of them."""
+
+    rows = execute(API_PRODUCTS_CREATE, {"items": Jsonb(items("sku", "name", "price"))})
+    for row in rows:
+        catalogue.invalidate(row.sku)
+    return jsonify(items=[row.sku for row in rows]), 201
+
+
+@api.route("/products/<sku>", methods=("PATCH",))
+def update_product(sku):
+    """Change the price and/or description of a product."""
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not ({"price", "description"} & body.keys()):
+        raise APIError("Atleast one of price or description is required.")
+
+    rows = execute(
+        API_PRODUCT_UPDATE,
+        {
+            "sku": sku,
+            "price": None if body.get("price") is None else str(body["price"]),
+            "set_desc": "description" in body,
+            "desc": body.get("description"),
+        },
+    )
+    catalogue.invalidate(sku)
+    return jsonify(record(rows[0] if rows else None))
+
+
+@api.route("/products/<sku>", methods=("DELETE",))
+def remove_product(sku):
+    """Queue the deletion of the product; poll the job it returns."""
+
+    return accepted(enqueue(*product_delete_job(sku)))
+
+
+# Suppliers
+
+
+@api.route("/suppliers", methods=("GET",))
+def suppliers():
+    """List suppliers, or fetch many at once with ?tin=A&tin=B."""
+
+    tins = request.args.getlist("tin")
+    if tins:
+        rows = execute(API_SUPPLIERS, {"tins": tins})
+        return jsonify(items=[record(row) for row in rows])
+
+    return listing(API_SUPPLIER_LISTING, "tin")
+
+
+@api.route("/suppliers/<tin>", methods=("GET",))
+def supplier(tin):
+    return jsonify(record(get_supplier(tin)))
+
+
+@api.route("/suppliers", methods=("POST",))
+def create_suppliers():
+    """Create one supplier or a batch of them."""
+
+    rows = execute(API_SUPPLIERS_CREATE, {"items": Jsonb(items("tin", "sku"))})
+    return jsonify(items=[row.tin for row in rows]), 201
+
+
+@api.route("/suppliers/<tin>", methods=("DELETE",))
+def remove_supplier(tin):
+    delete_supplier(tin)
+    return "", 204
+
+
+# Customers
+
+
+@api.route("/customers", methods=("GET",))
+def customers():
+    """List customers, or fetch many at once with ?cust_no=1&cust_no=2."""
+
+    cust_nos = numbers("cust_no")
+    if cust_nos:
+        rows = execute(API_CUSTOMERS, {"cust_nos": cust_nos})
+        return jsonify(items=[record(row) for row in rows])
+
+    return listing(CUSTOMER_LISTING, "cust_no", cast=int)
+
+
+@api.route("/customers/<int:cust_no>", methods=("GET",))
+def customer(cust_no):
+    rows = execute(CUSTOMER_BY_NO, {"cust_no": cust_no})
+    return jsonify(record(rows[0] if rows else None))
+
+
+@api.route("/customers", methods=("POST",))
+def create_customers():
+    """Create one customer or a batch of them; returns their numbers."""
+
+    rows = execute(API_CUSTOMERS_CREATE, {"items": Jsonb(items("name", "email"))})
+    return jsonify(items=[record(row) for row in rows]), 201
+
+
+@api.route("/customers/<int:cust_no>", methods=("DELETE",))
+def remove_customer(cust_no):
+    """Queue the deletion of the customer; poll the job it returns."""
+
+    return accepted(enqueue(*customer_delete_job(cust_no)))
+
+
+# Orders, order lines and payments
+
+
+@api.route("/orders", methods=("GET",))
+def orders():
+    """List orders with their totals, or fetch many with ?order_no=1&order_no=2."""
+
+    order_nos = numbers("order_no")
+    if order_nos:
+        rows = execute(API_ORDERS, {"order_nos": order_nos})
+        return jsonify(items=[record(row) for row in rows])
+
+    return listing(API_ORDER_LISTING, "order_no", cast=int)
+
+
+@api.route("/orders/<int:order_no>", methods=("GET",))
+def order(order_no):
+    """An order with its totals, payment and lines."""
+
+    order, lines = get_api_order(order_no)
+    order = record(order)
+    order["lines"] = [record(line) for line in lines]
+    return jsonify(order)
+
+
+@api.route("/orders", methods=("POST",))
+def create_order():
+    """Place an order with all of its lines in one statement.
+
+    Body: {"cust_no": 1, "date": "2023-01-01", "lines": [{"sku": "A", "qty": 2}]}
+    """
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise APIError("The body is required to be an object.")
+    for key in ("cust_no", "date"):
+        if body.get(key) in (None, ""):
+            raise APIError(f"{key} is required.")
+    lines = body.get("lines")
+    if not isinstance(lines, list) or not lines:
+        raise APIError("New order is required to have atleast one product.")
+    positive_quantities(lines)
+
+    rows = execute(
+        API_ORDER_CREATE,
+        {"cust_no": body["cust_no"], "date": body["date"], "lines": Jsonb(lines)},
+    )
+    return jsonify(order_no=rows[0].order_no), 201
+
+
+@api.route("/orders/<int:order_no>/lines", methods=("POST",))
+def add_lines(order_no):
+    """Add a batch of products to an unpaid order, summing repeated SKUs."""
+
+    lines = items("sku", "qty")
+    positive_quantities(lines)
+
+    rows = execute(API_ORDER_ADD_LINES, {"order_no": order_no, "lines": Jsonb(lines)})
+    if not rows:
+        raise APIError("Cannot add products to an order that is already payed.", 409)
+    return jsonify(items=[record(row) for row in rows]), 201
+
+
+@api.route("/orders/<int:order_no>/payment", methods=("POST",))
+def pay(order_no):
+    """Pay an order. Body: {"cust_no": 1}, the customer who placed it."""
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or body.get("cust_no") in (None, ""):
+        raise APIError("The number of the customer who is going to pay is required.")
+
+    rows = execute(API_ORDER_PAY, {"order_no": order_no, "cust_no": body["cust_no"]})
+    if not rows:
+        raise APIError("An order must be payed by the client who placed it.", 409)
+    return jsonify(record(rows[0])), 201
+
+
+# Background jobs
+
+
+@api.route("/jobs/<int:job_id>", methods=("GET",))
+def job(job_id):
+    """The state and progress of a background job (see jobs.py)."""
+
+    return jsonify(record(get_job(job_id)))
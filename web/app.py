@@ -1,28 +1,62 @@
 #!/usr/bin/python3
+import functools
 import os
+import time
 from logging.config import dictConfig
 
-import psycopg
+from flask import before_render_template
 from flask import flash
 from flask import Flask
 from flask import jsonify
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import session
+from flask import stream_template
+from flask import template_rendered
 from flask import url_for
-from psycopg.rows import namedtuple_row
-from psycopg_pool import ConnectionPool
 
+import metrics
+import views
+from api import api
+from db import catalogue
+from db import delete_supplier
+from db import fetch_page
+from db import get_customer
+from db import get_job
+from db import get_order
+from db import get_payment
+from db import get_supplier
+from db import health
+from db import is_payed
+from db import plan_history
+from db import plan_report
+from db import pool
+from db import reader
+from db import recent_jobs
+from db import refresh_sales_cube
+from db import sales_report
+from db import stream_rows
+from db import table_version
+from db import use_replica
+from db import write
+from exporter import stream_export
+from fragments import FRAGMENT_CACHE_DIR
+from fragments import FRAGMENT_CACHE_SIZE
+from fragments import Fragments
+from importer import MAX_UPLOAD_SIZE
+from jobs import enqueue
+from pooling import reads_replica
+from pooling import SHED_ERRORS
+from pooling import WROTE_AT
+from views import ChunkBuffer
 
-# postgres://{user}:{password}@{hostname}:{port}/{database-name}
-DATABASE_URL = os.environ.get("DATABASE_URL", "postgres://db:db@postgres/db")
-
-pool = ConnectionPool(conninfo=DATABASE_URL)
-# the pool starts connecting immediately.
 
 dictConfig(
     {
         "version": 1,
+        # keep the loggers of db.py, metrics.py, ... imported above
+        "disable_existing_loggers": False,
         "formatters": {
             "default": {
                 "format": "[%(asctime)s] %(levelname)s in %(module)s:%(lineno)s - %(funcName)20s(): %(message)s",
@@ -40,792 +74,229 @@ dictConfig(
 )
 
 
-def is_price(value):
-    size = len(value)
-    for i in range(size):
-        if not value[i].isdigit() and value[i] not in ('.', ','):
-            return False
-    return True
+def stream_listing(template, name, query, key):
+    """Render a whole listing as a streamed response."""
+
+    # stream_template must be called while the request context is active.
+    rendered = stream_template(template, page=None, **{name: stream_rows(query, key)})
+
+    def chunks():
+        buffer = ChunkBuffer()
+        for chunk in rendered:
+            if (text := buffer.add(chunk)) is not None:
+                yield text
+        yield buffer.flush()
+
+    return app.response_class(chunks(), mimetype="text/html")
 
 
 app = Flask(__name__)
 app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE
+app.register_blueprint(api)
 log = app.logger
 
 
-@app.route("/", methods=("GET",))
-def homepage():
-    try:
-        return render_template("home_page.html")
-    except Exception as e:
-        return render_template("error_page.html", error=e)
+def warm_templates():
+    """Compile every template now rather than on the first request using it."""
 
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
-@app.route("/products", methods=("GET",))
-def product_index():
-    """Show all the products."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            products = cur.execute(
-                """
-                SELECT SKU, name, description, price, COALESCE(EAN, 0)
-                FROM product
-                ORDER BY SKU ASC;
-                """,
-                {},
-            ).fetchall()
+TEMPLATES_VERSION = views.templates_version(app.jinja_env)
 
-    return render_template("products/index.html", products=products)
+fragments = Fragments(FRAGMENT_CACHE_SIZE, log, FRAGMENT_CACHE_DIR)
 
 
-@app.route("/products/register", methods=("GET", "POST"))
-def product_register():
-    """Register a new product."""
+@app.before_request
+def trace_request():
+    metrics.before_request(request.endpoint or "unmatched")
 
-    if request.method == "POST":
-        error = None
 
-        SKU = request.form["SKU"]
-        if not SKU:
-            error = "SKU is required."
-        else:
-            if len(SKU) > 25:
-                error = "SKU is required to be atmost 25 characters long."
+@app.before_request
+def route_reads():
+    use_replica(reads_replica(request.method, request.endpoint, session.get(WROTE_AT)))
 
-        name = request.form["name"]
-        if not name:
-            error = "Name is required."
-        else:
-            if len(name) > 200:
-                error = "Name is required to be atmost 200 characters long."
 
-        desc = request.form["description"]
+@app.after_request
+def record_request(response):
+    metrics.after_request(request.endpoint or "unmatched", request.method, response.status_code)
+    return response
 
-        price = request.form["price"]
-        if not price:
-            error = "Price is required."
-        else:
-            if not is_price(price):
-                error = "Price isn't valid."
-            elif len(price) > 11:
-                error = "Price must have atmost 10 digits."
-
-        EAN = request.form["EAN"]
-        if EAN == "":
-            EAN = 0
-        if EAN is not None:
-            if not EAN.isnumeric():
-                error = "EAN is required to be numeric."
-            elif len(EAN) > 13:
-                error = "EAN is required to be atmost 13 digits long."
-
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    sku_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as sku_exists
-                        FROM product
-                        WHERE SKU = %(SKU)s;
-                        """,
-                        {"SKU": SKU},
-                    ).fetchone()
-                    ean_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as ean_exists
-                        FROM product
-                        WHERE ean = %(ean)s;
-                        """,
-                        {"ean": EAN},
-                    ).fetchone()
-                    if sku_exists[0] == 1:
-                        error = "There is already a product with that SKU."
-                        flash(error)
-                        return redirect(url_for("product_register"))
-                    if ean_exists[0] == 1:
-                        error = "There is already a product with that ean."
-                        flash(error)
-                        return redirect(url_for("product_register"))
-                    cur.execute(
-                        """
-                        INSERT INTO product VALUES (%(SKU)s, %(name)s, %(desc)s, 
-                            %(price)s, %(EAN)s);
-                        """,
-                        {"SKU": SKU, "name": name, "desc": desc, "price": price, "EAN": EAN},
-                    )
-                conn.commit()
-            return redirect(url_for("product_index"))
-
-    return render_template("products/register.html")
-
-
-@app.route("/products/<product_sku>/delete", methods=("POST",))
-def product_delete(product_sku):
-    """Delete the product."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            cur.execute(
-                """
-                UPDATE supplier SET SKU = NULL
-                WHERE SKU = %(product_sku)s;
-                """,
-                {"product_sku": product_sku},
-            )
-            cur.execute(
-                """
-                DELETE FROM contains
-                WHERE SKU = %(product_sku)s;
-                """,
-                {"product_sku": product_sku},
-            )
-            cur.execute(
-                """
-                DELETE FROM product
-                WHERE SKU = %(product_sku)s;
-                """,
-                {"product_sku": product_sku},
-            )
-        conn.commit()
-    return redirect(url_for("product_index"))
-
-
-@app.route("/products/<product_sku>/update", methods=("GET", "POST"))
-def product_update(product_sku):
-    """Update the product price or description."""
+@app.after_request
+def record_write(response):
+    # The next pages this browser sees must show what it just wrote.
+    if request.method == "POST" and request.blueprint is None:
+        session[WROTE_AT] = time.time()
+    return response
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            product = cur.execute(
-                """
-                SELECT SKU, name, description, price
-                FROM product
-                WHERE SKU = %(product_sku)s;
-                """,
-                {"product_sku": product_sku},
-            ).fetchone()
-            log.debug(f"Found {cur.rowcount} rows.")
-
-    if request.method == "POST":
-        error = None
-
-        price = request.form["price"]
-        if price is not None:
-            if not is_price(price):
-                error = "Price isn't valid."
-            elif len(price) > 11:
-                error = "Price must have atmost 10 digits."
-
-        desc = request.form["description"]
-
-        if not price and not desc:
-            error = "Atleast one of price or description is required."
-
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    if price is not None:
-                        cur.execute(
-                            """
-                            UPDATE product
-                            SET price = %(price)s
-                            WHERE SKU = %(product_sku)s;
-                            """,
-                            {"product_sku": product_sku, "price": price},
-                        )
-                    if desc is not None:
-                        cur.execute(
-                            """
-                            UPDATE product
-                            SET description = %(desc)s
-                            WHERE SKU = %(product_sku)s;
-                            """,
-                            {"product_sku": product_sku, "desc": desc},
-                        )
-                conn.commit()
-            return redirect(url_for("product_index"))
-
-    return render_template("products/update.html", product=product)
-
-
-@app.route("/suppliers", methods=("GET",))
-def supplier_index():
-    """Show all the suppliers."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            suppliers = cur.execute(
-                """
-                SELECT TIN, name, address, SKU
-                FROM supplier
-                ORDER BY TIN ASC;
-                """,
-                {},
-            ).fetchall()
+@before_render_template.connect_via(app)
+def render_started(sender, template, context, **extra):
+    metrics.render_started(template.name)
 
-    return render_template("suppliers/index.html", suppliers=suppliers)
 
+@template_rendered.connect_via(app)
+def render_done(sender, template, context, **extra):
+    metrics.render_done(template.name)
 
-@app.route("/suppliers/register", methods=("GET", "POST"))
-def supplier_register():
-    """Register a new supplier."""
 
-    if request.method == "POST":
-        error = None
+@app.route("/metrics", methods=("GET",))
+def prometheus_metrics():
+    """Expose the request, query and template metrics of this worker."""
 
-        TIN = request.form["TIN"]
-        if not TIN:
-            error = "TIN is required."
-        else:
-            if len(TIN) > 20:
-                error = "TIN is required to be atmost 20 characters long."
-
-        name = request.form["name"]
-        if name is not None:
-            if len(name) > 200:
-                error = "Name is required to be atmost 200 characters long."
-
-        address = request.form["address"]
-        if address is not None:
-            if len(address) > 255:
-                error = "Address is required to be atmost 255 characters long."
-
-        SKU = request.form["SKU"]
-        if not SKU:
-            error = "SKU is required."
-        else:
-            if len(SKU) > 25:
-                error = "SKU is required to be atmost 25 characters long."
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
-        date = request.form["date"]
 
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    tin_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as tin_exists
-                        FROM supplier
-                        WHERE TIN = %(TIN)s;
-                        """,
-                        {"TIN": TIN},
-                    ).fetchone()
-                    sku_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as sku_exists
-                        FROM product
-                        WHERE SKU = %(SKU)s;
-                        """,
-                        {"SKU": SKU},
-                    ).fetchone()
-                    if tin_exists[0] == 1:
-                        error = "There is already a supplier with that TIN."
-                        flash(error)
-                        return redirect(url_for("supplier_register"))
-                    if sku_exists[0] == 0:
-                        error = "There isn't a product with that SKU."
-                        flash(error)
-                        return redirect(url_for("supplier_register"))
-                    cur.execute(
-                        """
-                        INSERT INTO supplier VALUES (%(TIN)s, %(name)s, %(address)s, 
-                            %(SKU)s, %(date)s);
-                        """,
-                        {"TIN": TIN, "name": name, "address": address, "SKU": SKU, "date": date},
-                    )
-                conn.commit()
-            return redirect(url_for("supplier_index"))
-
-    return render_template("suppliers/register.html")
-
-
-@app.route("/supplier/<supplier_tin>/delete", methods=("POST",))
-def supplier_delete(supplier_tin):
-    """Delete the supplier."""
+def shed_load(e):
+    """Answer at once with a 503 when no pooled connection was free in time."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            cur.execute(
-                """
-                DELETE FROM delivery
-                WHERE TIN = %(supplier_tin)s;
-                """,
-                {"supplier_tin": supplier_tin},
-            )
-            cur.execute(
-                """
-                DELETE FROM supplier
-                WHERE TIN = %(supplier_tin)s;
-                """,
-                {"supplier_tin": supplier_tin},
-            )
-        conn.commit()
-    return redirect(url_for("supplier_index"))
-
-
-@app.route("/suppliers/<tin>/update", methods=("GET", ))
-def supplier_info(tin):
-    """Show supplier information."""
+    headers = views.shed(request, e, log)
+    if request.blueprint == api.name:
+        return jsonify(error=views.BUSY), 503, headers
+    return app.response_class(views.BUSY + "\n", status=503, mimetype="text/plain", headers=headers)
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            supplier = cur.execute(
-                """
-                SELECT TIN, name, address, SKU, date
-                FROM supplier
-                WHERE TIN = %(tin)s;
-                """,
-                {"tin": tin},
-            ).fetchone()
-            log.debug(f"Found {cur.rowcount} rows.")
 
-    return render_template("suppliers/update.html", supplier=supplier)
+for error in SHED_ERRORS:
+    app.register_error_handler(error, shed_load)
 
 
-@app.route("/customers", methods=("GET",))
-def customer_index():
-    """Show all the customers."""
+@app.route("/health/live", methods=("GET",))
+def liveness():
+    """The worker is up; never touches the database."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            customers = cur.execute(
-                """
-                SELECT cust_no, name, email, phone, address
-                FROM customer
-                ORDER BY cust_no ASC;
-                """,
-            ).fetchall()
-
-    return render_template("customers/index.html", customers=customers)
-
-
-@app.route("/customers/register", methods=("GET", "POST"))
-def customer_register():
-    """Register a new customer."""
-
-    if request.method == "POST":
-        error = None
-
-        name = request.form["name"]
-        if not name:
-            error = "Name is required."
-            if not name.isalpha():
-                error = "Name is required to be alphabetic."
-            elif len(name) > 80:
-                error = "Name is required to be atmost 80 characters long."
-
-        email = request.form["email"]
-        if not email:
-            error = "Email is required."
-            if len(email) > 254:
-                error = "Email is required to be atmost 254 characters long."
-
-        phone = request.form["phone"]
-        if phone is not None:
-            if len(phone) > 15:
-                error = "Phone is required to be atmost 15 characters long."
-
-        address = request.form["address"]
-        if address is not None:
-            if len(address) > 255:
-                error = "Address is required to be atmost 255 characters long."
-
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    max_cust_no = cur.execute(
-                        """
-                        SELECT cust_no FROM customer
-                        WHERE cust_no >= ALL(
-                            SELECT cust_no FROM customer);
-                        """,
-                    ).fetchone()
-                    email_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as email_exists
-                        FROM customer
-                        WHERE email = %(email)s;
-                        """,
-                        {"email": email},
-                    ).fetchone()
-                    if email_exists[0] == 1:
-                        error = "There is already a customer with that email."
-                        flash(error)
-                        return redirect(url_for("customer_register"))
-                    cur.execute(
-                        """
-                        INSERT INTO customer VALUES (%(cust_no)s, %(name)s, %(email)s, 
-                            %(phone)s, %(address)s);
-                        """,
-                        {"cust_no": max_cust_no[0]+1, "name": name, "email": email, "phone": phone, "address": address},
-                    )
-                conn.commit()
-            return redirect(url_for("customer_index"))
-
-    return render_template("customers/register.html")
-
-
-@app.route("/customers/<cust_no>/delete", methods=("POST",))
-def customer_delete(cust_no):
-    """Delete the customer."""
+    return jsonify(status="alive", pid=os.getpid(), pool=pool.get_stats())
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            cur.execute(
-                """DELETE FROM process
-                WHERE order_no IN (
-                    SELECT order_no FROM orders
-                    WHERE cust_no = %(cust_no)s);
-                """,
-                {"cust_no": cust_no},
-            )
-            cur.execute(
-                """DELETE FROM contains
-                WHERE order_no IN (
-                    SELECT order_no FROM orders
-                    WHERE cust_no = %(cust_no)s);
-                """,
-                {"cust_no": cust_no},
-            )
-            cur.execute(
-                """
-                DELETE FROM pay
-                WHERE cust_no = %(cust_no)s;
-                """,
-                {"cust_no": cust_no},
-            )
-            cur.execute(
-                """
-                DELETE FROM orders
-                WHERE cust_no = %(cust_no)s;
-                """,
-                {"cust_no": cust_no},
-            )
-            cur.execute(
-                """
-                DELETE FROM customer
-                WHERE cust_no = %(cust_no)s;
-                """,
-                {"cust_no": cust_no},
-            )
-            conn.commit()
-    return redirect(url_for("customer_index"))
-
-
-@app.route("/customers/<cust_no>/update", methods=("GET", ))
-def customer_info(cust_no):
-    """Show customer information."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            customer = cur.execute(
-                """
-                SELECT cust_no, name, email, phone, address
-                FROM customer
-                WHERE cust_no = %(cust_no)s;
-                """,
-                {"cust_no": cust_no},
-            ).fetchone()
-            log.debug(f"Found {cur.rowcount} rows.")
+@app.route("/health/ready", methods=("GET",))
+def readiness():
+    """The worker can get a connection and run a query."""
 
-    return render_template("customers/update.html", customer=customer)
+    ready, stats = health()
+    status = "ready" if ready else "unavailable"
+    return jsonify(status=status, pid=os.getpid(), pool=stats), 200 if ready else 503
 
 
-@app.route("/orders", methods=("GET",))
-def orders_index():
-    """Show all the orders."""
+@app.route("/", methods=("GET",))
+def homepage():
+    try:
+        return render_template("home_page.html")
+    except Exception as e:
+        return render_template("error_page.html", error=e)
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            orders = cur.execute(
-                """
-                SELECT order_no, cust_no, date
-                FROM orders
-                ORDER BY order_no ASC;
-                """,
-            ).fetchall()
 
-    return render_template("orders/index.html", orders=orders)
+def render_fragment(template, context):
+    return render_template(template, **context)
+
+
+# The operations of the views of views.py, on the sync pool.
+OPERATIONS = {
+    "write": write,
+    "enqueue": enqueue,
+    "flash": flash,
+    "invalidate": catalogue.invalidate,
+    "known_missing": catalogue.known_missing,
+    "table_version": table_version,
+    "page": fetch_page,
+    "render_template": render_fragment,
+    "product": catalogue.product,
+    "supplier": get_supplier,
+    "customer": get_customer,
+    "order": get_order,
+    "is_payed": is_payed,
+    "payment": get_payment,
+    "delete_supplier": delete_supplier,
+    "sales_report": sales_report,
+    "recent_jobs": recent_jobs,
+    "job": get_job,
+    "plan_report": plan_report,
+    "plan_history": plan_history,
+}
+
+
+def respond(answer):
+    """The response to what a view of views.py answered."""
+
+    if isinstance(answer, views.Revalidate):
+        if answer.answer is None:
+            response = app.response_class(status=304)
+        else:
+            response = app.make_response(respond(answer.answer))
+            if response.status_code != 200:
+                return response
+        return views.revalidated(response, answer.etag, answer.changed_at)
+    if isinstance(answer, views.Redirect):
+        return redirect(url_for(answer.endpoint, **answer.values))
+    if isinstance(answer, views.Listing):
+        return stream_listing(*answer)
+    if isinstance(answer, views.Export):
+        return app.response_class(
+            stream_export(reader(), answer.statement),
+            mimetype=answer.mimetype,
+            headers=answer.headers,
+        )
+    return render_template(answer.template, **answer.context), answer.headers
 
 
-@app.route("/orders/register", methods=("GET", "POST"))
-def place_order():
-    """Place a new order."""
+def serve(view):
+    """The Flask view running the view `view` of views.py."""
 
-    if request.method == "POST":
-        error = None
+    @functools.wraps(view)
+    def flask_view(**kwargs):
+        context = views.Context(request, session, TEMPLATES_VERSION, fragments)
+        return respond(views.drive(view(context, **kwargs), OPERATIONS))
 
-        cust_no = request.form["cust_no"]
-        if not cust_no:
-            error = "Customer number is required."
-        else:
-            if not cust_no.isnumeric():
-                error = "Customer number is required to be an integer."
+    return flask_view
 
-        date = request.form["date"]
-        if not date:
-            error = "Date is required."
 
-        first_sku = request.form["sku"]
-        if not first_sku:
-            error = "New order is required to have atleast one product."
-        else:
-            if len(first_sku) > 25:
-                error = "SKU is required to be atmost 25 characters long."
+for rule, methods, view in views.ROUTES:
+    app.add_url_rule(rule, view.__name__, serve(view), methods=methods)
 
-        qty = request.form["qty"]
-        if not qty:
-            error = "Quantity is required."
-        else:
-            if not qty.isnumeric() or int(qty) <= 0:
-                error = "Quantity is required to be a positive integer."
 
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    max_order_no = cur.execute(
-                        """
-                        SELECT order_no FROM orders
-                        WHERE order_no >= ALL(
-                            SELECT order_no FROM orders);
-                        """,
-                    ).fetchone()
-                    client_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as client_exists
-                        FROM customer
-                        WHERE cust_no = %(cust_no)s;
-                        """,
-                        {"cust_no": cust_no},
-                    ).fetchone()
-                    product_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as product_exists
-                        FROM product
-                        WHERE SKU = %(sku)s;
-                        """,
-                        {"sku": first_sku},
-                    ).fetchone()
-                    if client_exists[0] == 0:
-                        error = "There isn't a customer with that number."
-                        flash(error)
-                        return redirect(url_for("place_order"))
-                    if product_exists[0] == 0:
-                        error = "There isn't a product with that SKU."
-                        flash(error)
-                        return redirect(url_for("place_order"))
-                    cur.execute(
-                        """
-                        INSERT INTO orders VALUES (%(new_order_no)s, %(cust_no)s, %(date)s);
-                        """,
-                        {"new_order_no": max_order_no[0]+1, "cust_no": cust_no, "date": date},
-                    )
-                    cur.execute(
-                        """
-                        INSERT INTO contains VALUES (%(new_order_no)s, %(sku)s, %(qty)s);
-                        """,
-                        {"new_order_no": max_order_no[0]+1, "sku": first_sku, "qty": qty},
-                    )
-                conn.commit()
-            return redirect(url_for("orders_index"))
-
-    return render_template("orders/register.html")
-
-
-@app.route("/orders/<order_no>/addproduct", methods=("GET", "POST"))
-def add_product(order_no):
-    """Add a new product to an existing order."""
+@app.cli.command("rebuild-order-summary")
+def rebuild_order_summary():
+    """Recompute the order_summary totals from contains and product."""
 
     with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            payed = cur.execute(
-                """
-                SELECT COUNT(*) as payed
-                FROM pay
-                WHERE order_no = %(order_no)s;
-                """,
-                {"order_no": order_no},
-            ).fetchone()
-            log.debug(f"Found {cur.rowcount} rows.")
-
-    if payed[0] == 1:
-        error = "Cannot add products to an order that is already payed."
-        flash(error)
-        return redirect(url_for("order_info", order_no=order_no))
-
-    if request.method == "POST":
-        error = None
-
-        sku = request.form["sku"]
-        if not sku:
-            error = "Product SKU is required."
-        else:
-            if len(sku) > 25:
-                error = "SKU is required to be atmost 25 characters long."
+        conn.execute("SELECT rebuild_order_summary();")
+    log.info("order_summary rebuilt.")
 
-        qty = request.form["qty"]
-        if not qty:
-            error = "Quantity is required."
-        else:
-            if not qty.isnumeric() or int(qty) <= 0:
-                error = "Quantity is required to be a positive integer."
 
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    product_exists = cur.execute(
-                        """
-                        SELECT COUNT(*) as product_exists
-                        FROM product
-                        WHERE SKU = %(sku)s;
-                        """,
-                        {"sku": sku},
-                    ).fetchone()
-                    if product_exists[0] == 0:
-                        error = "There isn't a product with that SKU."
-                        flash(error)
-                        return redirect(url_for("add_product", order_no=order_no))
-                    product_already_in_order = cur.execute(
-                        """
-                        SELECT COUNT(*) as product_already_in_order
-                        FROM contains
-                        WHERE SKU = %(sku)s AND order_no=%(order_no)s;
-                        """,
-                        {"sku": sku, "order_no": order_no},
-                    ).fetchone()
-                    if product_already_in_order[0] == 1:
-                        cur.execute(
-                            """
-                            UPDATE contains SET qty = qty + %(qty)s
-                            WHERE SKU = %(sku)s AND order_no=%(order_no)s;
-                            """,
-                            {"qty": qty, "sku": sku, "order_no": order_no},
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            INSERT INTO contains VALUES (%(order_no)s, %(sku)s, %(qty)s);
-                            """,
-                            {"order_no": order_no, "sku": sku, "qty": qty},
-                        )
-                conn.commit()
-            return redirect(url_for("order_info", order_no=order_no))
-
-    return render_template("orders/addproduct.html", order_no=order_no)
-
-
-@app.route("/orders/<order_no>/update", methods=("GET", ))
-def order_info(order_no):
-    """Show order information."""
+@app.cli.command("refresh-sales-cube")
+def refresh_sales():
+    """Fold the new payments and changes into sales_cube, e.g. from cron."""
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            order = cur.execute(
-                """
-                SELECT order_no, cust_no, date
-                FROM orders
-                WHERE order_no = %(order_no)s;
-                """,
-                {"order_no": order_no},
-            ).fetchone()
-            log.debug(f"Found {cur.rowcount} rows.")
-            products = cur.execute(
-                """
-                SELECT order_no, SKU, qty, name
-                FROM contains JOIN product USING (SKU)
-                WHERE order_no = %(order_no)s;
-                """,
-                {"order_no": order_no},
-            ).fetchall()
-
-    return render_template("orders/update.html", order=order, products=products)
-
-
-@app.route("/orders/<order_no>/pay", methods=("GET", "POST"))
-def pay_order(order_no):
-    """Pay the order."""
+    changes = refresh_sales_cube()
+    log.info(f"Folded {changes} changes into sales_cube.")
 
-    with pool.connection() as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            payed = cur.execute(
-                """
-                SELECT COUNT(*) as payed
-                FROM pay
-                WHERE order_no = %(order_no)s;
-                """,
-                {"order_no": order_no},
-            ).fetchone()
-            order_totals = cur.execute(
-                """
-                SELECT COUNT(*) as total_products, SUM(qty) as total_qty, SUM(qty*price) as total_price
-                FROM contains JOIN product USING (SKU)
-                WHERE order_no = %(order_no)s;
-                """,
-                {"order_no": order_no},
-            ).fetchone()
-            log.debug(f"Found {cur.rowcount} rows.")
-
-    if payed[0] == 1:
-        error = "Order is already payed."
-        flash(error)
-        return redirect(url_for("order_info", order_no=order_no))
-
-    if request.method == "POST":
-        error = None
-
-        payment_method = request.form["payment_method"]
-        if not payment_method:
-            error = "Payment method is required."
-        else:
-            if payment_method not in ("MBWay", "Multibanco", "Paypal", "Visa"):
-                error = "Payment method is required to be one of those listed."
 
-        cust_no_pay = request.form["cust_no_pay"]
-        if not cust_no_pay:
-            error = "The number of the customer who is going to pay is required."
-        else:
-            if not cust_no_pay.isnumeric():
-                error = "Customer number is required to be an integer."
+@app.cli.command("rebuild-sales-cube")
+def rebuild_sales_cube():
+    """Recompute the sales_cube totals from the product_sales view."""
 
-        if error is not None:
-            flash(error)
-        else:
-            with pool.connection() as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    cust_no_order = cur.execute(
-                        """
-                        SELECT cust_no FROM orders
-                        WHERE order_no = %(order_no)s;
-                        """,
-                        {"order_no": order_no},
-                    ).fetchone()
-                    if cust_no_order[0] == int(cust_no_pay):
-                        cur.execute(
-                            """
-                            INSERT INTO pay VALUES (%(order_no)s, %(cust_no)s);
-                            """,
-                            {"order_no": order_no, "cust_no": cust_no_pay},
-                        )
-                    else:
-                        error = "An order must be payed by the client who placed it."
-                        flash(error)
-                conn.commit()
-            return redirect(url_for("order_info", order_no=order_no))
-
-    return render_template("orders/pay.html", order_totals=order_totals, order_no=order_no)
+    with pool.connection() as conn:
+        conn.execute("SELECT rebuild_sales_cube();")
+    log.info("sales_cube rebuilt.")
+
+
+@app.cli.command("plans")
+def plan_changes():
+    """Sum up the captured plans by query; exits 1 if a plan changed."""
+
+    queries = plan_report()
+    for row in queries:
+        flag = "CHANGED " if row.changed else ""
+        print(
+            f"{flag}{row.query_name}: {row.captures} captures, {row.plans} plans, "
+            f"max {row.max_seconds:.3f}s, last on {row.route or '-'}"
+        )
+        print(f"    latest:   {', '.join(row.scans) or '-'}")
+        if row.changed:
+            print(f"    previous: {', '.join(row.previous_scans) or '-'}")
+    if any(row.changed for row in queries):
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,541 @@
+#!/usr/bin/python3
+"""ASGI entry point serving the HTML views of app.py on asyncio.
+
+The views are those of views.py, shared with app.py; only the operations
+they yield, which read and write the database, and the making of their
+responses differ. Connections come from a
+psycopg_pool AsyncConnectionPool, so a worker waiting on Postgres only parks
+a coroutine, and the independent reads of a page run concurrently on
+separate pooled connections. Run it from the web directory with any ASGI server, e.g.
+
+    hypercorn --workers 4 asgi:app
+
+The JSON API (/api/v1) and the flask CLI commands stay on the WSGI app.
+The deletes and imports it queues are run by `python jobs.py`.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import time
+
+import psycopg
+from psycopg.rows import namedtuple_row
+from quart import before_render_template
+from quart import flash
+from quart import g
+from quart import jsonify
+from quart import Quart
+from quart import redirect
+from quart import render_template
+from quart import request
+from quart import session
+from quart import stream_template
+from quart import template_rendered
+from quart import url_for
+
+import metrics
+import views
+from exporter import stream_export_async
+from fragments import FRAGMENT_CACHE_DIR
+from fragments import FRAGMENT_CACHE_SIZE
+from fragments import Fragments
+from importer import MAX_UPLOAD_SIZE
+from importer import UPLOAD_PART_SIZE
+from metrics import AsyncTimedPool
+from pooling import async_connection_pool
+from pooling import DATABASE_READ_URL
+from pooling import reads_replica
+from pooling import READY_TIMEOUT
+from pooling import ReplicaLag
+from pooling import SHED_ERRORS
+from pooling import WROTE_AT
+from queries import constraint_error
+from queries import CUSTOMER_BY_NO
+from queries import CUSTOMER_LATEST_ORDERS
+from queries import full_listing
+from queries import HEALTH_CHECK
+from queries import JOB_BY_ID
+from queries import JOB_DATA_APPEND
+from queries import JOB_ENQUEUE
+from queries import JOB_RECENT
+from queries import keyset
+from queries import ORDER_BY_NO
+from queries import ORDER_LINES
+from queries import ORDER_PAYED
+from queries import ORDER_TOTALS
+from queries import page
+from queries import PLAN_HISTORY
+from queries import PLAN_REPORT
+from queries import PAGE_SIZE
+from queries import PREPARE_STATEMENTS
+from queries import PRODUCT_BY_SKU
+from queries import REPLICA_LAG
+from queries import run_async
+from queries import SALES_CUBE_STATUS
+from queries import SALES_LATEST_YEAR
+from queries import SALES_ROLLUPS
+from queries import sales_rollups
+from queries import SUPPLIER_BY_TIN
+from queries import SUPPLIER_DELETE
+from queries import TABLE_VERSIONS
+from views import ChunkBuffer
+
+
+# postgres://{user}:{password}@{hostname}:{port}/{database-name}
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgres://db:db@postgres/db")
+# Rows fetched per round trip when a listing is streamed whole (?stream=1).
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 1000))
+
+# Opened in the serving process, once the event loop is running.
+pool = AsyncTimedPool(async_connection_pool(DATABASE_URL))
+read_pool = AsyncTimedPool(async_connection_pool(DATABASE_READ_URL)) if DATABASE_READ_URL else None
+
+replica_lag = ReplicaLag()
+_use_replica = contextvars.ContextVar("use_replica", default=False)
+
+app = Quart(__name__)
+app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE
+log = app.logger
+
+
+@app.before_serving
+async def open_pool():
+    await pool.open()
+    if read_pool is not None:
+        await read_pool.open()
+
+
+@app.after_serving
+async def close_pool():
+    await pool.close()
+    if read_pool is not None:
+        await read_pool.close()
+
+
+# The hooks are coroutines so that they run in the context of the request.
+
+
+@app.before_request
+async def trace_request():
+    metrics.before_request(request.endpoint or "unmatched")
+
+
+@app.before_request
+async def route_reads():
+    allowed = reads_replica(request.method, request.endpoint, session.get(WROTE_AT))
+    _use_replica.set(allowed and read_pool is not None)
+
+
+@app.after_request
+async def record_request(response):
+    metrics.after_request(request.endpoint or "unmatched", request.method, response.status_code)
+    return response
+
+
+@app.after_request
+async def record_write(response):
+    # The next pages this browser sees must show what it just wrote.
+    if request.method == "POST" and request.blueprint is None:
+        session[WROTE_AT] = time.time()
+    return response
+
+
+@before_render_template.connect_via(app)
+async def render_started(sender, template, context, **extra):
+    metrics.render_started(template.name)
+
+
+@template_rendered.connect_via(app)
+async def render_done(sender, template, context, **extra):
+    metrics.render_done(template.name)
+
+
+@app.route("/metrics", methods=("GET",))
+async def prometheus_metrics():
+    """Expose the request, query and template metrics of this worker."""
+
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+async def shed_load(e):
+    """Answer at once with a 503 when no pooled connection was free in time."""
+
+    headers = views.shed(request, e, log)
+    return app.response_class(views.BUSY + "\n", status=503, mimetype="text/plain", headers=headers)
+
+
+for error in SHED_ERRORS:
+    app.register_error_handler(error, shed_load)
+
+
+@app.route("/health/live", methods=("GET",))
+async def liveness():
+    """The worker is up; never touches the database."""
+
+    return jsonify(status="alive", pid=os.getpid(), pool=pool.get_stats())
+
+
+@app.route("/health/ready", methods=("GET",))
+async def readiness():
+    """The worker can get a connection and run a query."""
+
+    try:
+        async with pool.connection(timeout=READY_TIMEOUT) as conn:
+            async with conn.cursor() as cur:
+                await run_async(cur, HEALTH_CHECK)
+        ready = True
+    except psycopg.Error as e:
+        log.warning(f"Readiness check failed: {e}")
+        ready = False
+    status = "ready" if ready else "unavailable"
+    return jsonify(status=status, pid=os.getpid(), pool=pool.get_stats()), 200 if ready else 503
+
+
+class TemplateRequest:
+    """The request as the views and templates see it.
+
+    Quart only exposes the form and the files as awaitables, while the views
+    and templates read request.form[...] directly; this hands them both
+    already parsed.
+    """
+
+    def __init__(self, request, form, files=None):
+        self._request = request
+        self.form = form
+        self.files = files
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
+@app.context_processor
+async def template_request():
+    return {"request": TemplateRequest(request._get_current_object(), await request.form)}
+
+
+async def replica_fresh():
+    """Whether the replica is within REPLICA_MAX_LAG of the primary."""
+
+    if replica_lag.due():
+        try:
+            async with read_pool.connection(timeout=READY_TIMEOUT) as conn:
+                async with conn.cursor() as cur:
+                    await run_async(cur, REPLICA_LAG)
+                    lag = (await cur.fetchone())[0]
+        except psycopg.Error as e:
+            log.warning(f"Replica lag check failed: {e}")
+            lag = None
+        replica_lag.record(lag)
+    return replica_lag.fresh
+
+
+async def reader():
+    """The pool the reads of the current request should use."""
+
+    if _use_replica.get() and await replica_fresh():
+        return read_pool
+    return pool
+
+
+async def table_version(tables):
+    """Return (version, last change) of `tables`, or None if they are not
+    tracked; see db.table_version()."""
+
+    tables = tuple(tables)
+    versions = g.setdefault("table_versions", {})
+    if tables not in versions:
+        try:
+            row = await fetchone(TABLE_VERSIONS, {"tables": list(tables)})
+            versions[tables] = row.version, row.changed_at
+        except psycopg.errors.UndefinedTable:
+            log.warning(views.TABLE_VERSION_MISSING)
+            versions[tables] = None
+    return versions[tables]
+
+
+TEMPLATES_VERSION = views.templates_version(app.jinja_env)
+
+fragments = Fragments(FRAGMENT_CACHE_SIZE, log, FRAGMENT_CACHE_DIR)
+
+
+async def fetchone(query, params):
+    """Run a registered read on its own pooled connection, return its first row."""
+
+    async with (await reader()).connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            await run_async(cur, query, params)
+            return await cur.fetchone()
+
+
+async def fetchall(query, params, statement=None):
+    """Run a registered read on its own pooled connection, return all its rows."""
+
+    async with (await reader()).connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            await run_async(cur, query, params, statement)
+            return await cur.fetchall()
+
+
+async def write(query, params):
+    """Run a single write statement in its own transaction.
+
+    Returns (row, error) like db.write: the first RETURNING row and the
+    message of the constraint the statement violated.
+    """
+
+    try:
+        async with pool.connection() as conn:
+            async with conn.cursor(row_factory=namedtuple_row) as cur:
+                await run_async(cur, query, params)
+                row = await cur.fetchone() if cur.description else None
+    except (psycopg.IntegrityError, psycopg.DataError) as e:
+        log.debug(f"Write rejected: {e.diag.message_primary}")
+        return None, constraint_error(e)
+    return row, None
+
+
+async def pipelined(queries, params):
+    """Run the registered `queries`, all taking `params`, as one transaction."""
+
+    start = time.perf_counter()
+    async with pool.connection() as conn:
+        async with conn.pipeline():
+            cursors = [
+                await conn.cursor().execute(query.sql, params, prepare=PREPARE_STATEMENTS)
+                for query in queries
+            ]
+    metrics.pipeline_done(queries, cursors, time.perf_counter() - start)
+
+
+async def enqueue(kind, title, params, upload=None):
+    """Queue a background job, see jobs.enqueue(); run by `python jobs.py`."""
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            await run_async(cur, JOB_ENQUEUE, views.job_row(kind, title, params))
+            job_id = (await cur.fetchone()).id
+            part = 0
+            # Quart spools the upload to a temporary file; read it off the loop.
+            while upload is not None and (
+                data := await asyncio.to_thread(upload.read, UPLOAD_PART_SIZE)
+            ):
+                await run_async(cur, JOB_DATA_APPEND, {"job": job_id, "part": part, "data": data})
+                part += 1
+    return job_id
+
+
+async def fetch_page(query, key, cast=str, params=None):
+    """Fetch one keyset page of a listing, see queries.keyset()."""
+
+    statement, cursor, size, after, before = keyset(query, key, request.args, cast)
+    rows = await fetchall(query, {**(params or {}), **cursor}, statement)
+    return page(rows, key, size, after, before)
+
+
+async def stream_rows(query, key):
+    """Yield every row of a listing from a server-side cursor."""
+
+    async with (await reader()).connection() as conn:
+        async with conn.cursor(name="listing", row_factory=namedtuple_row) as cur:
+            cur.itersize = STREAM_BATCH_SIZE
+            await cur.execute(full_listing(query, key))
+            async for row in cur:
+                yield row
+
+
+async def stream_listing(template, name, query, key):
+    """Render a whole listing as a streamed response."""
+
+    rendered = await stream_template(template, page=None, **{name: stream_rows(query, key)})
+
+    async def chunks():
+        buffer = ChunkBuffer()
+        async for chunk in rendered:
+            if (text := buffer.add(chunk)) is not None:
+                yield text
+        yield buffer.flush()
+
+    return app.response_class(chunks(), mimetype="text/html")
+
+
+@app.route("/", methods=("GET",))
+async def homepage():
+    try:
+        return await render_template("home_page.html")
+    except Exception as e:
+        return await render_template("error_page.html", error=e)
+
+
+async def render_fragment(template, context):
+    return await render_template(template, **context)
+
+
+async def get_product(sku):
+    return await fetchone(PRODUCT_BY_SKU, {"sku": sku})
+
+
+async def get_supplier(tin):
+    return await fetchone(SUPPLIER_BY_TIN, {"tin": tin})
+
+
+async def get_customer(cust_no):
+    """Return (customer or None, their latest orders), read concurrently."""
+
+    params = {"cust_no": cust_no, "limit": PAGE_SIZE}
+    return await asyncio.gather(
+        fetchone(CUSTOMER_BY_NO, params),
+        fetchall(CUSTOMER_LATEST_ORDERS, params),
+    )
+
+
+async def get_order(order_no):
+    """Return (order or None, its lines), read concurrently."""
+
+    params = {"order_no": order_no}
+    return await asyncio.gather(
+        fetchone(ORDER_BY_NO, params),
+        fetchall(ORDER_LINES, params),
+    )
+
+
+async def is_payed(order_no):
+    return (await fetchone(ORDER_PAYED, {"order_no": order_no})).payed > 0
+
+
+async def get_payment(order_no):
+    """Return (whether the order has been paid, its totals), read concurrently."""
+
+    params = {"order_no": order_no}
+    payed, totals = await asyncio.gather(
+        fetchone(ORDER_PAYED, params),
+        fetchone(ORDER_TOTALS, params),
+    )
+    return payed.payed > 0, totals
+
+
+async def delete_supplier(tin):
+    await pipelined(SUPPLIER_DELETE, {"supplier_tin": tin})
+
+
+async def sales_report(year, sku):
+    """Return (year, rollups, status) of sales_cube; see db.sales_report()."""
+
+    params = {"year": year, "sku": sku}
+    rows = []
+    async with (await reader()).connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            await run_async(cur, SALES_CUBE_STATUS)
+            status = await cur.fetchone()
+            if year is None:
+                await run_async(cur, SALES_LATEST_YEAR)
+                year = params["year"] = (await cur.fetchone()).year
+            if year is not None:
+                await run_async(cur, SALES_ROLLUPS, params)
+                rows = await cur.fetchall()
+    return year, sales_rollups(rows), status
+
+
+async def primary(query, params=None):
+    """Run a registered read on the primary, return all its rows."""
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            await run_async(cur, query, params)
+            return await cur.fetchall()
+
+
+async def recent_jobs():
+    return await primary(JOB_RECENT, {"limit": PAGE_SIZE})
+
+
+async def get_job(job_id):
+    # Read from the primary, so the progress is never behind.
+    rows = await primary(JOB_BY_ID, {"job": job_id})
+    return rows[0] if rows else None
+
+
+async def plan_report():
+    return await primary(PLAN_REPORT)
+
+
+async def plan_history(query_name):
+    return await primary(PLAN_HISTORY, {"query_name": query_name, "limit": PAGE_SIZE})
+
+
+async def uncached(sku):
+    """There is no catalogue cache here (catalogue.py): nothing to drop, and
+    no product known missing; the foreign keys reject unknown SKUs."""
+
+    return False
+
+
+# The operations of the views of views.py, on the async pool.
+OPERATIONS = {
+    "write": write,
+    "enqueue": enqueue,
+    "flash": flash,
+    "invalidate": uncached,
+    "known_missing": uncached,
+    "table_version": table_version,
+    "page": fetch_page,
+    "render_template": render_fragment,
+    "product": get_product,
+    "supplier": get_supplier,
+    "customer": get_customer,
+    "order": get_order,
+    "is_payed": is_payed,
+    "payment": get_payment,
+    "delete_supplier": delete_supplier,
+    "sales_report": sales_report,
+    "recent_jobs": recent_jobs,
+    "job": get_job,
+    "plan_report": plan_report,
+    "plan_history": plan_history,
+}
+
+
+async def respond(answer):
+    """The response to what a view of views.py answered; see app.respond()."""
+
+    if isinstance(answer, views.Revalidate):
+        if answer.answer is None:
+            response = app.response_class("", status=304)
+        else:
+            response = await app.make_response(await respond(answer.answer))
+            if response.status_code != 200:
+                return response
+        return views.revalidated(response, answer.etag, answer.changed_at)
+    if isinstance(answer, views.Redirect):
+        return redirect(url_for(answer.endpoint, **answer.values))
+    if isinstance(answer, views.Listing):
+        return await stream_listing(*answer)
+    if isinstance(answer, views.Export):
+        return app.response_class(
+            stream_export_async(await reader(), answer.statement),
+            mimetype=answer.mimetype,
+            headers=answer.headers,
+        )
+    return await render_template(answer.template, **answer.context), answer.headers
+
+
+def serve(view):
+    """The Quart view running the view `view` of views.py."""
+
+    @functools.wraps(view)
+    async def quart_view(**kwargs):
+        form_request = TemplateRequest(
+            request._get_current_object(), await request.form, await request.files
+        )
+        context = views.Context(form_request, session, TEMPLATES_VERSION, fragments)
+        return await respond(await views.drive_async(view(context, **kwargs), OPERATIONS))
+
+    return quart_view
+
+
+for rule, methods, view in views.ROUTES:
+    app.add_url_rule(rule, view.__name__, serve(view), methods=methods)
+
+if __name__ == "__main__":
+    app.run()
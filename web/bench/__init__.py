@@ -0,0 +1,10 @@
+"""Load test and benchmark of the web application.
+
+Brings up a throwaway PostgreSQL cluster with the E3 schema and RI-1..RI-3
+(postgres.py, schema.sql), fills it at a given scale (data.py) and drives a
+mixed workload of browsing and form submissions through the Flask app
+(workload.py). Run it with `python -m bench` from the web directory.
+`python -m bench.startup` compares the startup cost of app.cgi with serving
+from gunicorn (startup.py), and `python -m bench.search` times product
+searches on millions of products (search.py).
+"""
@@ -0,0 +1,119 @@
+"""Run the benchmark and write its results as JSON.
+
+From the web directory:
+
+    python -m bench --scale 1 --concurrency 8 --duration 60 --output base.json
+    python -m bench --scale 1 --concurrency 8 --duration 60 --compare base.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from contextlib import nullcontext
+
+import psycopg
+
+from bench.data import add_arguments
+from bench.data import options
+from bench.data import prepare
+from bench.postgres import Postgres
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """Print the change of every route against a previous run."""
+
+    def change(old, new):
+        if not old or new is None:
+            return "     n/a"
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    print(f"{'route':<18}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'trips':>9}")
+    rows = dict(results["routes"], total=results["total"])
+    old_rows = dict(baseline["routes"], total=baseline["total"])
+    for route, new in rows.items():
+        old = old_rows.get(route, {})
+        print(
+            f"{route:<18}"
+            + "".join(
+                " " + change(old.get(key), new.get(key))
+                for key in ("throughput", "p50", "p95", "p99", "round_trips")
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.split("\n")[0])
+    add_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--duration", type=float, default=30, help="seconds recorded")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before recording")
+    parser.add_argument(
+        "--database-url",
+        help="use this empty database instead of a throwaway cluster (initdb/pg_ctl)",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="print the change against this JSON file")
+    args = parser.parse_args(argv)
+
+    with nullcontext(args.database_url) if args.database_url else Postgres() as conninfo:
+        print(f"Loading scale {args.scale}...", file=sys.stderr)
+        rows = prepare(conninfo, args.scale, args.seed, **options(args))
+
+        # the app reads its settings when it is imported
+        os.environ["DATABASE_URL"] = conninfo
+        from app import app
+        from db import pool
+        from jobs import workers
+
+        from bench.workload import State
+        from bench.workload import run
+
+        with psycopg.connect(conninfo) as conn:
+            state = State(conn, args.scale, args.seed)
+
+        print(
+            f"Running {args.concurrency} clients for {args.warmup}+{args.duration}s...",
+            file=sys.stderr,
+        )
+        # customer deletions are queued; run them alongside, as gunicorn would
+        workers.start()
+        results = run(app, state, args.seed, args.concurrency, args.duration, args.warmup)
+        workers.stop()
+        pool.close()
+
+    results = {
+        "commit": git_commit(),
+        "scale": args.scale,
+        "seed": args.seed,
+        "data": options(args),
+        "rows": rows,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        **results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Schema and synthetic data for the benchmark database.
+
+The data is generated in Python from a seed and loaded with COPY by several
+processes at once, each streaming its own range of customers, products,
+suppliers or orders on its own connection. The same seed and options give the
+same rows whatever the number of streams.
+
+Scale 1 is 1000 customers, 500 products, 500 suppliers and 50 employees;
+everything but the workplaces grows linearly. How many orders, lines and
+payments there are is set by the distributions:
+
+    orders per customer   geometric, mean --orders-per-customer (10)
+    lines per order       1 + geometric, mean --lines-per-order (2)
+    products of a line    Zipf over the catalogue, exponent --skew (1, 0 = uniform)
+    payments              each order is payed with probability --paid-fraction (0.7)
+
+The rows satisfy RI-1..RI-3 by construction; RI-1 and RI-2 are enforced as
+they are loaded, RI-3 is checked once, set-wise, at the end (see load()).
+
+To fill an existing empty database, from the web directory:
+
+    python -m bench.data postgres://... --scale 1000 --streams 8
+"""
+import argparse
+import bisect
+import itertools
+import math
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from datetime import timedelta
+from pathlib import Path
+
+import psycopg
+
+from migrate import migrate as apply_migrations
+
+
+SCHEMA = Path(__file__).with_name("schema.sql")
+
+CITIES = ["Lisboa", "Porto", "Coimbra", "Braga", "Faro", "Aveiro", "Evora", "Leiria"]
+DEPARTMENTS = ["Sales", "Logistics", "Finance", "Support", "Purchasing"]
+# Product names are "<material> <item> <number>", so that searches by prefix,
+# word or number match few or many products like real ones.
+MATERIALS = ["Steel", "Wooden", "Plastic", "Copper", "Glass", "Rubber", "Ceramic", "Leather",
+    "Cotton", "Aluminium", "Bamboo", "Paper", "Brass", "Nylon", "Stone", "Silver"]
+ITEMS = ["Hammer", "Chair", "Bottle", "Lamp", "Bucket", "Spoon", "Table", "Brush", "Basket",
+    "Mirror", "Wrench", "Kettle", "Shelf", "Ladder", "Jar", "Rope", "Clock", "Vase", "Drill",
+    "Blanket", "Helmet", "Funnel", "Stool", "Tray", "Hose", "Fan", "Saw", "Crate", "Pump", "Pan"]
+
+# Orders are placed on a day of this range, uniformly.
+FIRST_DAY = date(2022, 1, 1)
+DAYS = 730
+
+# Fraction of the orders processed by an employee.
+PROCESSED_FRACTION = 0.8
+
+DEFAULTS = {
+    "streams": 4,
+    "orders_per_customer": 10.0,
+    "lines_per_order": 2.0,
+    "skew": 1.0,
+    "paid_fraction": 0.7,
+}
+
+
+def sizes(scale):
+    return {
+        "customers": 1000 * scale,
+        "products": 500 * scale,
+        "suppliers": 500 * scale,
+        "employees": 50 * scale,
+        "workplaces": 20,
+    }
+
+
+def geometric(rng, mean):
+    """A number of events >= 0 with the given mean."""
+
+    if mean <= 0:
+        return 0
+    return int(math.log(1.0 - rng.random()) / math.log(mean / (mean + 1.0)))
+
+
+def ranges(n, streams):
+    """Split 1..n into at most `streams` contiguous (first, last) ranges."""
+
+    step = max(1, math.ceil(n / streams))
+    return [(first, min(first + step - 1, n)) for first in range(1, n + 1, step)]
+
+
+def sku(i):
+    return "SKU" + str(i).zfill(8)
+
+
+def tin(i):
+    return "TIN" + str(i).zfill(8)
+
+
+def postal_address(street, i):
+    return f"{street}, {1000 + i % 9000}-{i % 1000:03} {CITIES[i % len(CITIES)]}"
+
+
+def workplace_address(i):
+    return postal_address(f"Zona Industrial {i}", i)
+
+
+def is_warehouse(i):
+    return i % 2 == 0
+
+
+def copy(cur, statement, rows):
+    n = 0
+    with cur.copy(statement) as copy:
+        for row in rows:
+            copy.write_row(row)
+            n += 1
+    return n
+
+
+# Each load_* function runs in a worker process and loads its share in one
+# transaction, returning the number of rows per table.
+
+
+def load_customers(conninfo, seed, first, last):
+    rng = random.Random(f"{seed}:customers:{first}")
+    rows = (
+        (
+            i,
+            f"Customer {i}",
+            f"customer{i}@example.com",
+            str(910000000 + i),
+            postal_address(f"Rua {rng.randint(1, 500)}", i),
+        )
+        for i in range(first, last + 1)
+    )
+    with psycopg.connect(conninfo) as conn, conn.cursor() as cur:
+        n = copy(cur, "COPY customer (cust_no, name, email, phone, address) FROM STDIN", rows)
+    return {"customer": n}
+
+
+def load_products(conninfo, seed, first, last):
+    rng = random.Random(f"{seed}:products:{first}")
+    rows = (
+        (
+            sku(i),
+            f"{rng.choice(MATERIALS)} {rng.choice(ITEMS)} {i}",
+            f"Description of product {i}",
+            round(math.exp(rng.uniform(0, math.log(1000))), 2),
+            5600000000000 + i,
+        )
+        for i in range(first, last + 1)
+    )
+    with psycopg.connect(conninfo) as conn, conn.cursor() as cur:
+        n = copy(cur, "COPY product (SKU, name, description, price, ean) FROM STDIN", rows)
+    return {"product": n}
+
+
+def load_places(conninfo, seed, workplaces, employees):
+    """Workplaces with their office or warehouse, departments and employees.
+
+    They go in one transaction: the RI-2 triggers on workplace, office and
+    warehouse are deferred to its commit.
+    """
+
+    rng = random.Random(f"{seed}:places")
+    places = range(1, workplaces + 1)
+    counts = {}
+    with psycopg.connect(conninfo) as conn, conn.cursor() as cur:
+        counts["workplace"] = copy(
+            cur,
+            "COPY workplace (address, lat, long) FROM STDIN",
+            ((workplace_address(i), 38 + i / 10000, -9 + i / 10000) for i in places),
+        )
+        counts["warehouse"] = copy(
+            cur,
+            "COPY warehouse (address) FROM STDIN",
+            ((workplace_address(i),) for i in places if is_warehouse(i)),
+        )
+        counts["office"] = copy(
+            cur,
+            "COPY office (address) FROM STDIN",
+            ((workplace_address(i),) for i in places if not is_warehouse(i)),
+        )
+        counts["department"] = copy(
+            cur, "COPY department (name) FROM STDIN", ((name,) for name in DEPARTMENTS)
+        )
+        # born between 1950 and 2004, so at least 18 (RI-1)
+        counts["employee"] = copy(
+            cur,
+            "COPY employee (ssn, TIN, bdate, name) FROM STDIN",
+            (
+                (
+                    f"SSN{i}",
+                    f"ETIN{i}",
+                    date(1950, 1, 1) + timedelta(rng.randrange(365 * 55)),
+                    f"Employee {i}",
+                )
+                for i in range(1, employees + 1)
+            ),
+        )
+        counts["works"] = copy(
+            cur,
+            "COPY works (ssn, name, address) FROM STDIN",
+            (
+                (f"SSN{i}", rng.choice(DEPARTMENTS), workplace_address(rng.choice(places)))
+                for i in range(1, employees + 1)
+            ),
+        )
+    return counts
+
+
+def load_suppliers(conninfo, seed, first, last, products, workplaces):
+    """Suppliers of a random product each, delivering to one or two warehouses."""
+
+    rng = random.Random(f"{seed}:suppliers:{first}")
+    warehouses = [workplace_address(i) for i in range(1, workplaces + 1) if is_warehouse(i)]
+    delivery = []
+
+    def suppliers():
+        for i in range(first, last + 1):
+            yield (
+                tin(i),
+                f"Supplier {i}",
+                postal_address(f"Avenida {rng.randint(1, 500)}", i),
+                sku(rng.randint(1, products)),
+                FIRST_DAY - timedelta(rng.randrange(365)),
+            )
+            for address in rng.sample(warehouses, min(len(warehouses), rng.randint(1, 2))):
+                delivery.append((address, tin(i)))
+
+    with psycopg.connect(conninfo) as conn, conn.cursor() as cur:
+        return {
+            "supplier": copy(
+                cur, "COPY supplier (TIN, name, address, SKU, date) FROM STDIN", suppliers()
+            ),
+            "delivery": copy(cur, "COPY delivery (address, TIN) FROM STDIN", delivery),
+        }
+
+
+def order_counts(seed, first, last, orders_per_customer):
+    """The number of orders of each customer of first..last."""
+
+    rng = random.Random(f"{seed}:orders:{first}")
+    return [geometric(rng, orders_per_customer) for _ in range(first, last + 1)]
+
+
+def popularity(products, skew):
+    """Cumulative Zipf weights of the products, the first the most popular."""
+
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, products + 1)))
+
+
+def load_orders(conninfo, seed, first, last, first_order, products, employees, options):
+    """The orders of customers first..last, numbered from first_order, with
+    their lines, payments and processing."""
+
+    counts = order_counts(seed, first, last, options["orders_per_customer"])
+    rng = random.Random(f"{seed}:lines:{first}")
+    weights = popularity(products, options["skew"])
+    orders, lines, pay, process = [], [], [], []
+
+    order_no = first_order
+    for cust_no, n in zip(range(first, last + 1), counts):
+        for _ in range(n):
+            orders.append((order_no, cust_no, FIRST_DAY + timedelta(rng.randrange(DAYS))))
+            size = min(products, 1 + geometric(rng, options["lines_per_order"] - 1))
+            skus = set()
+            while len(skus) < size:
+                skus.add(1 + bisect.bisect_left(weights, rng.random() * weights[-1]))
+            for i in sorted(skus):
+                lines.append((order_no, sku(i), 1 + geometric(rng, 1.5)))
+            if rng.random() < options["paid_fraction"]:
+                pay.append((order_no, cust_no))
+            if rng.random() < PROCESSED_FRACTION:
+                process.append((f"SSN{rng.randint(1, employees)}", order_no))
+            order_no += 1
+
+    with psycopg.connect(conninfo) as conn, conn.cursor() as cur:
+        return {
+            "orders": copy(cur, "COPY orders (order_no, cust_no, date) FROM STDIN", orders),
+            "contains": copy(cur, "COPY contains (order_no, SKU, qty) FROM STDIN", lines),
+            "pay": copy(cur, "COPY pay (order_no, cust_no) FROM STDIN", pay),
+            "process": copy(cur, "COPY process (ssn, order_no) FROM STDIN", process),
+        }
+
+
+def _run(pool, tasks):
+    counts = {}
+    for future in [pool.submit(*task) for task in tasks]:
+        for table, n in future.result().items():
+            counts[table] = counts.get(table, 0) + n
+    return counts
+
+
+def load(conninfo, scale=1, seed=1, **options):
+    """Generate and COPY the data for `scale`; return the rows per table.
+
+    Customers, products and places are loaded first, then suppliers and
+    orders, which reference them. The RI-3 trigger, which scans contains
+    once per new order, is disabled while the orders are loaded; every order
+    is written in the same transaction as its lines and the rule is checked
+    set-wise before the trigger is enabled again.
+    """
+
+    options = {**DEFAULTS, **options}
+    size = sizes(scale)
+    streams = options["streams"]
+
+    with ProcessPoolExecutor(streams) as pool:
+        counts = _run(
+            pool,
+            [(load_customers, conninfo, seed, *r) for r in ranges(size["customers"], streams)]
+            + [(load_products, conninfo, seed, *r) for r in ranges(size["products"], streams)]
+            + [(load_places, conninfo, seed, size["workplaces"], size["employees"])],
+        )
+
+        tasks = [
+            (load_suppliers, conninfo, seed, *r, size["products"], size["workplaces"])
+            for r in ranges(size["suppliers"], streams)
+        ]
+        first_order = 1
+        for first, last in ranges(size["customers"], streams):
+            tasks.append(
+                (load_orders, conninfo, seed, first, last, first_order,
+                    size["products"], size["employees"], options)
+            )
+            first_order += sum(order_counts(seed, first, last, options["orders_per_customer"]))
+
+        with psycopg.connect(conninfo, autocommit=True) as conn:
+            conn.execute("ALTER TABLE orders DISABLE TRIGGER check_order_contains_trigger;")
+            try:
+                counts.update(_run(pool, tasks))
+                orphans = conn.execute(
+                    """
+                    SELECT COUNT(*) FROM orders
+                    WHERE NOT EXISTS (SELECT 1 FROM contains WHERE order_no = orders.order_no);
+                    """
+                ).fetchone()[0]
+                if orphans:
+                    raise RuntimeError(f"{orphans} generated orders have no products.")
+            finally:
+                conn.execute("ALTER TABLE orders ENABLE TRIGGER check_order_contains_trigger;")
+    return counts
+
+
+def prepare(conninfo, scale=1, seed=1, **options):
+    """Create the E3 schema, load the data and apply web/migrations."""
+
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(SCHEMA.read_text())
+    counts = load(conninfo, scale, seed, **options)
+    migrate(conninfo)
+    return counts
+
+
+def migrate(conninfo):
+    """Apply web/migrations with migrate.py, then ANALYZE."""
+
+    apply_migrations(conninfo, log=lambda message: print(message, file=sys.stderr))
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute("ANALYZE;")
+
+
+def add_arguments(parser):
+    parser.add_argument("--scale", type=int, default=1, help="data size (1 = 1000 customers)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the data and the mix")
+    parser.add_argument(
+        "--streams", type=int, default=DEFAULTS["streams"], help="parallel COPY processes"
+    )
+    parser.add_argument(
+        "--orders-per-customer", type=float, default=DEFAULTS["orders_per_customer"],
+        help="mean of the geometric number of orders of a customer",
+    )
+    parser.add_argument(
+        "--lines-per-order", type=float, default=DEFAULTS["lines_per_order"],
+        help="mean of the number of products of an order (>= 1)",
+    )
+    parser.add_argument(
+        "--skew", type=float, default=DEFAULTS["skew"],
+        help="Zipf exponent of the popularity of the products (0 = uniform)",
+    )
+    parser.add_argument(
+        "--paid-fraction", type=float, default=DEFAULTS["paid_fraction"],
+        help="probability that an order is payed",
+    )
+
+
+def options(args):
+    return {name: getattr(args, name) for name in DEFAULTS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.data", description="Fill an empty database with E3 data."
+    )
+    parser.add_argument("database_url")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    start = time.monotonic()
+    counts = prepare(args.database_url, args.scale, args.seed, **options(args))
+    for table, n in counts.items():
+        print(f"{table:<12}{n:>12}", file=sys.stderr)
+    print(f"Loaded in {time.monotonic() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""A throwaway PostgreSQL cluster for the benchmark.
+
+The cluster is created with initdb in a temporary directory, listens only on
+a Unix socket in that directory and is removed on exit. The server binaries
+are looked up in PG_BIN, then through pg_config, then on the PATH.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from pathlib import Path
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+
+def bindir():
+    if os.environ.get("PG_BIN"):
+        return Path(os.environ["PG_BIN"])
+    try:
+        return Path(
+            subprocess.run(
+                ["pg_config", "--bindir"], capture_output=True, check=True, text=True
+            ).stdout.strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        initdb = shutil.which("initdb")
+        if initdb is None:
+            raise RuntimeError("initdb not found; set PG_BIN to the PostgreSQL bin directory.")
+        return Path(initdb).parent
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Postgres:
+    """Context manager running a private cluster; yields its conninfo."""
+
+    def __init__(self, database="bench", user="bench"):
+        self.database = database
+        self.user = user
+        self.bin = bindir()
+        self.dir = None
+        self.port = None
+
+    def _run(self, program, *args):
+        subprocess.run([str(self.bin / program), *args], check=True, capture_output=True)
+
+    def conninfo(self, database=None):
+        return make_conninfo(
+            host=self.dir,
+            port=self.port,
+            user=self.user,
+            dbname=database or self.database,
+        )
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix="bench-pg-")
+        self.port = free_port()
+        data = os.path.join(self.dir, "data")
+        self._run("initdb", "-D", data, "-U", self.user, "-A", "trust", "-E", "UTF8", "--no-sync")
+        self._run(
+            "pg_ctl", "-D", data, "-l", os.path.join(self.dir, "server.log"), "-w",
+            "-o", f"-p {self.port} -k {self.dir} -c listen_addresses=''",
+            "start",
+        )
+        with psycopg.connect(self.conninfo("postgres"), autocommit=True) as conn:
+            conn.execute(f'CREATE DATABASE "{self.database}";')
+        return self.conninfo()
+
+    def __exit__(self, *exc):
+        try:
+            self._run("pg_ctl", "-D", os.path.join(self.dir, "data"), "-m", "fast", "-w", "stop")
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
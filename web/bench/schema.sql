@@ -0,0 +1,160 @@
+-- E3 schema used by the benchmark: the tables, RI-1 (check_age), RI-2
+-- (check_address_constraint_*), RI-3 (check_order_contains_trigger) and the
+-- product_sales view, as in E3/E3-report-47.ipynb. It is loaded into a fresh
+-- database, before the data and web/migrations. product_sales needs
+-- PostgreSQL 15 or later (REGEXP_SUBSTR).
+
+CREATE TABLE customer(
+cust_no INTEGER PRIMARY KEY,
+name VARCHAR(80) NOT NULL,
+email VARCHAR(254) UNIQUE NOT NULL,
+phone VARCHAR(15),
+address VARCHAR(255)
+);
+
+CREATE TABLE orders(
+order_no INTEGER PRIMARY KEY,
+cust_no INTEGER NOT NULL REFERENCES customer,
+date DATE NOT NULL
+--order_no must exist in contains
+);
+
+CREATE TABLE pay(
+order_no INTEGER PRIMARY KEY REFERENCES orders,
+cust_no INTEGER NOT NULL REFERENCES customer
+);
+
+CREATE TABLE employee(
+ssn VARCHAR(20) PRIMARY KEY,
+TIN VARCHAR(20) UNIQUE NOT NULL,
+bdate DATE,
+name VARCHAR NOT NULL
+--age must be >=18
+);
+
+CREATE TABLE process(
+ssn VARCHAR(20) REFERENCES employee,
+order_no INTEGER REFERENCES orders,
+PRIMARY KEY (ssn, order_no)
+);
+
+CREATE TABLE department(
+name VARCHAR PRIMARY KEY
+);
+
+CREATE TABLE workplace(
+address VARCHAR PRIMARY KEY,
+lat NUMERIC(8, 6) NOT NULL,
+long NUMERIC(9, 6) NOT NULL,
+UNIQUE(lat, long)
+--address must be in warehouse or office but not both
+);
+
+CREATE TABLE office(
+address VARCHAR(255) PRIMARY KEY REFERENCES workplace
+);
+
+CREATE TABLE warehouse(
+address VARCHAR(255) PRIMARY KEY REFERENCES workplace
+);
+
+CREATE TABLE works(
+ssn VARCHAR(20) REFERENCES employee,
+name VARCHAR(200) REFERENCES department,
+address VARCHAR(255) REFERENCES workplace,
+PRIMARY KEY (ssn, name, address)
+);
+
+CREATE TABLE product(
+SKU VARCHAR(25) PRIMARY KEY,
+name VARCHAR(200) NOT NULL,
+description VARCHAR,
+price NUMERIC(10, 2) NOT NULL,
+ean NUMERIC(13) UNIQUE
+);
+
+CREATE TABLE contains(
+order_no INTEGER REFERENCES orders,
+SKU VARCHAR(25) REFERENCES product,
+qty INTEGER,
+PRIMARY KEY (order_no, SKU)
+);
+
+CREATE TABLE supplier(
+TIN VARCHAR(20) PRIMARY KEY,
+name VARCHAR(200),
+address VARCHAR(255),
+SKU VARCHAR(25) REFERENCES product,
+date DATE
+);
+
+CREATE TABLE delivery(
+address VARCHAR(255) REFERENCES warehouse,
+TIN VARCHAR(20) REFERENCES supplier,
+PRIMARY KEY (address, TIN)
+);
+
+ALTER TABLE employee ADD CONSTRAINT check_age CHECK (DATE_TRUNC('year', AGE(CURRENT_DATE, bdate)) >= INTERVAL '18 years'); --age must be >=18
+
+CREATE OR REPLACE FUNCTION check_address_constraint() RETURNS TRIGGER AS
+$$
+DECLARE
+    office_count INTEGER;
+    warehouse_count INTEGER;
+BEGIN
+    --  check if address exists in office
+    SELECT COUNT(*) INTO office_count
+    FROM office
+    WHERE address = NEW.address;
+
+    -- check if address exists in warehouse
+    SELECT COUNT(*) INTO warehouse_count
+    FROM warehouse
+    WHERE address = NEW.address;
+
+    -- if it exists in both or none
+    IF (office_count = warehouse_count) THEN
+        RAISE EXCEPTION 'Address must be in warehouse or office but not both';
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Office trigger
+CREATE CONSTRAINT TRIGGER check_address_constraint_office
+AFTER INSERT OR UPDATE OR DELETE ON office DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW
+EXECUTE FUNCTION check_address_constraint();
+
+-- Warehouse trigger
+CREATE CONSTRAINT TRIGGER check_address_constraint_warehouse
+AFTER INSERT OR UPDATE OR DELETE ON warehouse DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW
+EXECUTE FUNCTION check_address_constraint();
+
+-- Workplace trigger
+CREATE CONSTRAINT TRIGGER check_address_constraint_workplace
+AFTER INSERT OR UPDATE ON workplace DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW
+EXECUTE FUNCTION check_address_constraint();
+
+CREATE OR REPLACE FUNCTION check_order_contains() RETURNS TRIGGER AS
+$$
+  BEGIN
+    IF NEW.order_no NOT IN (SELECT order_no FROM contains)
+    THEN RAISE EXCEPTION 'Order % must contain some products', NEW.order_no;
+    END IF;
+    RETURN NEW;
+  END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER check_order_contains_trigger AFTER INSERT ON orders DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW EXECUTE FUNCTION check_order_contains();
+
+
+CREATE VIEW product_sales AS
+SELECT SKU AS sku, order_no, qty, price*qty AS total_price, EXTRACT(YEAR FROM o.date) AS year, EXTRACT(MONTH FROM o.date) AS month, EXTRACT(DAY FROM o.date) AS day_of_month,
+    EXTRACT(DOW FROM o.date) + 1 AS day_of_week, REGEXP_SUBSTR(d.address, '[^,+$ ]+$', 1, 1) AS city
+FROM product pd join contains c using (SKU) join orders o using(order_no) join supplier using (SKU) join delivery d using (TIN) join pay using (order_no);
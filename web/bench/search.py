@@ -0,0 +1,127 @@
+"""Time /products/search on a catalogue of millions of products.
+
+Loads --products generated products (see data.py) into a throwaway cluster,
+applies web/migrations, which create the search indexes, and times searches
+of each kind through the Flask app:
+
+    sku       an exact SKU
+    ean       an exact EAN
+    prefix    the start of a name ("Steel Ham")
+    word      a word found in many names ("hammer")
+    number    a number found in a few names ("123456")
+    missing   a text no product has
+
+Prints the latency of each kind as JSON, and exits with status 1 if the p95
+of any kind is above --target milliseconds. From the web directory:
+
+    python -m bench.search --products 2000000 --streams 8
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import psycopg
+
+from bench.data import ITEMS
+from bench.data import load_products
+from bench.data import MATERIALS
+from bench.data import migrate
+from bench.data import ranges
+from bench.data import SCHEMA
+from bench.data import sku
+from bench.postgres import Postgres
+from bench.workload import percentile
+
+
+def terms(products, seed, n):
+    """`n` search texts of each kind for a catalogue of `products`."""
+
+    rng = random.Random(f"{seed}:search")
+
+    def product():
+        return rng.randint(1, products)
+
+    return {
+        "sku": [sku(product()) for _ in range(n)],
+        "ean": [str(5600000000000 + product()) for _ in range(n)],
+        "prefix": [f"{rng.choice(MATERIALS)} {rng.choice(ITEMS)[:3]}" for _ in range(n)],
+        "word": [rng.choice(ITEMS).lower() for _ in range(n)],
+        "number": [str(product()) for _ in range(n)],
+        "missing": [f"Titanium Anvil {product()}" for _ in range(n)],
+    }
+
+
+def search(client, text):
+    start = time.perf_counter()
+    response = client.get("/products/search", query_string={"q": text})
+    seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"Searching {text!r} answered {response.status_code}.")
+    return seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.search", description=__doc__.split("\n")[0])
+    parser.add_argument("--products", type=int, default=2_000_000, help="products loaded")
+    parser.add_argument("--searches", type=int, default=200, help="searches timed of each kind")
+    parser.add_argument("--target", type=float, default=10, help="p95 to stay under, in ms")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the data and the searches")
+    parser.add_argument("--streams", type=int, default=4, help="parallel COPY processes")
+    parser.add_argument(
+        "--database-url",
+        help="use this empty database instead of a throwaway cluster (initdb/pg_ctl)",
+    )
+    args = parser.parse_args(argv)
+
+    with nullcontext(args.database_url) if args.database_url else Postgres() as conninfo:
+        print(f"Loading {args.products} products...", file=sys.stderr)
+        with psycopg.connect(conninfo, autocommit=True) as conn:
+            conn.execute(SCHEMA.read_text())
+        with ProcessPoolExecutor(args.streams) as executor:
+            loads = [
+                executor.submit(load_products, conninfo, args.seed, first, last)
+                for first, last in ranges(args.products, args.streams)
+            ]
+            for future in loads:
+                future.result()
+        migrate(conninfo)
+
+        # the app reads its settings when it is imported
+        os.environ["DATABASE_URL"] = conninfo
+        from app import app
+        from db import pool
+
+        client = app.test_client()
+        results = {}
+        for kind, texts in terms(args.products, args.seed, args.searches).items():
+            # the first searches prepare the statement and warm the cache
+            for text in texts[:10]:
+                search(client, text)
+            seconds = sorted(search(client, text) for text in texts)
+            results[kind] = {
+                "searches": len(seconds),
+                "mean": sum(seconds) / len(seconds),
+                "p50": percentile(seconds, 50),
+                "p95": percentile(seconds, 95),
+                "p99": percentile(seconds, 99),
+                "max": seconds[-1],
+            }
+        pool.close()
+
+    slow = [kind for kind, r in results.items() if r["p95"] * 1000 > args.target]
+    json.dump(
+        {"products": args.products, "target_ms": args.target, "slow": slow, "kinds": results},
+        sys.stdout,
+        indent=2,
+    )
+    print()
+    sys.exit(1 if slow else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Compare serving a page through app.cgi with serving it from gunicorn.
+
+The cold path runs app.cgi once per request, as the web server would: a new
+interpreter imports the app, compiles the templates and connects to the
+database. The warm path starts gunicorn with gunicorn.conf.py once, then
+times the same requests against its already running workers. Both are
+reported as JSON, with the time the server took to become ready.
+
+From the web directory:
+
+    python -m bench.startup --requests 20 --path /products
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from contextlib import nullcontext
+from pathlib import Path
+
+from bench.data import prepare
+from bench.postgres import free_port
+from bench.postgres import Postgres
+
+
+WEB = Path(__file__).parent.parent
+# Seconds to wait for gunicorn to become ready.
+START_TIMEOUT = 60
+
+
+def summary(seconds):
+    return {
+        "requests": len(seconds),
+        "mean": statistics.fmean(seconds),
+        "p50": statistics.median(seconds),
+        "max": max(seconds),
+    }
+
+
+def cold(env, path, requests):
+    """Time `requests` runs of app.cgi for `path`."""
+
+    path, _, query = path.partition("?")
+    env = dict(
+        env,
+        REQUEST_METHOD="GET",
+        PATH_INFO=path,
+        QUERY_STRING=query,
+        SCRIPT_NAME="",
+        SERVER_NAME="localhost",
+        SERVER_PORT="80",
+        SERVER_PROTOCOL="HTTP/1.1",
+    )
+    seconds = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "app.cgi"], cwd=WEB, env=env, capture_output=True, check=True
+        )
+        seconds.append(time.perf_counter() - start)
+        status = result.stdout.split(b"\r\n", 1)[0]
+        if not status.startswith(b"Status: 200"):
+            raise RuntimeError(f"app.cgi answered {status.decode()}")
+    return summary(seconds)
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        response.read()
+        return response.status
+
+
+def warm(env, path, requests, workers):
+    """Start gunicorn, then time `requests` requests for `path`."""
+
+    port = free_port()
+    env = dict(env, BIND=f"127.0.0.1:{port}", WEB_CONCURRENCY=str(workers))
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+        cwd=WEB,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("gunicorn exited; is it installed?")
+            if time.perf_counter() - start > START_TIMEOUT:
+                raise RuntimeError("gunicorn did not become ready.")
+            try:
+                if get(base + "/health/ready") == 200:
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.05)
+        ready = time.perf_counter() - start
+
+        seconds = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            get(base + path)
+            seconds.append(time.perf_counter() - start)
+    finally:
+        server.terminate()
+        server.wait()
+    return {"startup": ready, **summary(seconds)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.startup", description=__doc__.split("\n")[0])
+    parser.add_argument("--path", default="/products", help="page requested")
+    parser.add_argument("--requests", type=int, default=20, help="requests timed on each path")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument(
+        "--database-url",
+        help="use this loaded database instead of a throwaway cluster (initdb/pg_ctl)",
+    )
+    args = parser.parse_args(argv)
+
+    with nullcontext(args.database_url) if args.database_url else Postgres() as conninfo:
+        if not args.database_url:
+            prepare(conninfo)
+        env = dict(os.environ, DATABASE_URL=conninfo)
+        results = {
+            "path": args.path,
+            "cold": cold(env, args.path, args.requests),
+            "warm": warm(env, args.path, args.requests, args.workers),
+        }
+    results["speedup"] = results["cold"]["p50"] / results["warm"]["p50"]
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
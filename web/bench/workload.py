@@ -0,0 +1,273 @@
+"""The mixed workload driven through the Flask app.
+
+Each thread has its own test client and picks operations at random with the
+weights of MIX: mostly browsing, plus the writes of the forms. Writes that can
+only succeed once (paying an order, deleting a customer) draw their targets
+from reserves of the generated data, so every run sees the same kind of rows.
+Latency is measured around the whole request, from the client's side;
+database round trips come from the app's own metrics.
+"""
+import queue
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from itertools import count
+
+import metrics
+
+from bench.data import sizes
+from bench.data import sku
+from bench.data import tin
+
+
+# How many unpayed orders are set aside for payments and added products.
+RESERVED_ORDERS = 100000
+
+
+class Reserve:
+    """Targets of one-shot writes; get() is None once they run out."""
+
+    def __init__(self, items):
+        self._items = queue.SimpleQueue()
+        for item in items:
+            self._items.put(item)
+
+    def get(self):
+        try:
+            return self._items.get_nowait()
+        except queue.Empty:
+            return None
+
+
+class State:
+    """What the operations of all the threads share."""
+
+    def __init__(self, conn, scale, seed):
+        self.sizes = sizes(scale)
+        rng = random.Random(seed)
+        customers = self.sizes["customers"]
+
+        # the last tenth of the customers are only ever deleted
+        self.deletable = customers - customers // 10
+        deleted = list(range(self.deletable + 1, customers + 1))
+        rng.shuffle(deleted)
+        self.to_delete = Reserve(deleted)
+
+        self.orders = conn.execute("SELECT MAX(order_no) FROM orders;").fetchone()[0]
+        # a sample of the generated orders that are not payed, half of them
+        # to be payed and half to have products added
+        self.owners = dict(
+            conn.execute(
+                """
+                SELECT order_no, cust_no FROM orders
+                WHERE cust_no <= %(deletable)s
+                    AND NOT EXISTS (SELECT 1 FROM pay WHERE order_no = orders.order_no)
+                ORDER BY order_no
+                LIMIT %(limit)s;
+                """,
+                {"deletable": self.deletable, "limit": RESERVED_ORDERS},
+            ).fetchall()
+        )
+        unpayed = sorted(self.owners)
+        rng.shuffle(unpayed)
+        self.to_pay = Reserve(unpayed[::2])
+        self.to_extend = Reserve(unpayed[1::2])
+
+        self.serial = count(1)
+        self.run = str(int(time.time()) % 1000000)
+
+    def sku(self, rng):
+        return sku(rng.randint(1, self.sizes["products"]))
+
+    def customer(self, rng):
+        return rng.randint(1, self.deletable)
+
+
+def product_index(client, state, rng):
+    return client.get("/products", query_string={"after": state.sku(rng)})
+
+
+def orders_index(client, state, rng):
+    return client.get(
+        "/orders", query_string={"after": rng.randint(1, state.orders)}
+    )
+
+
+def customer_index(client, state, rng):
+    return client.get("/customers", query_string={"after": state.customer(rng)})
+
+
+def supplier_index(client, state, rng):
+    return client.get(
+        "/suppliers", query_string={"after": tin(rng.randint(1, state.sizes["suppliers"]))}
+    )
+
+
+def order_info(client, state, rng):
+    return client.get(f"/orders/{rng.randint(1, state.orders)}/update")
+
+
+def customer_info(client, state, rng):
+    return client.get(f"/customers/{state.customer(rng)}/update")
+
+
+def sales_dashboard(client, state, rng):
+    return client.get("/reports/sales")
+
+
+def product_register(client, state, rng):
+    n = next(state.serial)
+    return client.post(
+        "/products/register",
+        data={
+            "SKU": f"B{state.run}-{n}",
+            "name": f"Bench product {n}",
+            "description": "Registered by the benchmark",
+            "price": f"{rng.uniform(1, 1000):.2f}",
+            "EAN": "",
+        },
+    )
+
+
+def place_order(client, state, rng):
+    return client.post(
+        "/orders/register",
+        data={
+            "cust_no": str(state.customer(rng)),
+            "date": "2023-06-01",
+            "sku": state.sku(rng),
+            "qty": str(rng.randint(1, 10)),
+        },
+    )
+
+
+def add_product(client, state, rng):
+    order_no = state.to_extend.get()
+    if order_no is None:
+        return None
+    # a product already in the order is rejected and flashed, as for a user
+    return client.post(
+        f"/orders/{order_no}/addproduct",
+        data={"sku": state.sku(rng), "qty": str(rng.randint(1, 10))},
+    )
+
+
+def pay_order(client, state, rng):
+    order_no = state.to_pay.get()
+    if order_no is None:
+        return None
+    return client.post(
+        f"/orders/{order_no}/pay",
+        data={"payment_method": "MBWay", "cust_no_pay": str(state.owners[order_no])},
+    )
+
+
+def customer_delete(client, state, rng):
+    cust_no = state.to_delete.get()
+    if cust_no is None:
+        return None
+    return client.post(f"/customers/{cust_no}/delete")
+
+
+# operation -> relative weight
+MIX = {
+    product_index: 20,
+    orders_index: 10,
+    customer_index: 5,
+    supplier_index: 5,
+    order_info: 20,
+    customer_info: 10,
+    sales_dashboard: 2,
+    product_register: 5,
+    place_order: 10,
+    add_product: 8,
+    pay_order: 5,
+    customer_delete: 2,
+}
+
+
+def percentile(sorted_seconds, p):
+    index = min(len(sorted_seconds) - 1, int(len(sorted_seconds) * p / 100))
+    return sorted_seconds[index]
+
+
+def worker(app, state, seed, deadline, record, results):
+    client = app.test_client()
+    rng = random.Random(seed)
+    operations = list(MIX)
+    weights = list(MIX.values())
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        start = time.perf_counter()
+        response = operation(client, state, rng)
+        seconds = time.perf_counter() - start
+        if response is None:
+            # its reserve is used up
+            continue
+        if record.is_set():
+            results[operation.__name__].append((seconds, response.status_code))
+
+
+def run(app, state, seed, concurrency, duration, warmup):
+    """Run the mix on `concurrency` threads and return the stats per route.
+
+    The first `warmup` seconds fill the pool, the prepared statements and
+    the caches and are not recorded.
+    """
+
+    record = threading.Event()
+    per_thread = [defaultdict(list) for _ in range(concurrency)]
+    deadline = time.monotonic() + warmup + duration
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(app, state, f"{seed}-{i}", deadline, record, per_thread[i]),
+            daemon=True,
+        )
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(warmup)
+    round_trips = {op.__name__: metrics.REQUEST_ROUND_TRIPS.get(route=op.__name__) for op in MIX}
+    record.set()
+    start = time.monotonic()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    samples = defaultdict(list)
+    for results in per_thread:
+        for route, values in results.items():
+            samples[route].extend(values)
+
+    routes = {}
+    for route in sorted(samples):
+        seconds = sorted(s for s, _ in samples[route])
+        trips = metrics.REQUEST_ROUND_TRIPS.get(route=route) - round_trips[route]
+        routes[route] = {
+            "requests": len(seconds),
+            "errors": sum(1 for _, status in samples[route] if status >= 500),
+            "throughput": len(seconds) / elapsed,
+            "mean": statistics.fmean(seconds),
+            "p50": percentile(seconds, 50),
+            "p95": percentile(seconds, 95),
+            "p99": percentile(seconds, 99),
+            # requests still in flight when recording starts are counted in
+            # the totals, which is negligible over the duration of a run
+            "round_trips": trips / len(seconds),
+        }
+
+    every = sorted(s for values in samples.values() for s, _ in values)
+    total = {
+        "requests": len(every),
+        "errors": sum(r["errors"] for r in routes.values()),
+        "throughput": len(every) / elapsed,
+        "p50": percentile(every, 50) if every else None,
+        "p95": percentile(every, 95) if every else None,
+        "p99": percentile(every, 99) if every else None,
+    }
+    return {"elapsed": elapsed, "routes": routes, "total": total}
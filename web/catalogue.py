@@ -0,0 +1,119 @@
+"""Process-local cache of the product catalogue.
+
+Products are cached by SKU. Each worker process runs a listener thread with
+its own connection LISTENing on the `product_changed` channel, where the
+triggers from migrations/0002_product_notify.sql publish the SKU of every
+product that is inserted, updated or deleted (an empty payload means the
+whole table changed). Entries are only cached while the listener is
+connected, so a worker that cannot hear invalidations falls back to reading
+the database.
+
+It serves the reads of single products by SKU: the product update page and
+GET /api/v1/products/<sku>, and the early rejection of SKUs it already found
+missing on the register and order forms. The other hot reads of the products
+do not go through it: the listing pages are cached whole by fragments.py,
+and order totals come from order_summary (migration 0003) rather than from
+the prices. With a size of 0 there is no cache, no listener and no
+connection of its own: every read goes to the pool.
+"""
+import os
+import threading
+import time
+
+import psycopg
+from psycopg.rows import namedtuple_row
+
+from cache import LRUCache
+from queries import PRODUCT_BY_SKU
+from queries import run
+
+
+CHANNEL = "product_changed"
+# Seconds to wait before reconnecting a listener that lost its connection.
+RECONNECT_DELAY = 5
+
+_MISSING = object()
+
+
+class Catalogue:
+    def __init__(self, pool, conninfo, maxsize, log):
+        self.pool = pool
+        self.conninfo = conninfo
+        self.log = log
+        self.cache = LRUCache(maxsize)
+        self._listening = False
+        self._generation = 0
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def product(self, sku):
+        """Return the product with `sku`, or None if there isn't one."""
+
+        if self.cache.maxsize <= 0:
+            return self._read(sku)
+        self._ensure_listener()
+        product = self.cache.get(sku, _MISSING)
+        if product is not _MISSING:
+            return product
+
+        generation = self._generation
+        product = self._read(sku)
+
+        # Don't cache a row that may have been invalidated while reading it.
+        if self._listening and generation == self._generation:
+            self.cache.put(sku, product)
+        return product
+
+    def known_missing(self, sku):
+        """Whether the cache already knows there is no product with `sku`.
+
+        Never touches the database, so write paths can reject unknown SKUs
+        early and otherwise leave the check to the foreign keys.
+        """
+
+        return self._listening and self.cache.get(sku, _MISSING) is None
+
+    def invalidate(self, sku=None):
+        """Drop `sku` (or everything) from the cache."""
+
+        with self._lock:
+            self._generation += 1
+        if sku:
+            self.cache.pop(sku)
+        else:
+            self.cache.clear()
+
+    def _read(self, sku):
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=namedtuple_row) as cur:
+                return run(cur, PRODUCT_BY_SKU, {"sku": sku}).fetchone()
+
+    def _ensure_listener(self):
+        # Threads do not survive fork, so every worker starts its own.
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listening = False
+            self.cache.clear()
+            self._listener_pid = os.getpid()
+            threading.Thread(
+                target=self._listen, name="catalogue-listener", daemon=True
+            ).start()
+
+    def _listen(self):
+        while True:
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {CHANNEL};")
+                    # Anything cached before LISTEN took effect may be stale.
+                    self.invalidate()
+                    self._listening = True
+                    for notify in conn.notifies():
+                        self.invalidate(notify.payload)
+            except psycopg.Error as e:
+                self.log.warning(f"Catalogue listener disconnected: {e}")
+            self._listening = False
+            self.invalidate()
+            time.sleep(RECONNECT_DELAY)
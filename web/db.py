@@ -0,0 +1,349 @@
+"""Database access shared by the HTML views and the JSON API.
+
+The statements themselves are registered in queries.py; this module runs
+them on the worker's connection pool. The reads of the views go through
+reader(), which picks the replica pool when the request may use it.
+"""
+import contextvars
+import logging
+import os
+import time
+
+import psycopg
+from flask import g
+from flask import request
+from psycopg.rows import namedtuple_row
+
+import metrics
+from catalogue import Catalogue
+from metrics import TimedPool
+from pooling import DATABASE_READ_URL
+from pooling import READY_TIMEOUT
+from pooling import ReplicaLag
+from pooling import WorkerPool
+from queries import API_ORDER
+from queries import API_ORDER_LINES
+from queries import constraint_error
+from queries import CUSTOMER_BY_NO
+from queries import CUSTOMER_LATEST_ORDERS
+from queries import full_listing
+from queries import HEALTH_CHECK
+from queries import JOB_BY_ID
+from queries import JOB_RECENT
+from queries import keyset
+from queries import ORDER_BY_NO
+from queries import ORDER_LINES
+from queries import ORDER_PAYED
+from queries import ORDER_TOTALS
+from queries import page
+from queries import PLAN_HISTORY
+from queries import PLAN_REPORT
+from queries import PAGE_SIZE
+from queries import PREPARE_STATEMENTS
+from queries import REPLICA_LAG
+from queries import run
+from queries import SALES_CUBE_REFRESH
+from queries import SALES_CUBE_STATUS
+from queries import SALES_LATEST_YEAR
+from queries import SALES_ROLLUPS
+from queries import sales_rollups
+from queries import SUPPLIER_BY_TIN
+from queries import SUPPLIER_DELETE
+from queries import TABLE_VERSIONS
+from views import TABLE_VERSION_MISSING
+
+
+log = logging.getLogger(__name__)
+
+# postgres://{user}:{password}@{hostname}:{port}/{database-name}
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgres://db:db@postgres/db")
+
+# Each worker opens its pool on first use; see pooling.py for its settings.
+pool = TimedPool(WorkerPool(DATABASE_URL))
+read_pool = TimedPool(WorkerPool(DATABASE_READ_URL)) if DATABASE_READ_URL else None
+
+replica_lag = ReplicaLag()
+_use_replica = contextvars.ContextVar("use_replica", default=False)
+
+# Rows fetched per round trip when a listing is streamed whole (?stream=1).
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 1000))
+# Products kept in each worker's catalogue cache.
+CATALOGUE_CACHE_SIZE = int(os.environ.get("CATALOGUE_CACHE_SIZE", 10000))
+
+
+def execute(query, params=None):
+    """Run a single statement in its own transaction and return its rows.
+
+    Returns the rows of a SELECT or of a RETURNING clause (an empty list for
+    statements without either). Database errors are raised to the caller.
+    """
+
+    with pool.connection() as conn:
+        with conn.cursor(row_factory=namedtuple_row) as cur:
+            run(cur, query, params)
+            return cur.fetchall() if cur.description else []
+
+
+def use_replica(allowed):
+    """Let (or stop) the reads of the current request go to the replica."""
+
+    _use_replica.set(allowed and read_pool is not None)
+
+
+def replica_fresh():
+    """Whether the replica is within REPLICA_MAX_LAG of the primary."""
+
+    if replica_lag.due():
+        try:
+            with read_pool.connection(timeout=READY_TIMEOUT) as conn:
+                with conn.cursor() as cur:
+                    lag = run(cur, REPLICA_LAG).fetchone()[0]
+        except psycopg.Error as e:
+            log.warning(f"Replica lag check failed: {e}")
+            lag = None
+        replica_lag.record(lag)
+    return replica_lag.fresh
+
+
+def reader():
+    """The pool the reads of the current request should use."""
+
+    if _use_replica.get() and replica_fresh():
+        return read_pool
+    return pool
+
+
+def read(query, params=None):
+    """Like execute(), for a read that may go to the replica."""
+
+    with reader().connection() as conn:
+        with conn.cursor(row_factory=namedtuple_row) as cur:
+            run(cur, query, params)
+            return cur.fetchall()
+
+
+def table_version(tables):
+    """Return (version, last change) of `tables` together, or None if they
+    are not tracked (migration 0004 not applied).
+
+    The version grows with every statement that writes to any of them, and
+    is read from the same pool as the pages showing them, once per request.
+    """
+
+    tables = tuple(tables)
+    versions = g.setdefault("table_versions", {})
+    if tables not in versions:
+        try:
+            row = read(TABLE_VERSIONS, {"tables": list(tables)})[0]
+            versions[tables] = row.version, row.changed_at
+        except psycopg.errors.UndefinedTable:
+            log.warning(TABLE_VERSION_MISSING)
+            versions[tables] = None
+    return versions[tables]
+
+
+def sales_report(year=None, sku=None):
+    """Return the rollups of sales_cube for `year`, as last refreshed.
+
+    Returns (year, rollups, status), where rollups maps "total", "month",
+    "day_of_week" and "city" to their rows, and status says when the cube
+    was refreshed and how many paid orders and products wait for the next
+    refresh; `year` defaults to the latest one with sales, and `sku`
+    restricts the report to one product. Only reads, so it may go to the
+    replica.
+    """
+
+    rows = []
+    with reader().connection() as conn:
+        with conn.cursor(row_factory=namedtuple_row) as cur:
+            status = run(cur, SALES_CUBE_STATUS).fetchone()
+            if year is None:
+                year = run(cur, SALES_LATEST_YEAR).fetchone().year
+            if year is not None:
+                rows = run(cur, SALES_ROLLUPS, {"year": year, "sku": sku}).fetchall()
+    return year, sales_rollups(rows), status
+
+
+def refresh_sales_cube():
+    """Fold the payments and changes made since the last refresh into
+    sales_cube; return how many orders and products were folded in."""
+
+    changes = execute(SALES_CUBE_REFRESH)[0].changes
+    log.debug(f"Folded {changes} changes into sales_cube.")
+    return changes
+
+
+def health():
+    """Return (ready, stats): whether a pooled connection answers within
+    READY_TIMEOUT seconds, and the counters of this worker's pool."""
+
+    try:
+        with pool.connection(timeout=READY_TIMEOUT) as conn:
+            with conn.cursor() as cur:
+                run(cur, HEALTH_CHECK)
+        ready = True
+    except psycopg.Error as e:
+        log.warning(f"Readiness check failed: {e}")
+        ready = False
+    return ready, pool.get_stats()
+
+
+def write(query, params):
+    """Run a single write statement in its own transaction.
+
+    The database constraints do the existence and uniqueness checks, so the
+    write costs one round trip. Returns (row, error): the first RETURNING row
+    of the statement (None if it has none or affected no rows) and the
+    user-facing message of the constraint it violated (None on success).
+    """
+
+    try:
+        rows = execute(query, params)
+    except (psycopg.IntegrityError, psycopg.DataError) as e:
+        log.debug(f"Write rejected: {e.diag.message_primary}")
+        return None, constraint_error(e)
+    return (rows[0] if rows else None), None
+
+
+def pipelined(conn, queries, params):
+    """Run the registered `queries`, all taking `params`, as one batch and commit.
+
+    The statements still run in order inside one transaction, but they are
+    sent together and their results are read back together, so the batch
+    costs a single network round trip instead of one per statement. Returns
+    one cursor per query, ready to fetch from.
+    """
+
+    start = time.perf_counter()
+    with conn.pipeline():
+        cursors = [
+            conn.cursor(row_factory=namedtuple_row).execute(
+                query.sql, params, prepare=PREPARE_STATEMENTS
+            )
+            for query in queries
+        ]
+        conn.commit()
+    metrics.pipeline_done(queries, cursors, time.perf_counter() - start)
+    return cursors
+
+
+def fetch_page(query, key, cast=str, params=None):
+    """Fetch one page of the listing `query` using keyset pagination on `key`.
+
+    The page position comes from the `after`/`before` request arguments,
+    see queries.keyset(); `params` are the other parameters of the query.
+    Returns a queries.Page.
+    """
+
+    statement, cursor, size, after, before = keyset(query, key, request.args, cast)
+    with reader().connection() as conn:
+        with conn.cursor(row_factory=namedtuple_row) as cur:
+            rows = run(cur, query, {**(params or {}), **cursor}, statement).fetchall()
+            log.debug(f"Found {cur.rowcount} rows.")
+    return page(rows, key, size, after, before)
+
+
+def stream_rows(query, key):
+    """Return a generator of every row of a listing, from a server-side cursor.
+
+    Rows are pulled STREAM_BATCH_SIZE at a time, so memory use does not grow
+    with the size of the table. The connection is held until the generator
+    is exhausted or closed.
+    """
+
+    # The pool is chosen now, while the request is being handled.
+    return _stream_rows(reader(), full_listing(query, key))
+
+
+def _stream_rows(source, query):
+    with source.connection() as conn:
+        with conn.cursor(name="listing", row_factory=namedtuple_row) as cur:
+            cur.itersize = STREAM_BATCH_SIZE
+            yield from cur.execute(query)
+
+
+catalogue = Catalogue(pool, DATABASE_URL, CATALOGUE_CACHE_SIZE, log)
+
+
+def get_supplier(tin):
+    """Return the supplier with `tin`, or None."""
+
+    rows = read(SUPPLIER_BY_TIN, {"tin": tin})
+    return rows[0] if rows else None
+
+
+def get_customer(cust_no, limit=PAGE_SIZE):
+    """Return (customer or None, their latest `limit` orders with totals)."""
+
+    with reader().connection() as conn:
+        customer, orders = pipelined(
+            conn,
+            (CUSTOMER_BY_NO, CUSTOMER_LATEST_ORDERS),
+            {"cust_no": cust_no, "limit": limit},
+        )
+        return customer.fetchone(), orders.fetchall()
+
+
+def get_order(order_no):
+    """Return (order or None, its lines with the product names)."""
+
+    with reader().connection() as conn:
+        order, lines = pipelined(conn, (ORDER_BY_NO, ORDER_LINES), {"order_no": order_no})
+        return order.fetchone(), lines.fetchall()
+
+
+def is_payed(order_no):
+    """Return whether the order has been paid."""
+
+    return read(ORDER_PAYED, {"order_no": order_no})[0].payed > 0
+
+
+def get_payment(order_no):
+    """Return (whether the order has been paid, its order_summary totals or None)."""
+
+    with reader().connection() as conn:
+        payed, totals = pipelined(conn, (ORDER_PAYED, ORDER_TOTALS), {"order_no": order_no})
+        return payed.fetchone().payed > 0, totals.fetchone()
+
+
+def get_api_order(order_no):
+    """Return (order with totals and payment or None, its lines with prices)."""
+
+    with reader().connection() as conn:
+        order, lines = pipelined(conn, (API_ORDER, API_ORDER_LINES), {"order_no": order_no})
+        return order.fetchone(), lines.fetchall()
+
+
+def delete_supplier(tin):
+    """Delete a supplier and its deliveries."""
+
+    with pool.connection() as conn:
+        pipelined(conn, SUPPLIER_DELETE, {"supplier_tin": tin})
+
+
+def get_job(job_id):
+    """Return the background job `job_id` (see jobs.py), or None.
+
+    Jobs are read from the primary, so their progress is never behind.
+    """
+
+    rows = execute(JOB_BY_ID, {"job": job_id})
+    return rows[0] if rows else None
+
+
+def recent_jobs(limit=PAGE_SIZE):
+    """Return the latest `limit` background jobs, newest first."""
+
+    return execute(JOB_RECENT, {"limit": limit})
+
+
+def plan_report():
+    """Return the captured plans summed up per query (see plans.py)."""
+
+    return execute(PLAN_REPORT)
+
+
+def plan_history(query_name, limit=PAGE_SIZE):
+    """Return the latest `limit` captured plans of `query_name`, newest first."""
+
+    return execute(PLAN_HISTORY, {"query_name": query_name, "limit": limit})
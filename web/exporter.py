@@ -0,0 +1,162 @@
+"""Streaming CSV/NDJSON export of the tables and views behind the app.
+
+Every export is a single COPY ... TO STDOUT whose output is relayed to the
+client chunk by chunk as the server produces it, so a worker holds at most
+EXPORT_CHUNK_SIZE bytes of an export at a time, however large the table.
+Rows come out in storage order; sorting would delay the first byte until
+the whole result had been read.
+"""
+from collections import namedtuple
+from datetime import date
+
+from psycopg import sql
+
+
+# Bytes collected from COPY before they are handed to the WSGI server.
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+# `query` is a SELECT with a `{where}` placeholder; `date` is the expression
+# the date_from/date_to filters apply to (None if the export has no date).
+Export = namedtuple("Export", ["query", "date"])
+
+EXPORTS = {
+    "products": Export(
+        """
+        SELECT SKU, name, description, price, ean
+        FROM product
+        {where}
+        """,
+        None,
+    ),
+    "suppliers": Export(
+        """
+        SELECT TIN, name, address, SKU, date
+        FROM supplier
+        {where}
+        """,
+        "date",
+    ),
+    "delivery": Export(
+        """
+        SELECT address, TIN
+        FROM delivery
+        {where}
+        """,
+        None,
+    ),
+    "customers": Export(
+        """
+        SELECT cust_no, name, email, phone, address
+        FROM customer
+        {where}
+        """,
+        None,
+    ),
+    "orders": Export(
+        """
+        SELECT order_no, cust_no, date
+        FROM orders
+        {where}
+        """,
+        "date",
+    ),
+    "contains": Export(
+        """
+        SELECT order_no, SKU, qty
+        FROM contains JOIN orders USING (order_no)
+        {where}
+        """,
+        "orders.date",
+    ),
+    "pay": Export(
+        """
+        SELECT order_no, pay.cust_no
+        FROM pay JOIN orders USING (order_no)
+        {where}
+        """,
+        "orders.date",
+    ),
+    "product_sales": Export(
+        """
+        SELECT sku, order_no, qty, total_price, year, month, day_of_month,
+            day_of_week, city
+        FROM product_sales
+        {where}
+        """,
+        "make_date(year::integer, month::integer, day_of_month::integer)",
+    ),
+}
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def export_dates(args):
+    """(date_from, date_to) from ?date_from= and ?date_to=, None when unset.
+
+    Raises ValueError, with the message to answer, when a date is not in
+    the YYYY-MM-DD format.
+    """
+
+    try:
+        return tuple(
+            date.fromisoformat(args[name]) if args.get(name) else None
+            for name in ("date_from", "date_to")
+        )
+    except ValueError:
+        raise ValueError("Dates are required to be in the YYYY-MM-DD format.") from None
+
+
+def export_statement(entity, fmt, date_from=None, date_to=None):
+    """Build the COPY statement for an export, filtered to the date range."""
+
+    spec = EXPORTS[entity]
+    filters = []
+    if spec.date is not None and date_from is not None:
+        filters.append(sql.SQL("{} >= {}").format(sql.SQL(spec.date), sql.Literal(date_from)))
+    if spec.date is not None and date_to is not None:
+        filters.append(sql.SQL("{} <= {}").format(sql.SQL(spec.date), sql.Literal(date_to)))
+    where = sql.SQL("WHERE ") + sql.SQL(" AND ").join(filters) if filters else sql.SQL("")
+    query = sql.SQL(spec.query).format(where=where)
+
+    if fmt == "csv":
+        return sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true);").format(query)
+    # One JSON object per line. row_to_json escapes every control character,
+    # so with these otherwise unused quote/delimiter bytes COPY never quotes
+    # or escapes the JSON text it emits.
+    return sql.SQL(
+        "COPY (SELECT row_to_json(t) FROM ({}) t) TO STDOUT "
+        "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02');"
+    ).format(query)
+
+
+def stream_export(pool, statement):
+    """Yield the output of a COPY TO STDOUT `statement` in chunks."""
+
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            with cur.copy(statement) as copy:
+                buffer = bytearray()
+                while data := copy.read():
+                    buffer += data
+                    if len(buffer) >= EXPORT_CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+                yield bytes(buffer)
+
+
+async def stream_export_async(pool, statement):
+    """Like stream_export(), on a psycopg_pool AsyncConnectionPool."""
+
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            async with cur.copy(statement) as copy:
+                buffer = bytearray()
+                while data := await copy.read():
+                    buffer += data
+                    if len(buffer) >= EXPORT_CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+                yield bytes(buffer)
@@ -0,0 +1,231 @@
+"""Validation of the HTML forms of views.py.
+
+Each function takes the submitted form and returns (values, error): the
+parameters for the statement in queries.py and the message to flash (None
+when the form is valid). Whether a product exists is left to the views (the
+catalogue cache) and the foreign keys.
+"""
+
+
+def is_price(value):
+    size = len(value)
+    for i in range(size):
+        if not value[i].isdigit() and value[i] not in ('.', ','):
+            return False
+    return True
+
+
+def product_register(form):
+    error = None
+
+    SKU = form["SKU"]
+    if not SKU:
+        error = "SKU is required."
+    else:
+        if len(SKU) > 25:
+            error = "SKU is required to be atmost 25 characters long."
+
+    name = form["name"]
+    if not name:
+        error = "Name is required."
+    else:
+        if len(name) > 200:
+            error = "Name is required to be atmost 200 characters long."
+
+    desc = form["description"]
+
+    price = form["price"]
+    if not price:
+        error = "Price is required."
+    else:
+        if not is_price(price):
+            error = "Price isn't valid."
+        elif len(price) > 11:
+            error = "Price must have atmost 10 digits."
+
+    EAN = form["EAN"] or None
+    if EAN is not None:
+        if not EAN.isnumeric():
+            error = "EAN is required to be numeric."
+        elif len(EAN) > 13:
+            error = "EAN is required to be atmost 13 digits long."
+
+    return {"SKU": SKU, "name": name, "desc": desc, "price": price, "EAN": EAN}, error
+
+
+def product_search(args):
+    error = None
+
+    text = (args.get("q") or "").strip()
+    if len(text) > 200:
+        error = "Search is required to be atmost 200 characters long."
+
+    # LIKE wildcards typed by the user are matched literally.
+    pattern = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    EAN = int(text) if text.isascii() and text.isdigit() and len(text) <= 13 else None
+
+    return {
+        "sku": text,
+        "ean": EAN,
+        # the names from `text` (inclusive) to `text` followed by the last
+        # code point (exclusive) are the ones starting with `text`
+        "prefix": text,
+        "prefix_end": text + "\U0010ffff",
+        # a trigram has 3 characters; shorter texts only match prefixes
+        "pattern": f"%{pattern}%" if len(text) >= 3 else None,
+    }, error
+
+
+def product_update(form):
+    error = None
+
+    price = form["price"] or None
+    if price is not None:
+        if not is_price(price):
+            error = "Price isn't valid."
+        elif len(price) > 11:
+            error = "Price must have atmost 10 digits."
+
+    desc = form["description"]
+
+    if not price and not desc:
+        error = "Atleast one of price or description is required."
+
+    return {"price": price, "desc": desc}, error
+
+
+def supplier_register(form):
+    error = None
+
+    TIN = form["TIN"]
+    if not TIN:
+        error = "TIN is required."
+    else:
+        if len(TIN) > 20:
+            error = "TIN is required to be atmost 20 characters long."
+
+    name = form["name"]
+    if name is not None:
+        if len(name) > 200:
+            error = "Name is required to be atmost 200 characters long."
+
+    address = form["address"]
+    if address is not None:
+        if len(address) > 255:
+            error = "Address is required to be atmost 255 characters long."
+
+    SKU = form["SKU"]
+    if not SKU:
+        error = "SKU is required."
+    else:
+        if len(SKU) > 25:
+            error = "SKU is required to be atmost 25 characters long."
+
+    date = form["date"] or None
+
+    return {"TIN": TIN, "name": name, "address": address, "SKU": SKU, "date": date}, error
+
+
+def customer_register(form):
+    error = None
+
+    name = form["name"]
+    if not name:
+        error = "Name is required."
+        if not name.isalpha():
+            error = "Name is required to be alphabetic."
+        elif len(name) > 80:
+            error = "Name is required to be atmost 80 characters long."
+
+    email = form["email"]
+    if not email:
+        error = "Email is required."
+        if len(email) > 254:
+            error = "Email is required to be atmost 254 characters long."
+
+    phone = form["phone"]
+    if phone is not None:
+        if len(phone) > 15:
+            error = "Phone is required to be atmost 15 characters long."
+
+    address = form["address"]
+    if address is not None:
+        if len(address) > 255:
+            error = "Address is required to be atmost 255 characters long."
+
+    return {"name": name, "email": email, "phone": phone, "address": address}, error
+
+
+def place_order(form):
+    error = None
+
+    cust_no = form["cust_no"]
+    if not cust_no:
+        error = "Customer number is required."
+    else:
+        if not cust_no.isnumeric():
+            error = "Customer number is required to be an integer."
+
+    date = form["date"]
+    if not date:
+        error = "Date is required."
+
+    first_sku = form["sku"]
+    if not first_sku:
+        error = "New order is required to have atleast one product."
+    else:
+        if len(first_sku) > 25:
+            error = "SKU is required to be atmost 25 characters long."
+
+    qty = form["qty"]
+    if not qty:
+        error = "Quantity is required."
+    else:
+        if not qty.isnumeric() or int(qty) <= 0:
+            error = "Quantity is required to be a positive integer."
+
+    if error is not None:
+        return None, error
+    return {"cust_no": cust_no, "date": date, "sku": first_sku, "qty": int(qty)}, None
+
+
+def add_product(form):
+    error = None
+
+    sku = form["sku"]
+    if not sku:
+        error = "Product SKU is required."
+    else:
+        if len(sku) > 25:
+            error = "SKU is required to be atmost 25 characters long."
+
+    qty = form["qty"]
+    if not qty:
+        error = "Quantity is required."
+    else:
+        if not qty.isnumeric() or int(qty) <= 0:
+            error = "Quantity is required to be a positive integer."
+
+    if error is not None:
+        return None, error
+    return {"sku": sku, "qty": int(qty)}, None
+
+
+def pay_order(form):
+    error = None
+
+    payment_method = form["payment_method"]
+    if not payment_method:
+        error = "Payment method is required."
+    else:
+        if payment_method not in ("MBWay", "Multibanco", "Paypal", "Visa"):
+            error = "Payment method is required to be one of those listed."
+
+    cust_no_pay = form["cust_no_pay"]
+    if not cust_no_pay:
+        error = "The number of the customer who is going to pay is required."
+    else:
+        if not cust_no_pay.isnumeric():
+            error = "Customer number is required to be an integer."
+
+    return {"cust_no": cust_no_pay}, error
@@ -0,0 +1,121 @@
+"""Cache of rendered listing fragments.
+
+The rows of a listing page are rendered once and reused until the tables
+they come from change. The views key each fragment on their route, the page
+cursor (after/before/size) and the version of the tables from
+db.table_version(), so a write makes the old entries unreachable and the
+LRU evicts them; nothing has to be invalidated.
+
+Each worker keeps the fragments in an LRUCache. With FRAGMENT_CACHE_DIR set
+(e.g. a directory under /dev/shm) they are also written there as files, so
+the workers of a host render each page once between them.
+"""
+import hashlib
+import os
+import tempfile
+
+from markupsafe import Markup
+
+from cache import LRUCache
+
+
+# Fragments kept in each worker's memory (0 disables).
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 256))
+# Directory shared by the workers of a host (default unset), and the number
+# of fragments kept there.
+FRAGMENT_CACHE_DIR = os.environ.get("FRAGMENT_CACHE_DIR")
+FRAGMENT_CACHE_DIR_SIZE = int(os.environ.get("FRAGMENT_CACHE_DIR_SIZE", 4096))
+
+
+class SharedFragments:
+    """Fragments stored as one file each in a directory.
+
+    Files are replaced atomically, so a reader never sees a partial one.
+    Once the directory holds more than `maxsize` fragments the least
+    recently read ones are removed.
+    """
+
+    def __init__(self, path, maxsize, log):
+        self.path = path
+        self.maxsize = maxsize
+        self.log = log
+        self._puts = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + ".html")
+
+    def get(self, key):
+        path = self._file(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                fragment = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.log.warning(f"Cannot read {path}: {e}")
+            return None
+        return fragment
+
+    def put(self, key, fragment):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(fragment)
+            os.replace(tmp, self._file(key))
+        except OSError as e:
+            self.log.warning(f"Cannot write to {self.path}: {e}")
+            return
+        self._puts += 1
+        if self._puts % (self.maxsize // 10 + 1) == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove the least recently read fragments beyond `maxsize`."""
+
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    if entry.name.endswith(".html"):
+                        entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        for _, path in entries[: max(len(entries) - self.maxsize, 0)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class Fragments:
+    def __init__(self, maxsize, log, path=None, shared_maxsize=FRAGMENT_CACHE_DIR_SIZE):
+        self.cache = LRUCache(maxsize)
+        self.shared = SharedFragments(path, shared_maxsize, log) if path else None
+
+    def get(self, key):
+        """Return (fragment, result) for `key`.
+
+        result is "hit" (this worker's cache), "shared_hit" (the shared
+        directory) or "miss", in which case fragment is None.
+        """
+
+        fragment = self.cache.get(key)
+        if fragment is not None:
+            return fragment, "hit"
+        if self.shared is not None:
+            fragment = self.shared.get(key)
+            if fragment is not None:
+                fragment = Markup(fragment)
+                self.cache.put(key, fragment)
+                return fragment, "shared_hit"
+        return None, "miss"
+
+    def put(self, key, fragment):
+        fragment = Markup(fragment)
+        self.cache.put(key, fragment)
+        if self.shared is not None:
+            self.shared.put(key, str(fragment))
+        return fragment
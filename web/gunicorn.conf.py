@@ -0,0 +1,58 @@
+"""Gunicorn settings for serving app.py from long-lived pre-forked workers.
+
+From the web directory:
+
+    pip install gunicorn
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Unlike app.cgi, which starts an interpreter, imports Flask, compiles the
+templates and connects to the database for every request, each worker does
+that once and then serves requests from threads sharing its connection pool.
+The pool is opened in the worker, after fork; the templates are compiled
+before the worker takes its first request. Each worker also runs JOB_THREADS
+threads taking the queued background jobs (see jobs.py).
+
+`kill -HUP <master pid>` reloads gracefully: new workers load the current
+code and settings, and the old ones finish the requests they are serving
+before they exit. `kill -TERM` stops the server the same way.
+"""
+import os
+
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+# Worker processes, and request threads per worker. Keep the threads at or
+# below POOL_MAX_SIZE, or they queue for connections.
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = "gthread"
+
+# Seconds a worker may spend on a request before it is restarted, and that
+# old workers are given to finish their requests on reload or shutdown.
+timeout = int(os.environ.get("WEB_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+# Replace a worker after this many requests (0 never), with some jitter so
+# they are not all replaced at once.
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    # Runs in the worker once the app is imported, before its first request.
+    from app import warm_templates
+    from db import pool
+    from jobs import workers
+
+    warm_templates()
+    pool.open()
+    workers.start()
+
+
+def worker_exit(server, worker):
+    from db import pool
+    from jobs import workers
+
+    # Running jobs finish their current chunk and go back to the queue.
+    workers.stop(graceful_timeout)
+    pool.close()
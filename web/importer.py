@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+"""Bulk CSV import of products, customers and suppliers.
+
+The CSV (with a header row, columns in the order listed in IMPORTS) is
+streamed into a temporary staging table with COPY FROM STDIN, one COPY per
+part of the file read, validated
+set-wise with the same rules as the register forms and merged into the real
+table in the same transaction. Rows that break a rule are reported back with
+their line number instead of aborting the load.
+
+Usage: python importer.py {products,customers,suppliers} FILE.csv
+"""
+import argparse
+import os
+import sys
+from collections import namedtuple
+from functools import partial
+
+import psycopg
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgres://db:db@postgres/db")
+
+# Bytes of the uploaded file sent per COPY message.
+COPY_CHUNK_SIZE = 64 * 1024
+# Bytes of a file uploaded for an import job stored per row of job_data.
+UPLOAD_PART_SIZE = int(os.environ.get("UPLOAD_PART_SIZE", 1024 * 1024))
+# Largest request body the apps accept, so the largest file they import.
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 512 * 1024 * 1024))
+# Rejected rows reported back (the count is always complete).
+MAX_REPORTED_ERRORS = 1000
+
+# `checks` is evaluated against staging rows `s` and yields the first rule
+# the row breaks (or NULL); `merge` inserts the valid rows and returns the
+# `key` of every row it inserted, so rows lost to a concurrent insert are
+# reported as conflicts too.
+Import = namedtuple("Import", ["columns", "key", "checks", "merge", "conflict"])
+
+IMPORTS = {
+    "products": Import(
+        columns=("sku", "name", "description", "price", "ean"),
+        key="sku",
+        checks="""
+            CASE
+                WHEN COALESCE(sku, '') = '' THEN 'SKU is required.'
+                WHEN length(sku) > 25 THEN 'SKU is required to be atmost 25 characters long.'
+                WHEN COALESCE(name, '') = '' THEN 'Name is required.'
+                WHEN length(name) > 200 THEN 'Name is required to be atmost 200 characters long.'
+                WHEN COALESCE(price, '') = '' THEN 'Price is required.'
+                WHEN price !~ '^[0-9]+([.,][0-9]*)?$' THEN 'Price isn''t valid.'
+                WHEN length(price) > 11 OR price !~ '^[0-9]{1,8}([.,]|$)'
+                    THEN 'Price must have atmost 10 digits.'
+                WHEN ean !~ '^[0-9]*$' THEN 'EAN is required to be numeric.'
+                WHEN length(ean) > 13 THEN 'EAN is required to be atmost 13 digits long.'
+                WHEN line > MIN(line) OVER (PARTITION BY sku)
+                    OR EXISTS (SELECT 1 FROM product p WHERE p.SKU = s.sku)
+                    THEN 'There is already a product with that SKU.'
+                WHEN ean <> '' AND (
+                    line > MIN(line) OVER (PARTITION BY ean = '', ltrim(ean, '0'))
+                    OR EXISTS (SELECT 1 FROM product p WHERE p.ean = NULLIF(s.ean, '')::numeric))
+                    THEN 'There is already a product with that ean.'
+            END
+            """,
+        merge="""
+            INSERT INTO product (SKU, name, description, price, ean)
+            SELECT sku, name, description, replace(price, ',', '.')::numeric,
+                NULLIF(ean, '')::numeric
+            FROM staging
+            WHERE error IS NULL
+            ORDER BY line
+            ON CONFLICT DO NOTHING
+            RETURNING SKU AS key
+            """,
+        # ON CONFLICT DO NOTHING does not tell which of the two keys was taken.
+        conflict="There is already a product with that SKU or ean.",
+    ),
+    "customers": Import(
+        columns=("name", "email", "phone", "address"),
+        key="email",
+        checks="""
+            CASE
+                WHEN COALESCE(name, '') = '' THEN 'Name is required.'
+                WHEN length(name) > 80 THEN 'Name is required to be atmost 80 characters long.'
+                WHEN COALESCE(email, '') = '' THEN 'Email is required.'
+                WHEN length(email) > 254 THEN 'Email is required to be atmost 254 characters long.'
+                WHEN length(phone) > 15 THEN 'Phone is required to be atmost 15 characters long.'
+                WHEN length(address) > 255 THEN 'Address is required to be atmost 255 characters long.'
+                WHEN line > MIN(line) OVER (PARTITION BY email)
+                    OR EXISTS (SELECT 1 FROM customer c WHERE c.email = s.email)
+                    THEN 'There is already a customer with that email.'
+            END
+            """,
+        merge="""
+            INSERT INTO customer (name, email, phone, address)
+            SELECT name, email, NULLIF(phone, ''), NULLIF(address, '')
+            FROM staging
+            WHERE error IS NULL
+            ORDER BY line
+            ON CONFLICT DO NOTHING
+            RETURNING email AS key
+            """,
+        conflict="There is already a customer with that email.",
+    ),
+    "suppliers": Import(
+        columns=("tin", "name", "address", "sku", "date"),
+        key="tin",
+        checks="""
+            CASE
+                WHEN COALESCE(tin, '') = '' THEN 'TIN is required.'
+                WHEN length(tin) > 20 THEN 'TIN is required to be atmost 20 characters long.'
+                WHEN length(name) > 200 THEN 'Name is required to be atmost 200 characters long.'
+                WHEN length(address) > 255 THEN 'Address is required to be atmost 255 characters long.'
+                WHEN COALESCE(sku, '') = '' THEN 'SKU is required.'
+                WHEN length(sku) > 25 THEN 'SKU is required to be atmost 25 characters long.'
+                WHEN date !~ '^([1-9][0-9]{3}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01]))?$'
+                    THEN 'Date isn''t valid.'
+                WHEN date <> '' AND substr(date, 9, 2)::integer > EXTRACT(DAY FROM
+                    make_date(substr(date, 1, 4)::integer, substr(date, 6, 2)::integer, 1)
+                    + INTERVAL '1 month - 1 day')
+                    THEN 'Date isn''t valid.'
+                WHEN line > MIN(line) OVER (PARTITION BY tin)
+                    OR EXISTS (SELECT 1 FROM supplier p WHERE p.TIN = s.tin)
+                    THEN 'There is already a supplier with that TIN.'
+                WHEN NOT EXISTS (SELECT 1 FROM product p WHERE p.SKU = s.sku)
+                    THEN 'There isn''t a product with that SKU.'
+            END
+            """,
+        merge="""
+            INSERT INTO supplier (TIN, name, address, SKU, date)
+            SELECT tin, name, address, sku, NULLIF(date, '')::date
+            FROM staging
+            WHERE error IS NULL
+            ORDER BY line
+            ON CONFLICT DO NOTHING
+            RETURNING TIN AS key
+            """,
+        conflict="There is already a supplier with that TIN.",
+    ),
+}
+
+
+def rows_end(data):
+    """The length of the complete rows at the start of the CSV bytes `data`.
+
+    That is just past its last newline outside a quoted field: a quote
+    inside a field is doubled, so a newline ends a row when the quotes
+    before it are even.
+    """
+
+    quotes = data.count(b'"')
+    end = len(data)
+    while (newline := data.rfind(b"\n", 0, end)) >= 0:
+        quotes -= data.count(b'"', newline, end)
+        if quotes % 2 == 0:
+            return newline + 1
+        end = newline
+    return 0
+
+
+def copy_rows(cur, columns, data, header):
+    """COPY the complete CSV rows `data` into staging."""
+
+    with cur.copy(
+        f"COPY staging ({columns}) FROM STDIN WITH (FORMAT csv, HEADER {str(header).lower()});"
+    ) as copy:
+        view = memoryview(data)
+        for start in range(0, len(view), COPY_CHUNK_SIZE):
+            copy.write(view[start:start + COPY_CHUNK_SIZE])
+
+
+def import_csv(conn, entity, parts):
+    """Load the CSV into the table behind `entity`.
+
+    `parts` yields the bytes of the file in order. The rows complete so far
+    are copied after each part, and the next part is only asked for once
+    that COPY is over, so it may be read from `conn` (see jobs.job_data()).
+    Runs inside the caller's transaction on `conn`. Returns
+    (imported, rejected, errors), where `errors` lists the (line, message)
+    of the first MAX_REPORTED_ERRORS rejected rows.
+    """
+
+    spec = IMPORTS[entity]
+    columns = ", ".join(spec.columns)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TEMP TABLE staging (
+                line BIGSERIAL,
+                {", ".join(f"{column} TEXT" for column in spec.columns)},
+                error TEXT
+            ) ON COMMIT DROP;
+            """
+        )
+        header = True
+        rest = b""
+        for part in parts:
+            data = rest + part
+            end = rows_end(data)
+            rest = data[end:]
+            if end:
+                copy_rows(cur, columns, data[:end], header)
+                header = False
+        # The last row may have no newline.
+        if rest:
+            copy_rows(cur, columns, rest, header)
+
+        cur.execute(
+            f"""
+            UPDATE staging SET error = checked.error
+            FROM (SELECT line, {spec.checks} AS error FROM staging s) checked
+            WHERE staging.line = checked.line AND checked.error IS NOT NULL;
+            """
+        )
+        cur.execute(
+            f"""
+            WITH merged AS ({spec.merge})
+            UPDATE staging SET error = %(conflict)s
+            WHERE error IS NULL
+                AND NOT EXISTS (SELECT 1 FROM merged WHERE key = staging.{spec.key});
+            """,
+            {"conflict": spec.conflict},
+        )
+
+        imported, rejected = cur.execute(
+            """
+            SELECT COUNT(*) FILTER (WHERE error IS NULL),
+                COUNT(*) FILTER (WHERE error IS NOT NULL)
+            FROM staging;
+            """
+        ).fetchone()
+        # line 1 of the file is the header
+        errors = cur.execute(
+            """
+            SELECT line + 1, error
+            FROM staging
+            WHERE error IS NOT NULL
+            ORDER BY line
+            LIMIT %(limit)s;
+            """,
+            {"limit": MAX_REPORTED_ERRORS},
+        ).fetchall()
+
+    return imported, rejected, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import a CSV file.")
+    parser.add_argument("entity", choices=IMPORTS)
+    parser.add_argument("file", type=argparse.FileType("rb"))
+    args = parser.parse_args()
+
+    try:
+        with psycopg.connect(DATABASE_URL) as conn:
+            parts = iter(partial(args.file.read, UPLOAD_PART_SIZE), b"")
+            imported, rejected, errors = import_csv(conn, args.entity, parts)
+    except psycopg.DataError as e:
+        print(f"The file isn't a valid CSV: {e.diag.message_primary}", file=sys.stderr)
+        return 2
+
+    for line, error in errors:
+        print(f"line {line}: {error}", file=sys.stderr)
+    print(f"{imported} imported, {rejected} rejected.")
+    return 1 if rejected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
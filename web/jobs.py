@@ -0,0 +1,312 @@
+"""Background jobs: the long deletes and the CSV imports, run outside requests.
+
+Jobs are rows of the job table (migrations/0007_jobs.sql). The views enqueue
+one with enqueue() and answer at once with a link to its status page. Worker
+threads claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+threads, in any number of processes, share the queue without a broker and
+never take the same job. Deletes work in chunks of JOB_CHUNK_SIZE orders or
+order lines, each in a short transaction of its own that also records the
+progress of the job, so no request waits on their locks for long. A job whose
+worker died stops beating; once its heartbeat is JOB_STALE_SECONDS old it is
+claimed again and carries on where it stopped.
+
+The job threads also fold the new sales into sales_cube every
+SALES_CUBE_REFRESH_INTERVAL seconds, so /reports/sales only reads it.
+
+gunicorn.conf.py starts JOB_THREADS job threads in each web worker. Under
+app.cgi or asgi.py, or to run the jobs on other hosts, start them from the
+web directory:
+
+    python jobs.py --threads 4
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+
+import psycopg
+from psycopg.rows import namedtuple_row
+from psycopg.types.json import Jsonb
+
+from db import execute
+from db import pipelined
+from db import pool
+from db import refresh_sales_cube
+from importer import import_csv
+from importer import UPLOAD_PART_SIZE
+from queries import CUSTOMER_DELETE
+from queries import CUSTOMER_DELETE_ORDERS
+from queries import CUSTOMER_ORDERS_CHUNK
+from queries import JOB_CLAIM
+from queries import JOB_CUSTOMER_DELETE_TOTAL
+from queries import JOB_DATA_APPEND
+from queries import JOB_DATA_PART
+from queries import JOB_DONE
+from queries import JOB_ENQUEUE
+from queries import JOB_FAILED
+from queries import JOB_HEARTBEAT
+from queries import JOB_PRODUCT_DELETE_TOTAL
+from queries import JOB_PROGRESS
+from queries import JOB_RELEASE
+from queries import PRODUCT_DELETE
+from queries import PRODUCT_DELETE_LINES
+from queries import run
+from views import job_row
+
+
+log = logging.getLogger(__name__)
+
+# Job threads started in each gunicorn worker (0 leaves the jobs to jobs.py).
+JOB_THREADS = int(os.environ.get("JOB_THREADS", 1))
+# Orders (customer deletes) or order lines (product deletes) per transaction.
+JOB_CHUNK_SIZE = int(os.environ.get("JOB_CHUNK_SIZE", 1000))
+# Seconds an idle job thread waits before looking at the queue again.
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+# Seconds without a heartbeat after which a running job is claimed again.
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", 60))
+# Claims of a job before it is failed, so a job that kills its worker ends.
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+# Seconds between two refreshes of sales_cube (0 leaves them to cron).
+SALES_CUBE_REFRESH_INTERVAL = float(os.environ.get("SALES_CUBE_REFRESH_INTERVAL", 60))
+
+
+class JobError(Exception):
+    """A job failed; the message is shown on its status page."""
+
+
+class Interrupted(Exception):
+    """The worker is stopping between two chunks of a job."""
+
+
+def enqueue(kind, title, params, upload=None):
+    """Queue a job of `kind` and return its id.
+
+    `upload`, a binary file, is copied into job_data UPLOAD_PART_SIZE bytes
+    at a time, in the transaction that queues the job, so no worker claims
+    the job before its file is complete.
+    """
+
+    with pool.connection() as conn:
+        with conn.cursor(row_factory=namedtuple_row) as cur:
+            job_id = run(cur, JOB_ENQUEUE, job_row(kind, title, params)).fetchone().id
+            part = 0
+            while upload is not None and (data := upload.read(UPLOAD_PART_SIZE)):
+                run(cur, JOB_DATA_APPEND, {"job": job_id, "part": part, "data": data})
+                part += 1
+    return job_id
+
+
+def job_data(conn, job_id):
+    """The parts of the file uploaded for a job, in order.
+
+    Each part is read from job_data on `conn` when asked for, so the job
+    holds no other connection and no more than one part at a time.
+    """
+
+    with conn.cursor(row_factory=namedtuple_row) as cur:
+        part = 0
+        while row := run(cur, JOB_DATA_PART, {"job": job_id, "part": part}).fetchone():
+            yield row.data
+            part += 1
+
+
+def delete_customer(conn, job, stopping):
+    """Delete a customer, JOB_CHUNK_SIZE of their orders per transaction."""
+
+    params = {"job": job.id, "cust_no": job.params["cust_no"], "limit": JOB_CHUNK_SIZE}
+    pipelined(conn, (JOB_CUSTOMER_DELETE_TOTAL,), params)
+    with conn.cursor(row_factory=namedtuple_row) as cur:
+        while True:
+            if stopping.is_set():
+                raise Interrupted
+            orders = [row.order_no for row in run(cur, CUSTOMER_ORDERS_CHUNK, params)]
+            if not orders:
+                break
+            pipelined(
+                conn,
+                (*CUSTOMER_DELETE_ORDERS, JOB_PROGRESS),
+                {**params, "orders": orders, "done": len(orders)},
+            )
+    # Also removes the orders placed since the last chunk, and the customer.
+    pipelined(conn, CUSTOMER_DELETE, params)
+
+
+def delete_product(conn, job, stopping):
+    """Delete a product, JOB_CHUNK_SIZE of its order lines per transaction."""
+
+    params = {"job": job.id, "product_sku": job.params["sku"], "limit": JOB_CHUNK_SIZE}
+    pipelined(conn, (JOB_PRODUCT_DELETE_TOTAL,), params)
+    with conn.cursor(row_factory=namedtuple_row) as cur:
+        while True:
+            if stopping.is_set():
+                raise Interrupted
+            deleted = run(cur, PRODUCT_DELETE_LINES, params).fetchone().deleted
+            conn.commit()
+            if not deleted:
+                break
+    pipelined(conn, PRODUCT_DELETE, params)
+
+
+def import_file(conn, job, stopping):
+    """Run the uploaded CSV import in one transaction, see importer.import_csv()."""
+
+    try:
+        imported, rejected, errors = import_csv(conn, job.params["entity"], job_data(conn, job.id))
+    except psycopg.DataError as e:
+        raise JobError(f"The file isn't a valid CSV: {e.diag.message_primary}") from e
+    pipelined(conn, (JOB_PROGRESS,), {"job": job.id, "done": imported + rejected})
+    return {"imported": imported, "rejected": rejected, "errors": errors}
+
+
+HANDLERS = {
+    "customer_delete": delete_customer,
+    "product_delete": delete_product,
+    "import": import_file,
+}
+
+
+class Workers:
+    """Threads running the queued jobs, one beating for those they run, and
+    one refreshing sales_cube."""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if not self.threads:
+            return
+        self._stopping.clear()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.threads)
+        ]
+        self._threads.append(
+            threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+        )
+        if SALES_CUBE_REFRESH_INTERVAL:
+            self._threads.append(
+                threading.Thread(target=self._refresh, name="sales-cube-refresh", daemon=True)
+            )
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Stop once the running jobs finish their chunk; they go back to the queue."""
+
+        self._stopping.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        self._threads = []
+
+    def run_next(self):
+        """Claim the oldest runnable job and run it; return whether there was one."""
+
+        with pool.connection() as conn:
+            with conn.cursor(row_factory=namedtuple_row) as cur:
+                job = run(cur, JOB_CLAIM, {"stale": JOB_STALE_SECONDS}).fetchone()
+                conn.commit()
+            if job is None:
+                return False
+
+            if job.attempts > JOB_MAX_ATTEMPTS:
+                error = f"Its worker stopped {JOB_MAX_ATTEMPTS} times, giving up."
+                pipelined(conn, (JOB_FAILED,), {"job": job.id, "error": error})
+                return True
+
+            log.info(f"Running job {job.id} ({job.kind}).")
+            with self._lock:
+                self._running.add(job.id)
+            try:
+                result = HANDLERS[job.kind](conn, job, self._stopping)
+            except Interrupted:
+                conn.rollback()
+                pipelined(conn, (JOB_RELEASE,), {"job": job.id})
+                log.info(f"Job {job.id} put back in the queue.")
+            except JobError as e:
+                conn.rollback()
+                log.warning(f"Job {job.id} failed: {e}")
+                pipelined(conn, (JOB_FAILED,), {"job": job.id, "error": str(e)})
+            except psycopg.Error as e:
+                conn.rollback()
+                log.warning(f"Job {job.id} failed: {e}")
+                error = e.diag.message_primary or str(e)
+                pipelined(conn, (JOB_FAILED,), {"job": job.id, "error": error})
+            except Exception:
+                conn.rollback()
+                log.exception(f"Job {job.id} failed.")
+                error = "Unexpected error, see the log of the worker."
+                pipelined(conn, (JOB_FAILED,), {"job": job.id, "error": error})
+            else:
+                pipelined(conn, (JOB_DONE,), {"job": job.id, "result": Jsonb(result)})
+                log.info(f"Job {job.id} done.")
+            finally:
+                with self._lock:
+                    self._running.discard(job.id)
+        return True
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self.run_next()
+            except psycopg.Error as e:
+                # The job, if any, is claimed again once its heartbeat is stale.
+                log.warning(f"Job worker lost its connection: {e}")
+                ran = False
+            if not ran:
+                self._stopping.wait(JOB_POLL_INTERVAL)
+
+    def _beat(self):
+        while not self._stopping.wait(JOB_STALE_SECONDS / 4):
+            with self._lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                execute(JOB_HEARTBEAT, {"jobs": running})
+            except psycopg.Error as e:
+                log.warning(f"Job heartbeat failed: {e}")
+
+    def _refresh(self):
+        # Every worker refreshes; refresh_sales_cube() returns at once while
+        # another one is running.
+        while not self._stopping.wait(SALES_CUBE_REFRESH_INTERVAL):
+            try:
+                refresh_sales_cube()
+            except psycopg.Error as e:
+                log.warning(f"sales_cube refresh failed: {e}")
+
+
+workers = Workers(JOB_THREADS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the queued background jobs.")
+    parser.add_argument(
+        "--threads", type=int, default=max(JOB_THREADS, 1), help="jobs run at the same time"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(message)s")
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    runner = Workers(args.threads)
+    runner.start()
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    log.info("Stopping, waiting for the running jobs to finish their chunk.")
+    runner.stop()
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
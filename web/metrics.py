@@ -0,0 +1,286 @@
+"""Request, query and template instrumentation in Prometheus text format.
+
+Every registered query run through queries.run() and every pooled connection
+taken through a TimedPool is recorded twice: in the process-wide metrics
+served at /metrics, and in the trace of the request being handled (if any),
+which after_request() turns into per-route metrics and, for slow requests,
+into a log line with the query breakdown.
+
+Metrics are per process; with several workers each one serves its own.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+# Requests slower than this many seconds are logged with their queries.
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0))
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+
+
+def _labels(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _labels(self.labels, key)
+                lines.append(f"{self.name}{{{labels}}} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                labels = _labels(self.labels, key)
+                prefix = labels + "," if labels else ""
+                for bound, count in zip(self.buckets, state):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {state[-1]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {state[-2]}")
+                lines.append(f"{self.name}_count{{{labels}}} {state[-1]}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request.",
+    ("route", "method", "status"),
+)
+REQUESTS_SHED = Counter(
+    "http_requests_shed_total",
+    "Requests answered with a 503 because no pooled connection was free in time.",
+    ("route",),
+)
+REQUEST_ROUND_TRIPS = Counter(
+    "http_request_db_round_trips_total",
+    "Database round trips made by the requests of a route.",
+    ("route",),
+)
+REQUEST_ROWS = Counter(
+    "http_request_db_rows_total",
+    "Rows returned or affected by the queries of a route.",
+    ("route",),
+)
+REQUEST_POOL_WAIT = Histogram(
+    "http_request_pool_wait_seconds",
+    "Time a request spent waiting for pooled connections.",
+    ("route",),
+)
+REQUEST_RENDER_SECONDS = Histogram(
+    "http_request_render_seconds",
+    "Time a request spent rendering templates.",
+    ("route",),
+)
+QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time spent executing a registered query.",
+    ("query",),
+)
+QUERY_ROWS = Counter(
+    "db_query_rows_total",
+    "Rows returned or affected by a registered query.",
+    ("query",),
+)
+FRAGMENT_LOOKUPS = Counter(
+    "fragment_cache_lookups_total",
+    "Listing fragments found in the worker's cache (hit), the shared directory (shared_hit) or rendered (miss).",
+    ("route", "result"),
+)
+TEMPLATE_SECONDS = Histogram(
+    "template_render_seconds",
+    "Time spent rendering a template.",
+    ("template",),
+)
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """What one request did: its queries, round trips, pool waits and renders."""
+
+    def __init__(self, route=None):
+        self.start = time.perf_counter()
+        self.route = route
+        self.queries = []
+        self.round_trips = 0
+        self.pool_wait = 0.0
+        self.render = 0.0
+        self._rendering = {}
+
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def query_done(name, seconds, rows, round_trips=1):
+    """Record a registered query; pipelined statements share a round trip."""
+
+    rows = max(rows, 0)
+    QUERY_SECONDS.observe(seconds, query=name)
+    QUERY_ROWS.inc(rows, query=name)
+    trace = _trace.get()
+    if trace is not None:
+        trace.queries.append((name, seconds, rows))
+        trace.round_trips += round_trips
+
+
+def pipeline_done(queries, cursors, seconds):
+    """Record a batch of pipelined queries, which took `seconds` in all."""
+
+    # The statements shared one round trip, each is charged all of it.
+    for i, (query, cur) in enumerate(zip(queries, cursors)):
+        query_done(query.name, seconds, cur.rowcount, round_trips=int(i == 0))
+
+
+def pool_wait(seconds):
+    trace = _trace.get()
+    if trace is not None:
+        trace.pool_wait += seconds
+
+
+def render_started(template):
+    trace = _trace.get()
+    if trace is not None:
+        trace._rendering[template] = time.perf_counter()
+
+
+def render_done(template):
+    trace = _trace.get()
+    if trace is not None and template in trace._rendering:
+        seconds = time.perf_counter() - trace._rendering.pop(template)
+        TEMPLATE_SECONDS.observe(seconds, template=template)
+        trace.render += seconds
+
+
+def before_request(route=None):
+    """Start tracing the current request."""
+
+    _trace.set(Trace(route))
+
+
+def current_route():
+    """The route of the request being traced, or None outside of requests."""
+
+    trace = _trace.get()
+    return trace.route if trace is not None else None
+
+
+def after_request(route, method, status):
+    """Record the metrics of the current request and log it if it was slow."""
+
+    trace = _trace.get()
+    if trace is None:
+        return
+    _trace.set(None)
+    seconds = time.perf_counter() - trace.start
+
+    REQUEST_SECONDS.observe(seconds, route=route, method=method, status=status)
+    REQUEST_ROUND_TRIPS.inc(trace.round_trips, route=route)
+    REQUEST_ROWS.inc(sum(rows for _, _, rows in trace.queries), route=route)
+    REQUEST_POOL_WAIT.observe(trace.pool_wait, route=route)
+    REQUEST_RENDER_SECONDS.observe(trace.render, route=route)
+
+    if seconds >= SLOW_REQUEST_SECONDS:
+        breakdown = ", ".join(
+            f"{name} {query_seconds:.3f}s/{rows} rows"
+            for name, query_seconds, rows in trace.queries
+        )
+        log.warning(
+            f"Slow request {method} {route} {status} took {seconds:.3f}s: "
+            f"{trace.round_trips} round trips, pool wait {trace.pool_wait:.3f}s, "
+            f"render {trace.render:.3f}s; queries: {breakdown or 'none'}"
+        )
+
+
+class TimedPool:
+    """A psycopg_pool ConnectionPool that records how long connection() waited."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        start = time.perf_counter()
+        with self._pool.connection(timeout=timeout) as conn:
+            pool_wait(time.perf_counter() - start)
+            yield conn
+
+
+class AsyncTimedPool(TimedPool):
+    """Like TimedPool, for an AsyncConnectionPool."""
+
+    @asynccontextmanager
+    async def connection(self, timeout=None):
+        start = time.perf_counter()
+        async with self._pool.connection(timeout=timeout) as conn:
+            pool_wait(time.perf_counter() - start)
+            yield conn
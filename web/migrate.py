@@ -0,0 +1,282 @@
+"""Apply web/migrations to the database, in order, each one once.
+
+Migrations are the files of web/migrations named NNNN_description.sql. Each
+one applied is recorded in schema_migration with the SHA-256 of the file, so
+a later run only applies the new ones, and stops if a migration that was
+already applied has been edited since.
+
+A migration runs in a transaction of its own, unless it builds indexes with
+CREATE INDEX CONCURRENTLY, which cannot run inside one. Those migrations run
+statement by statement (each statement ending with a ';' at the end of a
+line), and the tables stay writable while their indexes are built. A build
+that fails leaves an invalid index behind; the next run drops it and builds
+it again. Runs on the same database wait for each other.
+
+From the web directory:
+
+    python migrate.py                  apply the pending migrations
+    python migrate.py --status         list the migrations and when they were applied
+    python migrate.py --baseline 0008  record 0001 to 0008 as applied without
+                                       running them, for a database that was
+                                       migrated by hand with psql
+    python migrate.py --repair         record the checksums of the applied
+                                       migrations as they are now, once an
+                                       edit that does not need to be run
+                                       again was reviewed
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import psycopg
+
+
+# postgres://{user}:{password}@{hostname}:{port}/{database-name}
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgres://db:db@postgres/db")
+
+MIGRATIONS = Path(__file__).parent / "migrations"
+# Seconds between two attempts to take the lock held by another run.
+LOCK_POLL_INTERVAL = 5
+
+Migration = namedtuple("Migration", ["version", "name", "path", "sql", "checksum"])
+
+_FILE_NAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+_CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE
+)
+_STATEMENT_END = re.compile(r";[ \t]*$", re.MULTILINE)
+_DOLLAR_QUOTED = re.compile(r"(\$\w*\$).*?\1", re.DOTALL)
+_LINE_COMMENT = re.compile(r"--[^\n]*")
+_TRANSACTION_CONTROL = re.compile(
+    r"^\s*(BEGIN|START\s+TRANSACTION|COMMIT|END|ROLLBACK|ABORT|PREPARE\s+TRANSACTION)\b",
+    re.IGNORECASE,
+)
+
+_CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migration(
+    version VARCHAR(10) PRIMARY KEY,
+    name TEXT NOT NULL,
+    checksum CHAR(64) NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+
+class MigrationError(Exception):
+    pass
+
+
+def migrations(directory=MIGRATIONS):
+    """The migrations found in `directory`, in version order."""
+
+    found = []
+    for path in sorted(directory.glob("*.sql")):
+        match = _FILE_NAME.match(path.name)
+        if not match:
+            raise MigrationError(f"{path.name} is not named NNNN_description.sql.")
+        text = path.read_text()
+        checksum = hashlib.sha256(text.encode()).hexdigest()
+        found.append(Migration(match[1], match[2], path, text, checksum))
+
+    versions = [int(m.version) for m in found]
+    if len(set(versions)) != len(versions):
+        raise MigrationError("Two migrations share the same version.")
+    return found
+
+
+def applied(conn):
+    """{version: checksum} of the migrations recorded in schema_migration."""
+
+    return dict(conn.execute("SELECT version, checksum FROM schema_migration;").fetchall())
+
+
+def pending(conn, available):
+    """The migrations of `available` not applied yet, checking the applied ones."""
+
+    done = applied(conn)
+    for migration in available:
+        checksum = done.get(migration.version)
+        if checksum is not None and checksum != migration.checksum:
+            raise MigrationError(
+                f"{migration.path.name} was changed after it was applied; "
+                "add a new migration instead, or run --repair if the edit "
+                "needs no new run."
+            )
+    return [m for m in available if m.version not in done]
+
+
+def record(conn, migration):
+    conn.execute(
+        "INSERT INTO schema_migration (version, name, checksum) VALUES (%s, %s, %s);",
+        (migration.version, migration.name, migration.checksum),
+    )
+
+
+def apply(conn, migration):
+    """Run `migration` on the autocommit connection `conn` and record it."""
+
+    indexes = _CONCURRENT_INDEX.findall(migration.sql)
+    if not indexes:
+        # A COMMIT of its own would end the transaction before record(), and
+        # a crash in between would leave the migration applied but not
+        # recorded.
+        control = transaction_control(migration.sql)
+        if control:
+            raise MigrationError(
+                f"{migration.path.name} runs {control.upper()}; the runner owns the transaction."
+            )
+        with conn.transaction():
+            conn.execute(migration.sql)
+            record(conn, migration)
+        return
+
+    # What a failed CREATE INDEX CONCURRENTLY left behind would be skipped
+    # by IF NOT EXISTS, so it is dropped first.
+    invalid = conn.execute(
+        """
+        SELECT c.relname
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid AND c.relname = ANY(%s)
+            AND pg_catalog.pg_table_is_visible(c.oid);
+        """,
+        ([name.lower() for name in indexes],),
+    ).fetchall()
+    for (name,) in invalid:
+        conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}";')
+
+    for statement in _STATEMENT_END.split(migration.sql):
+        if _strip_comments(statement):
+            conn.execute(statement)
+    record(conn, migration)
+
+
+def transaction_control(text):
+    """The first BEGIN, COMMIT, ROLLBACK... statement of `text`, or None.
+
+    Function bodies are skipped: the BEGIN and END of PL/pgSQL are not
+    transaction control.
+    """
+
+    text = _LINE_COMMENT.sub("", _DOLLAR_QUOTED.sub("$$", text))
+    for statement in text.split(";"):
+        match = _TRANSACTION_CONTROL.match(statement)
+        if match:
+            return match[1]
+    return None
+
+
+def _strip_comments(statement):
+    return "\n".join(
+        line for line in statement.splitlines() if not line.strip().startswith("--")
+    ).strip()
+
+
+def migrate(conninfo, log=print):
+    """Apply the pending migrations of web/migrations; return those applied."""
+
+    available = migrations()
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(_CREATE_TABLE)
+        # A session lock, held across the transactions of the migrations. It
+        # is polled rather than waited for: a waiting statement would hold a
+        # snapshot, which the CREATE INDEX CONCURRENTLY of the run holding the
+        # lock waits for.
+        while not conn.execute(
+            "SELECT pg_try_advisory_lock(hashtext('schema_migration'));"
+        ).fetchone()[0]:
+            log("Waiting for another migration run to finish...")
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            todo = pending(conn, available)
+            for migration in todo:
+                log(f"Applying {migration.path.name}...")
+                apply(conn, migration)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(hashtext('schema_migration'));")
+    return todo
+
+
+def baseline(conninfo, version):
+    """Record the migrations up to `version` as applied, without running them."""
+
+    available = migrations()
+    if version not in {int(m.version) for m in available}:
+        raise MigrationError(f"There is no migration {version}.")
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(_CREATE_TABLE)
+        with conn.transaction():
+            for migration in pending(conn, available):
+                if int(migration.version) <= version:
+                    record(conn, migration)
+
+
+def repair(conninfo):
+    """Record the current checksum of the applied migrations that were edited
+    since; return them. Nothing is run: the edit must not need to be."""
+
+    available = migrations()
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(_CREATE_TABLE)
+        done = applied(conn)
+        edited = [m for m in available if done.get(m.version, m.checksum) != m.checksum]
+        with conn.transaction():
+            for migration in edited:
+                conn.execute(
+                    "UPDATE schema_migration SET checksum = %s WHERE version = %s;",
+                    (migration.checksum, migration.version),
+                )
+    return edited
+
+
+def status(conninfo):
+    """(migration, applied_at or None) for every migration."""
+
+    available = migrations()
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(_CREATE_TABLE)
+        pending(conn, available)
+        dates = dict(conn.execute("SELECT version, applied_at FROM schema_migration;").fetchall())
+    return [(m, dates.get(m.version)) for m in available]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the pending schema migrations.")
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--status", action="store_true", help="list the migrations")
+    group.add_argument(
+        "--baseline", type=int, metavar="VERSION",
+        help="record the migrations up to VERSION as applied, without running them",
+    )
+    group.add_argument(
+        "--repair", action="store_true",
+        help="record the checksums of the applied migrations that were edited",
+    )
+    args = parser.parse_args()
+
+    try:
+        if args.status:
+            for migration, applied_at in status(args.database_url):
+                when = applied_at.strftime("%Y-%m-%d %H:%M:%S") if applied_at else "pending"
+                print(f"{migration.path.name:<40}{when}")
+        elif args.baseline is not None:
+            baseline(args.database_url, args.baseline)
+        elif args.repair:
+            for migration in repair(args.database_url):
+                print(f"Recorded the new checksum of {migration.path.name}.")
+        else:
+            applied_now = migrate(args.database_url)
+            print(f"{len(applied_now)} migrations applied.")
+    except MigrationError as e:
+        print(e, file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
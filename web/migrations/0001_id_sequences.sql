@@ -0,0 +1,14 @@
+-- Allocate orders.order_no and customer.cust_no from sequences instead of
+-- scanning the table for its current maximum on every insert. The sequences
+-- are seeded from the existing keys; the tables are locked while seeding so
+-- no insert can slip in between reading the maximum and setting the default.
+
+LOCK TABLE orders, customer IN EXCLUSIVE MODE;
+
+CREATE SEQUENCE IF NOT EXISTS orders_order_no_seq AS INTEGER OWNED BY orders.order_no;
+SELECT setval('orders_order_no_seq', COALESCE(MAX(order_no), 0) + 1, false) FROM orders;
+ALTER TABLE orders ALTER COLUMN order_no SET DEFAULT nextval('orders_order_no_seq');
+
+CREATE SEQUENCE IF NOT EXISTS customer_cust_no_seq AS INTEGER OWNED BY customer.cust_no;
+SELECT setval('customer_cust_no_seq', COALESCE(MAX(cust_no), 0) + 1, false) FROM customer;
+ALTER TABLE customer ALTER COLUMN cust_no SET DEFAULT nextval('customer_cust_no_seq');
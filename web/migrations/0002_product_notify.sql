@@ -0,0 +1,31 @@
+-- Publish every change to the product catalogue on the product_changed
+-- channel so the web workers can evict their cached copies. The payload is
+-- the SKU of the affected row; an empty payload means the table was
+-- truncated. Notifications are only delivered when the transaction commits.
+
+CREATE OR REPLACE FUNCTION notify_product_changed() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('product_changed', '');
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('product_changed', OLD.SKU);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('product_changed', NEW.SKU);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS product_changed_trigger ON product;
+CREATE TRIGGER product_changed_trigger
+AFTER INSERT OR UPDATE OR DELETE ON product
+FOR EACH ROW EXECUTE FUNCTION notify_product_changed();
+
+DROP TRIGGER IF EXISTS product_truncated_trigger ON product;
+CREATE TRIGGER product_truncated_trigger
+AFTER TRUNCATE ON product
+FOR EACH STATEMENT EXECUTE FUNCTION notify_product_changed();
@@ -0,0 +1,85 @@
+-- Keep the totals of every order (number of products, quantity and price)
+-- in order_summary, maintained by triggers on contains and product, so the
+-- views read one row instead of aggregating contains JOIN product. The
+-- table can be recomputed at any time with SELECT rebuild_order_summary();
+-- (or `flask --app app rebuild-order-summary`).
+
+CREATE TABLE IF NOT EXISTS order_summary(
+order_no INTEGER PRIMARY KEY REFERENCES orders,
+total_products INTEGER NOT NULL DEFAULT 0,
+total_qty BIGINT NOT NULL DEFAULT 0,
+total_price NUMERIC(16, 2) NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION order_summary_contains() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE order_summary
+        SET total_products = total_products - 1,
+            total_qty = total_qty - COALESCE(OLD.qty, 0),
+            total_price = total_price - COALESCE(OLD.qty, 0) * (
+                SELECT price FROM product WHERE SKU = OLD.SKU)
+        WHERE order_no = OLD.order_no;
+
+        -- an order without lines has no summary, so it can still be deleted
+        DELETE FROM order_summary
+        WHERE order_no = OLD.order_no AND total_products = 0;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO order_summary
+        SELECT NEW.order_no, 1, COALESCE(NEW.qty, 0), COALESCE(NEW.qty, 0) * price
+        FROM product
+        WHERE SKU = NEW.SKU
+        ON CONFLICT (order_no) DO UPDATE
+        SET total_products = order_summary.total_products + 1,
+            total_qty = order_summary.total_qty + EXCLUDED.total_qty,
+            total_price = order_summary.total_price + EXCLUDED.total_price;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS order_summary_contains_trigger ON contains;
+CREATE TRIGGER order_summary_contains_trigger
+AFTER INSERT OR UPDATE OR DELETE ON contains
+FOR EACH ROW EXECUTE FUNCTION order_summary_contains();
+
+
+CREATE OR REPLACE FUNCTION order_summary_product() RETURNS TRIGGER AS
+$$
+BEGIN
+    UPDATE order_summary s
+    SET total_price = s.total_price + c.qty * (NEW.price - OLD.price)
+    FROM contains c
+    WHERE c.SKU = NEW.SKU AND c.qty IS NOT NULL AND s.order_no = c.order_no;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS order_summary_product_trigger ON product;
+CREATE TRIGGER order_summary_product_trigger
+AFTER UPDATE OF price ON product
+FOR EACH ROW WHEN (OLD.price IS DISTINCT FROM NEW.price)
+EXECUTE FUNCTION order_summary_product();
+
+
+CREATE OR REPLACE FUNCTION rebuild_order_summary() RETURNS VOID AS
+$$
+BEGIN
+    -- keep writers out while the totals are recomputed
+    LOCK TABLE contains, product IN SHARE MODE;
+    LOCK TABLE order_summary IN EXCLUSIVE MODE;
+
+    DELETE FROM order_summary;
+    INSERT INTO order_summary
+    SELECT order_no, COUNT(*), COALESCE(SUM(qty), 0), COALESCE(SUM(qty * price), 0)
+    FROM contains JOIN product USING (SKU)
+    GROUP BY order_no;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_order_summary();
@@ -0,0 +1,66 @@
+-- Count the changes of the tables the views read, so the web app can tell
+-- whether a page changed (ETag / 304) with one indexed lookup instead of
+-- running its query. Every statement that writes to a tracked table adds 1
+-- to one of its 16 slots (picked by backend pid, so concurrent writers
+-- rarely wait on the same row); the version of a table is the sum of its
+-- slots. The counters are updated in the writing transaction, so a new
+-- version is never visible before the rows it stands for.
+
+CREATE TABLE IF NOT EXISTS table_version(
+name VARCHAR(63) NOT NULL,
+slot SMALLINT NOT NULL,
+version BIGINT NOT NULL DEFAULT 0,
+changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+PRIMARY KEY (name, slot)
+);
+
+INSERT INTO table_version (name, slot)
+SELECT name, slot
+FROM unnest(ARRAY['product', 'supplier', 'customer', 'orders', 'contains', 'pay', 'order_summary']) name,
+    generate_series(0, 15) slot
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS TRIGGER AS
+$$
+BEGIN
+    UPDATE table_version
+    SET version = version + 1, changed_at = clock_timestamp()
+    WHERE name = TG_TABLE_NAME AND slot = pg_backend_pid() % 16;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS product_version_trigger ON product;
+CREATE TRIGGER product_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON product
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS supplier_version_trigger ON supplier;
+CREATE TRIGGER supplier_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON supplier
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS customer_version_trigger ON customer;
+CREATE TRIGGER customer_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON customer
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS orders_version_trigger ON orders;
+CREATE TRIGGER orders_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON orders
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS contains_version_trigger ON contains;
+CREATE TRIGGER contains_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON contains
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS pay_version_trigger ON pay;
+CREATE TRIGGER pay_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pay
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS order_summary_version_trigger ON order_summary;
+CREATE TRIGGER order_summary_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON order_summary
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
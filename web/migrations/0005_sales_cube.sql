@@ -0,0 +1,234 @@
+-- Keep the product_sales view pre-aggregated in sales_cube, one row per
+-- product, day and city, so the sales reports read a few rows instead of
+-- joining six tables and parsing every address. The cube is brought up to
+-- date with SELECT refresh_sales_cube(); (run by the job threads of
+-- jobs.py every SALES_CUBE_REFRESH_INTERVAL seconds), which only looks at
+-- what changed since the last refresh:
+--   * orders paid since then, queued in sales_cube_pending, are added to
+--     the totals;
+--   * products whose past sales changed (a new price, a supplier or
+--     delivery added or removed, a paid order or line deleted), marked in
+--     sales_cube_stale, are recomputed from the view.
+-- SELECT rebuild_sales_cube(); recomputes the whole cube (or
+-- `flask --app app rebuild-sales-cube`). Needs PostgreSQL 15 or later.
+
+CREATE TABLE IF NOT EXISTS sales_cube(
+sku VARCHAR(25) NOT NULL,
+year SMALLINT NOT NULL,
+month SMALLINT NOT NULL,
+day_of_month SMALLINT NOT NULL,
+day_of_week SMALLINT NOT NULL,
+city TEXT,
+qty BIGINT NOT NULL,
+total_price NUMERIC(16, 2) NOT NULL,
+UNIQUE NULLS NOT DISTINCT (sku, year, month, day_of_month, city)
+);
+
+CREATE INDEX IF NOT EXISTS sales_cube_year_index ON sales_cube (year);
+
+CREATE TABLE IF NOT EXISTS sales_cube_pending(
+order_no INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS sales_cube_stale(
+sku VARCHAR(25) PRIMARY KEY
+);
+
+
+CREATE OR REPLACE FUNCTION sales_cube_pay() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO sales_cube_stale
+        SELECT SKU FROM contains WHERE order_no = OLD.order_no
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO sales_cube_pending VALUES (NEW.order_no)
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_cube_pay_trigger ON pay;
+CREATE TRIGGER sales_cube_pay_trigger
+AFTER INSERT OR UPDATE OR DELETE ON pay
+FOR EACH ROW EXECUTE FUNCTION sales_cube_pay();
+
+
+-- Lines of unpaid orders are not sales yet; their payment queues them.
+CREATE OR REPLACE FUNCTION sales_cube_contains() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO sales_cube_stale
+        SELECT OLD.SKU WHERE EXISTS (SELECT 1 FROM pay WHERE order_no = OLD.order_no)
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO sales_cube_stale
+        SELECT NEW.SKU WHERE EXISTS (SELECT 1 FROM pay WHERE order_no = NEW.order_no)
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_cube_contains_trigger ON contains;
+CREATE TRIGGER sales_cube_contains_trigger
+AFTER INSERT OR UPDATE OR DELETE ON contains
+FOR EACH ROW EXECUTE FUNCTION sales_cube_contains();
+
+
+CREATE OR REPLACE FUNCTION sales_cube_orders() RETURNS TRIGGER AS
+$$
+BEGIN
+    INSERT INTO sales_cube_stale
+    SELECT c.SKU
+    FROM contains c JOIN pay USING (order_no)
+    WHERE c.order_no = NEW.order_no
+    ON CONFLICT DO NOTHING;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_cube_orders_trigger ON orders;
+CREATE TRIGGER sales_cube_orders_trigger
+AFTER UPDATE OF date ON orders
+FOR EACH ROW WHEN (OLD.date IS DISTINCT FROM NEW.date)
+EXECUTE FUNCTION sales_cube_orders();
+
+
+-- The view prices every past sale at the current price of the product.
+CREATE OR REPLACE FUNCTION sales_cube_product() RETURNS TRIGGER AS
+$$
+BEGIN
+    INSERT INTO sales_cube_stale VALUES (NEW.SKU)
+    ON CONFLICT DO NOTHING;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_cube_product_trigger ON product;
+CREATE TRIGGER sales_cube_product_trigger
+AFTER UPDATE OF price ON product
+FOR EACH ROW WHEN (OLD.price IS DISTINCT FROM NEW.price)
+EXECUTE FUNCTION sales_cube_product();
+
+
+-- Every sale is counted once per city its product is delivered to.
+CREATE OR REPLACE FUNCTION sales_cube_supplier() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.SKU IS NOT NULL THEN
+        INSERT INTO sales_cube_stale VALUES (OLD.SKU)
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.SKU IS NOT NULL THEN
+        INSERT INTO sales_cube_stale VALUES (NEW.SKU)
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_cube_supplier_trigger ON supplier;
+CREATE TRIGGER sales_cube_supplier_trigger
+AFTER INSERT OR DELETE OR UPDATE OF TIN, SKU ON supplier
+FOR EACH ROW EXECUTE FUNCTION sales_cube_supplier();
+
+
+CREATE OR REPLACE FUNCTION sales_cube_delivery() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO sales_cube_stale
+        SELECT SKU FROM supplier WHERE TIN = OLD.TIN AND SKU IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO sales_cube_stale
+        SELECT SKU FROM supplier WHERE TIN = NEW.TIN AND SKU IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sales_cube_delivery_trigger ON delivery;
+CREATE TRIGGER sales_cube_delivery_trigger
+AFTER INSERT OR UPDATE OR DELETE ON delivery
+FOR EACH ROW EXECUTE FUNCTION sales_cube_delivery();
+
+
+CREATE OR REPLACE FUNCTION refresh_sales_cube() RETURNS INTEGER AS
+$$
+DECLARE
+    stale VARCHAR(25)[];
+    paid INTEGER[];
+BEGIN
+    -- one refresh at a time; whoever finds one running leaves it the work
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_sales_cube')) THEN
+        RETURN 0;
+    END IF;
+
+    WITH drained AS (DELETE FROM sales_cube_stale RETURNING sku)
+    SELECT COALESCE(array_agg(sku), '{}') INTO stale FROM drained;
+    WITH drained AS (DELETE FROM sales_cube_pending RETURNING order_no)
+    SELECT COALESCE(array_agg(order_no), '{}') INTO paid FROM drained;
+
+    -- orders paid after the queue was drained are left for the next refresh
+    DELETE FROM sales_cube WHERE sku = ANY(stale);
+    INSERT INTO sales_cube
+    SELECT sku, year, month, day_of_month, day_of_week, city,
+        COALESCE(SUM(qty), 0), COALESCE(SUM(total_price), 0)
+    FROM product_sales
+    WHERE sku = ANY(stale)
+        AND order_no NOT IN (SELECT order_no FROM sales_cube_pending)
+    GROUP BY sku, year, month, day_of_month, day_of_week, city;
+
+    INSERT INTO sales_cube
+    SELECT sku, year, month, day_of_month, day_of_week, city,
+        COALESCE(SUM(qty), 0), COALESCE(SUM(total_price), 0)
+    FROM product_sales
+    WHERE order_no = ANY(paid) AND sku <> ALL(stale)
+    GROUP BY sku, year, month, day_of_month, day_of_week, city
+    ON CONFLICT (sku, year, month, day_of_month, city) DO UPDATE
+    SET qty = sales_cube.qty + EXCLUDED.qty,
+        total_price = sales_cube.total_price + EXCLUDED.total_price;
+
+    RETURN cardinality(stale) + cardinality(paid);
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION rebuild_sales_cube() RETURNS VOID AS
+$$
+BEGIN
+    -- keep writers and refreshes out while the cube is recomputed
+    LOCK TABLE product, contains, orders, supplier, delivery, pay IN SHARE MODE;
+    PERFORM pg_advisory_xact_lock(hashtext('refresh_sales_cube'));
+
+    DELETE FROM sales_cube_stale;
+    DELETE FROM sales_cube_pending;
+    DELETE FROM sales_cube;
+    INSERT INTO sales_cube
+    SELECT sku, year, month, day_of_month, day_of_week, city,
+        COALESCE(SUM(qty), 0), COALESCE(SUM(total_price), 0)
+    FROM product_sales
+    GROUP BY sku, year, month, day_of_month, day_of_week, city;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_sales_cube();
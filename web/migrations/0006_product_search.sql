@@ -0,0 +1,20 @@
+-- Indexes behind /products/search, so finding a product never scans the
+-- whole table:
+--   * the text_pattern_ops btree serves prefix matches on the name (LIKE
+--     'A%', as in E3 6.2, or the equivalent ~>=~ / ~<~ range the app sends),
+--     whatever the collation of the database;
+--   * the pg_trgm GIN indexes serve case-insensitive substring matches
+--     (ILIKE '%ham%') on the name and the description;
+--   * SKU and EAN lookups use the primary key and the EAN unique index.
+-- Built CONCURRENTLY (see migrate.py), so product stays writable meanwhile.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_name_pattern_index
+ON product (name text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_name_trgm_index
+ON product USING GIN (name gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_description_trgm_index
+ON product USING GIN (description gin_trgm_ops);
@@ -0,0 +1,28 @@
+-- Queue of the background jobs run by web/jobs.py: the customer and product
+-- deletes, which may touch tens of thousands of rows, and the CSV imports.
+-- Workers claim the oldest runnable job with SELECT ... FOR UPDATE SKIP
+-- LOCKED, so they never wait on each other nor take the same job. A running
+-- job whose heartbeat_at is too old lost its worker and is claimed again.
+
+CREATE TABLE IF NOT EXISTS job(
+id BIGSERIAL PRIMARY KEY,
+kind VARCHAR(40) NOT NULL,
+title TEXT NOT NULL,
+params JSONB NOT NULL DEFAULT '{}',
+data BYTEA,
+state VARCHAR(10) NOT NULL DEFAULT 'queued'
+    CHECK (state IN ('queued', 'running', 'done', 'failed')),
+progress BIGINT NOT NULL DEFAULT 0,
+total BIGINT,
+result JSONB,
+error TEXT,
+attempts INTEGER NOT NULL DEFAULT 0,
+created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+started_at TIMESTAMPTZ,
+heartbeat_at TIMESTAMPTZ,
+finished_at TIMESTAMPTZ
+);
+
+-- Finished jobs are kept for their status page but never scanned by workers.
+CREATE INDEX IF NOT EXISTS job_runnable_index
+ON job (id) WHERE state IN ('queued', 'running');
@@ -0,0 +1,20 @@
+-- Plans of the slow statements sampled by web/plans.py (PLAN_CAPTURE_SECONDS),
+-- shown at /admin/plans and by `flask --app app plans`. `params` holds the
+-- names and types of the parameters, never their values; `scans` lists how
+-- each table was read (e.g. "Index Scan using product_pkey on product"),
+-- which is what the report compares between two captures of a query.
+
+CREATE TABLE IF NOT EXISTS query_plan(
+id BIGSERIAL PRIMARY KEY,
+query_name TEXT NOT NULL,
+route TEXT,
+params JSONB NOT NULL,
+seconds DOUBLE PRECISION NOT NULL,
+analyzed BOOLEAN NOT NULL,
+explain_seconds DOUBLE PRECISION,
+scans TEXT[] NOT NULL,
+plan JSONB NOT NULL,
+captured_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS query_plan_query_index ON query_plan (query_name, id);
@@ -0,0 +1,36 @@
+-- Indexes behind the filters of the write paths, which otherwise scan the
+-- whole table. Built CONCURRENTLY (see migrate.py), so the tables stay
+-- writable meanwhile:
+--   * supplier.SKU: detaching the suppliers of a deleted product, and the
+--     sales_cube triggers of migration 0005;
+--   * delivery.TIN: deleting a supplier's deliveries (the primary key is
+--     (address, TIN), which does not help a lookup by TIN);
+--   * orders (cust_no, order_no): the chunks of a customer delete and the
+--     latest orders of the customer page, in order_no order;
+--   * pay.cust_no: the payments left when a customer is deleted;
+--   * contains.SKU: the chunks of a product delete and the lines of the
+--     products whose sales_cube rows are recomputed;
+--   * orders.date and product.price: the filters of E3 6.1, and the date
+--     range of the exports (?date_from=, ?date_to=).
+-- product.ean already has the index of its UNIQUE constraint.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS supplier_sku_index
+ON supplier (SKU);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS delivery_tin_index
+ON delivery (TIN);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_cust_no_index
+ON orders (cust_no, order_no);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pay_cust_no_index
+ON pay (cust_no);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS contains_sku_index
+ON contains (SKU);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_date_index
+ON orders (date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_price_index
+ON product (price);
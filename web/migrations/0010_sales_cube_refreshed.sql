@@ -0,0 +1,77 @@
+-- sales_cube is refreshed by the job workers of web/jobs.py every
+-- SALES_CUBE_REFRESH_INTERVAL seconds (or `flask --app app refresh-sales-cube`
+-- from cron), no longer by /reports/sales, which only reads it. The report
+-- shows when the cube was last refreshed: sales_cube_refresh holds that time,
+-- set by refresh_sales_cube() and rebuild_sales_cube() below, which are those
+-- of migration 0005 plus that update.
+
+CREATE TABLE IF NOT EXISTS sales_cube_refresh(
+id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+refreshed_at TIMESTAMPTZ NOT NULL
+);
+
+INSERT INTO sales_cube_refresh (refreshed_at) VALUES (now())
+ON CONFLICT DO NOTHING;
+
+
+CREATE OR REPLACE FUNCTION refresh_sales_cube() RETURNS INTEGER AS
+$$
+DECLARE
+    stale VARCHAR(25)[];
+    paid INTEGER[];
+BEGIN
+    -- one refresh at a time; whoever finds one running leaves it the work
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_sales_cube')) THEN
+        RETURN 0;
+    END IF;
+
+    UPDATE sales_cube_refresh SET refreshed_at = now();
+
+    WITH drained AS (DELETE FROM sales_cube_stale RETURNING sku)
+    SELECT COALESCE(array_agg(sku), '{}') INTO stale FROM drained;
+    WITH drained AS (DELETE FROM sales_cube_pending RETURNING order_no)
+    SELECT COALESCE(array_agg(order_no), '{}') INTO paid FROM drained;
+
+    -- orders paid after the queue was drained are left for the next refresh
+    DELETE FROM sales_cube WHERE sku = ANY(stale);
+    INSERT INTO sales_cube
+    SELECT sku, year, month, day_of_month, day_of_week, city,
+        COALESCE(SUM(qty), 0), COALESCE(SUM(total_price), 0)
+    FROM product_sales
+    WHERE sku = ANY(stale)
+        AND order_no NOT IN (SELECT order_no FROM sales_cube_pending)
+    GROUP BY sku, year, month, day_of_month, day_of_week, city;
+
+    INSERT INTO sales_cube
+    SELECT sku, year, month, day_of_month, day_of_week, city,
+        COALESCE(SUM(qty), 0), COALESCE(SUM(total_price), 0)
+    FROM product_sales
+    WHERE order_no = ANY(paid) AND sku <> ALL(stale)
+    GROUP BY sku, year, month, day_of_month, day_of_week, city
+    ON CONFLICT (sku, year, month, day_of_month, city) DO UPDATE
+    SET qty = sales_cube.qty + EXCLUDED.qty,
+        total_price = sales_cube.total_price + EXCLUDED.total_price;
+
+    RETURN cardinality(stale) + cardinality(paid);
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION rebuild_sales_cube() RETURNS VOID AS
+$$
+BEGIN
+    -- keep writers and refreshes out while the cube is recomputed
+    LOCK TABLE product, contains, orders, supplier, delivery, pay IN SHARE MODE;
+    PERFORM pg_advisory_xact_lock(hashtext('refresh_sales_cube'));
+
+    UPDATE sales_cube_refresh SET refreshed_at = now();
+    DELETE FROM sales_cube_stale;
+    DELETE FROM sales_cube_pending;
+    DELETE FROM sales_cube;
+    INSERT INTO sales_cube
+    SELECT sku, year, month, day_of_month, day_of_week, city,
+        COALESCE(SUM(qty), 0), COALESCE(SUM(total_price), 0)
+    FROM product_sales
+    GROUP BY sku, year, month, day_of_month, day_of_week, city;
+END;
+$$ LANGUAGE plpgsql;
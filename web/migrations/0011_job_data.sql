@@ -0,0 +1,20 @@
+-- The files uploaded for import jobs, in parts of UPLOAD_PART_SIZE bytes
+-- (web/importer.py) instead of one job.data value: the views write the upload
+-- part by part as they read it, and the job streams the parts back into
+-- COPY, so neither holds the whole file in memory and the 1 GB limit of a
+-- BYTEA value no longer caps the file. The parts go once the job is over.
+
+CREATE TABLE IF NOT EXISTS job_data(
+job_id BIGINT NOT NULL REFERENCES job (id) ON DELETE CASCADE,
+part INTEGER NOT NULL,
+data BYTEA NOT NULL,
+PRIMARY KEY (job_id, part)
+);
+
+-- Files of the jobs queued before this migration become their only part.
+INSERT INTO job_data (job_id, part, data)
+SELECT id, 0, data FROM job
+WHERE data IS NOT NULL AND state IN ('queued', 'running')
+ON CONFLICT DO NOTHING;
+
+ALTER TABLE job DROP COLUMN IF EXISTS data;
@@ -0,0 +1,169 @@
+"""Capture the plans of slow statements; opt-in with PLAN_CAPTURE_SECONDS.
+
+queries.run() and run_async() hand every registered statement slower than
+PLAN_CAPTURE_SECONDS to sample(), which keeps PLAN_CAPTURE_SAMPLE of them.
+A thread of the worker re-runs the kept statements under EXPLAIN on a
+connection of its own, in a transaction it always rolls back: with ANALYZE
+and BUFFERS when the statement can run in a read-only transaction, without
+them otherwise, so a write is never executed twice. The request is never
+kept waiting; statements arriving while PLAN_CAPTURE_QUEUE are waiting are
+dropped.
+
+Each plan is stored in query_plan (migrations/0008_query_plans.sql) with
+the route, the query name and the shape of the parameters (their names and
+types, never their values), and the list of its scans. /admin/plans and
+`flask --app app plans` group the plans by query and flag the queries whose
+latest plan reads a table differently from the one before.
+"""
+import logging
+import os
+import queue
+import random
+import threading
+
+import psycopg
+from psycopg import sql
+from psycopg.types.json import Jsonb
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+# postgres://{user}:{password}@{hostname}:{port}/{database-name}
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgres://db:db@postgres/db")
+
+# Statements slower than this many seconds may have their plan captured
+# (default unset: no capture).
+PLAN_CAPTURE_SECONDS = float(os.environ.get("PLAN_CAPTURE_SECONDS") or "inf")
+# Fraction of the slow statements whose plan is captured.
+PLAN_CAPTURE_SAMPLE = float(os.environ.get("PLAN_CAPTURE_SAMPLE", 0.1))
+# Statements waiting for their EXPLAIN, per worker.
+PLAN_CAPTURE_QUEUE = int(os.environ.get("PLAN_CAPTURE_QUEUE", 100))
+# Seconds an EXPLAIN ANALYZE may run before it is cancelled.
+PLAN_CAPTURE_TIMEOUT = float(os.environ.get("PLAN_CAPTURE_TIMEOUT", 30))
+# Captures kept per query.
+PLAN_CAPTURE_KEEP = int(os.environ.get("PLAN_CAPTURE_KEEP", 50))
+
+_queue = queue.Queue(PLAN_CAPTURE_QUEUE)
+_lock = threading.Lock()
+_capturer_pid = None
+
+
+def sample(query, params, statement, seconds):
+    """Queue the statement for an EXPLAIN if it is slow and sampled."""
+
+    if seconds < PLAN_CAPTURE_SECONDS or random.random() >= PLAN_CAPTURE_SAMPLE:
+        return
+    _ensure_capturer()
+    try:
+        _queue.put_nowait((query, params, statement, seconds, metrics.current_route()))
+    except queue.Full:
+        log.debug(f"Plan of {query.name} dropped, the capture queue is full.")
+
+
+def shape(params):
+    """The names and types of the parameters, e.g. {"sku": "str"}."""
+
+    shapes = {}
+    for name, value in (params or {}).items():
+        kind = type(value).__name__
+        if isinstance(value, (list, tuple)) and value:
+            kind = f"{kind}[{type(value[0]).__name__}]"
+        shapes[name] = kind
+    return shapes
+
+
+def scans(plan):
+    """How each table or index is read in `plan`, in plan order.
+
+    e.g. ["Index Scan using product_pkey on product", "Seq Scan on contains"]
+    """
+
+    found = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop(0)
+        if "Scan" in node["Node Type"]:
+            scan = node["Node Type"]
+            if "Index Name" in node:
+                scan += f" using {node['Index Name']}"
+            if "Relation Name" in node:
+                scan += f" on {node['Relation Name']}"
+            found.append(scan)
+        nodes.extend(node.get("Plans", ()))
+    return found
+
+
+def explain(conn, statement, params):
+    """EXPLAIN the statement on `conn` and return (analyzed, the JSON plan).
+
+    The statement runs in a transaction that is rolled back, read-only when
+    analyzed, so whatever it would change is left untouched.
+    """
+
+    text = statement if isinstance(statement, str) else statement.as_string(conn)
+    timeout = sql.SQL("SET LOCAL statement_timeout = {}").format(
+        int(PLAN_CAPTURE_TIMEOUT * 1000)
+    )
+    try:
+        with conn.transaction(force_rollback=True):
+            conn.execute("SET TRANSACTION READ ONLY")
+            conn.execute(timeout)
+            rows = conn.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {text}", params)
+            return True, rows.fetchone()[0][0]
+    except psycopg.errors.ReadOnlySqlTransaction:
+        pass
+    with conn.transaction(force_rollback=True):
+        conn.execute(timeout)
+        rows = conn.execute(f"EXPLAIN (FORMAT JSON) {text}", params)
+        return False, rows.fetchone()[0][0]
+
+
+def _ensure_capturer():
+    # Threads do not survive fork, so every worker starts its own.
+    global _capturer_pid
+    if _capturer_pid == os.getpid():
+        return
+    with _lock:
+        if _capturer_pid == os.getpid():
+            return
+        _capturer_pid = os.getpid()
+        threading.Thread(target=_capture, name="plan-capture", daemon=True).start()
+
+
+def _capture():
+    # queries imports this module.
+    from queries import PLAN_INSERT
+    from queries import PLAN_PRUNE
+
+    conn = None
+    while True:
+        query, params, statement, seconds, route = _queue.get()
+        try:
+            if conn is None or conn.closed:
+                conn = psycopg.connect(DATABASE_URL, autocommit=True)
+            analyzed, plan = explain(conn, statement or query.sql, params)
+            with conn.transaction():
+                conn.execute(
+                    PLAN_INSERT.sql,
+                    {
+                        "query_name": query.name,
+                        "route": route,
+                        "params": Jsonb(shape(params)),
+                        "seconds": seconds,
+                        "analyzed": analyzed,
+                        "explain_seconds": plan["Execution Time"] / 1000 if analyzed else None,
+                        "scans": scans(plan["Plan"]),
+                        "plan": Jsonb(plan),
+                    },
+                )
+                conn.execute(PLAN_PRUNE.sql, {"query_name": query.name, "keep": PLAN_CAPTURE_KEEP})
+        except Exception:
+            # Whatever went wrong, the thread must outlive it: it is the only
+            # one of this worker. The connection is dropped, as it may be
+            # left in any state.
+            log.exception(f"Could not capture the plan of {query.name}.")
+            if conn is not None:
+                conn.close()
+                conn = None
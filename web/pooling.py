@@ -0,0 +1,190 @@
+"""Connection pool settings and the per-worker pool of the WSGI app.
+
+The pool is sized and tuned from the environment. Nothing connects at import
+time: each worker process opens its own pool the first time it needs a
+connection, so the app can be imported (by app.cgi, the flask CLI, a
+pre-forking server) while the database is down, and no pool is shared across
+fork().
+
+A request that cannot get a connection within POOL_TIMEOUT seconds, or that
+finds POOL_MAX_WAITING requests already queued, gets a PoolTimeout or
+TooManyRequests, which the apps turn into a 503 (see SHED_ERRORS).
+
+With DATABASE_READ_URL set, the GET requests of READ_ROUTES read from a
+second pool on a replica, as long as its lag stays under REPLICA_MAX_LAG.
+Everything else, and every request from a browser that wrote in the last
+REPLICA_MAX_LAG seconds (so it reads its own writes), stays on the primary.
+"""
+import logging
+import os
+import threading
+import time
+
+from psycopg_pool import AsyncConnectionPool
+from psycopg_pool import ConnectionPool
+from psycopg_pool import PoolTimeout
+from psycopg_pool import TooManyRequests
+
+
+# Connections kept open, and the most opened at once, per worker.
+POOL_MIN_SIZE = int(os.environ.get("POOL_MIN_SIZE", 2))
+POOL_MAX_SIZE = int(os.environ.get("POOL_MAX_SIZE", 10))
+# Seconds a request waits for a connection before it is shed.
+POOL_TIMEOUT = float(os.environ.get("POOL_TIMEOUT", 5))
+# Requests queued for a connection beyond which new ones are shed at once
+# (0 means no limit).
+POOL_MAX_WAITING = int(os.environ.get("POOL_MAX_WAITING", 0))
+# Seconds after which an idle connection above the minimum is closed, and
+# after which any connection is replaced.
+POOL_MAX_IDLE = float(os.environ.get("POOL_MAX_IDLE", 600))
+POOL_MAX_LIFETIME = float(os.environ.get("POOL_MAX_LIFETIME", 3600))
+# 1 to check every connection with a round trip before handing it out.
+POOL_CHECK = os.environ.get("POOL_CHECK", "0") != "0"
+
+# Seconds the readiness check waits for a connection.
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", 1))
+
+# Seconds the Retry-After header of a shed request asks the client to wait.
+RETRY_AFTER = 1
+
+# Connection string of a read replica; unset, everything reads the primary.
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+# Seconds of replication lag beyond which reads go back to the primary, and
+# seconds between two measurements of the lag.
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", 1))
+
+# Routes whose GET only reads and may be a little behind the primary.
+READ_ROUTES = {
+    "product_index",
+    "product_search",
+    "product_update",
+    "supplier_index",
+    "supplier_info",
+    "customer_index",
+    "customer_info",
+    "orders_index",
+    "order_info",
+    "pay_order",
+    "export",
+    "sales_dashboard",
+}
+
+# Session key holding when the browser last wrote.
+WROTE_AT = "wrote_at"
+
+# What a request gets when the pool is saturated.
+SHED_ERRORS = (PoolTimeout, TooManyRequests)
+
+POOL_OPTIONS = {
+    "min_size": POOL_MIN_SIZE,
+    "max_size": max(POOL_MIN_SIZE, POOL_MAX_SIZE),
+    "timeout": POOL_TIMEOUT,
+    "max_waiting": POOL_MAX_WAITING,
+    "max_idle": POOL_MAX_IDLE,
+    "max_lifetime": POOL_MAX_LIFETIME,
+}
+
+
+log = logging.getLogger(__name__)
+
+
+def reads_replica(method, endpoint, wrote_at):
+    """Whether a request may read from the replica."""
+
+    return (
+        DATABASE_READ_URL is not None
+        and method == "GET"
+        and endpoint in READ_ROUTES
+        and time.time() - (wrote_at or 0) > REPLICA_MAX_LAG
+    )
+
+
+class ReplicaLag:
+    """The last measured lag of the replica, shared by a worker's requests."""
+
+    def __init__(self):
+        self.lag = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def fresh(self):
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG
+
+    def due(self):
+        """Whether the lag should be measured again; only one caller is told so."""
+
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < REPLICA_CHECK_INTERVAL:
+                return False
+            self._checked = now
+            return True
+
+    def record(self, lag):
+        """Record the measured lag in seconds, or None if it couldn't be measured."""
+
+        was_fresh = self.fresh
+        self.lag = lag
+        if was_fresh and not self.fresh:
+            log.warning(f"Replica lag is {lag}s, reading from the primary.")
+        elif self.fresh and not was_fresh:
+            log.info(f"Replica lag is {lag}s, reading from the replica.")
+
+
+def connection_pool(conninfo):
+    """A ConnectionPool with the configured settings, not yet opened."""
+
+    check = ConnectionPool.check_connection if POOL_CHECK else None
+    return ConnectionPool(conninfo, open=False, check=check, **POOL_OPTIONS)
+
+
+def async_connection_pool(conninfo):
+    """An AsyncConnectionPool with the configured settings, not yet opened."""
+
+    check = AsyncConnectionPool.check_connection if POOL_CHECK else None
+    return AsyncConnectionPool(conninfo, open=False, check=check, **POOL_OPTIONS)
+
+
+class WorkerPool:
+    """A ConnectionPool opened lazily, once per process."""
+
+    def __init__(self, conninfo):
+        self.conninfo = conninfo
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def opened(self):
+        return self._pid == os.getpid()
+
+    def _get(self):
+        # A pool inherited through fork() has no worker threads left, so
+        # every process opens its own.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = connection_pool(self.conninfo)
+                    self._pool.open(wait=False)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def open(self):
+        """Open this process's pool now rather than on first use."""
+
+        self._get()
+
+    def connection(self, timeout=None):
+        return self._get().connection(timeout=timeout)
+
+    def get_stats(self):
+        """The pool's counters, or {} before this process opened it."""
+
+        return self._pool.get_stats() if self.opened else {}
+
+    def close(self):
+        if self.opened:
+            self._pool.close()
+            self._pid = None
@@ -0,0 +1,996 @@
+"""Registry of the SQL run by the WSGI app, the ASGI app and the JSON API.
+
+Every statement is registered once by name with query() and executed with
+run() (or run_async()), which prepares it on the connection the first time
+it runs there, records it in metrics.py and hands it to plans.py, which may
+capture its plan if it was slow. Pooled connections live for the whole life
+of a worker, so the hot lookups are parsed and planned once per connection
+instead of once per request.
+
+This module never opens a connection, so it can be imported by either kind
+of pool.
+"""
+import os
+import time
+from collections import namedtuple
+
+import psycopg
+from psycopg import sql
+
+import metrics
+import plans
+
+
+# Rows shown per listing page; clients may ask for fewer/more with ?size=.
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 500))
+# Server-side prepared statements; turn off (0) behind a connection pooler
+# in transaction mode, which cannot keep them.
+PREPARE_STATEMENTS = os.environ.get("PREPARE_STATEMENTS", "1") != "0"
+
+
+Query = namedtuple("Query", ["name", "sql"])
+
+QUERIES = {}
+
+
+def query(name, text):
+    """Register the statement `text` under `name` and return it."""
+
+    if name in QUERIES:
+        raise ValueError(f"Query {name} is already registered.")
+    QUERIES[name] = Query(name, text)
+    return QUERIES[name]
+
+
+def run(cur, query, params=None, statement=None):
+    """Execute the registered `query` on `cur` and return the cursor.
+
+    `statement` overrides the SQL actually sent, for statements composed
+    from the registered text (listing pages); it is recorded under the
+    query name.
+    """
+
+    start = time.perf_counter()
+    cur.execute(statement or query.sql, params, prepare=PREPARE_STATEMENTS)
+    seconds = time.perf_counter() - start
+    metrics.query_done(query.name, seconds, cur.rowcount)
+    plans.sample(query, params, statement, seconds)
+    return cur
+
+
+async def run_async(cur, query, params=None, statement=None):
+    """Like run(), on an async cursor."""
+
+    start = time.perf_counter()
+    await cur.execute(statement or query.sql, params, prepare=PREPARE_STATEMENTS)
+    seconds = time.perf_counter() - start
+    metrics.query_done(query.name, seconds, cur.rowcount)
+    plans.sample(query, params, statement, seconds)
+    return cur
+
+
+# Listings take `{where}` and `{order}` placeholders, see keyset().
+
+PRODUCT_LISTING = query(
+    "product_listing",
+    """
+    SELECT SKU, name, description, price, COALESCE(EAN, 0)
+    FROM product
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+SUPPLIER_LISTING = query(
+    "supplier_listing",
+    """
+    SELECT TIN, name, address, SKU
+    FROM supplier
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+CUSTOMER_LISTING = query(
+    "customer_listing",
+    """
+    SELECT cust_no, name, email, phone, address
+    FROM customer
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+ORDER_LISTING = query(
+    "order_listing",
+    """
+    SELECT order_no, cust_no, date, total_products, total_price
+    FROM orders LEFT JOIN order_summary USING (order_no)
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+# Takes the parameters of forms.product_search(); each condition has its own
+# index (migrations/0006_product_search.sql). The name prefix is matched as
+# a range rather than LIKE 'text%' so that the generic plan of the prepared
+# statement can use the index as well.
+PRODUCT_SEARCH = query(
+    "product_search",
+    """
+    SELECT SKU, name, description, price, COALESCE(EAN, 0)
+    FROM (
+        SELECT * FROM product
+        WHERE SKU = %(sku)s
+            OR EAN = %(ean)s
+            OR (name ~>=~ %(prefix)s AND name ~<~ %(prefix_end)s)
+            OR name ILIKE %(pattern)s
+            OR description ILIKE %(pattern)s
+    ) product
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+
+# Products
+
+PRODUCT_BY_SKU = query(
+    "product_by_sku",
+    """
+    SELECT SKU, name, description, price, ean
+    FROM product
+    WHERE SKU = %(sku)s;
+    """,
+)
+
+PRODUCT_INSERT = query(
+    "product_insert",
+    """
+    INSERT INTO product VALUES (%(SKU)s, %(name)s, %(desc)s,
+        %(price)s, %(EAN)s);
+    """,
+)
+
+PRODUCT_UPDATE = query(
+    "product_update",
+    """
+    UPDATE product
+    SET price = COALESCE(%(price)s, price), description = %(desc)s
+    WHERE SKU = %(product_sku)s;
+    """,
+)
+
+PRODUCT_DELETE = (
+    query(
+        "product_delete_suppliers",
+        """
+        UPDATE supplier SET SKU = NULL
+        WHERE SKU = %(product_sku)s;
+        """,
+    ),
+    query(
+        "product_delete_lines",
+        """
+        DELETE FROM contains
+        WHERE SKU = %(product_sku)s;
+        """,
+    ),
+    query(
+        "product_delete",
+        """
+        DELETE FROM product
+        WHERE SKU = %(product_sku)s;
+        """,
+    ),
+)
+
+
+# Suppliers
+
+SUPPLIER_BY_TIN = query(
+    "supplier_by_tin",
+    """
+    SELECT TIN, name, address, SKU, date
+    FROM supplier
+    WHERE TIN = %(tin)s;
+    """,
+)
+
+SUPPLIER_INSERT = query(
+    "supplier_insert",
+    """
+    INSERT INTO supplier VALUES (%(TIN)s, %(name)s, %(address)s,
+        %(SKU)s, %(date)s);
+    """,
+)
+
+SUPPLIER_DELETE = (
+    query(
+        "supplier_delete_deliveries",
+        """
+        DELETE FROM delivery
+        WHERE TIN = %(supplier_tin)s;
+        """,
+    ),
+    query(
+        "supplier_delete",
+        """
+        DELETE FROM supplier
+        WHERE TIN = %(supplier_tin)s;
+        """,
+    ),
+)
+
+
+# Customers
+
+CUSTOMER_BY_NO = query(
+    "customer_by_no",
+    """
+    SELECT cust_no, name, email, phone, address
+    FROM customer
+    WHERE cust_no = %(cust_no)s;
+    """,
+)
+
+CUSTOMER_LATEST_ORDERS = query(
+    "customer_latest_orders",
+    """
+    SELECT order_no, date, total_products, total_price
+    FROM orders LEFT JOIN order_summary USING (order_no)
+    WHERE cust_no = %(cust_no)s
+    ORDER BY order_no DESC
+    LIMIT %(limit)s;
+    """,
+)
+
+CUSTOMER_INSERT = query(
+    "customer_insert",
+    """
+    INSERT INTO customer (name, email, phone, address)
+    VALUES (%(name)s, %(email)s, %(phone)s, %(address)s);
+    """,
+)
+
+CUSTOMER_DELETE = (
+    query(
+        "customer_delete_processes",
+        """
+        DELETE FROM process
+        WHERE order_no IN (
+            SELECT order_no FROM orders
+            WHERE cust_no = %(cust_no)s);
+        """,
+    ),
+    query(
+        "customer_delete_lines",
+        """
+        DELETE FROM contains
+        WHERE order_no IN (
+            SELECT order_no FROM orders
+            WHERE cust_no = %(cust_no)s);
+        """,
+    ),
+    query(
+        "customer_delete_payments",
+        """
+        DELETE FROM pay
+        WHERE cust_no = %(cust_no)s;
+        """,
+    ),
+    query(
+        "customer_delete_orders",
+        """
+        DELETE FROM orders
+        WHERE cust_no = %(cust_no)s;
+        """,
+    ),
+    query(
+        "customer_delete",
+        """
+        DELETE FROM customer
+        WHERE cust_no = %(cust_no)s;
+        """,
+    ),
+)
+
+
+# Orders
+
+ORDER_BY_NO = query(
+    "order_by_no",
+    """
+    SELECT order_no, cust_no, date
+    FROM orders
+    WHERE order_no = %(order_no)s;
+    """,
+)
+
+ORDER_LINES = query(
+    "order_lines",
+    """
+    SELECT order_no, SKU, qty, name
+    FROM contains JOIN product USING (SKU)
+    WHERE order_no = %(order_no)s;
+    """,
+)
+
+ORDER_PAYED = query(
+    "order_payed",
+    """
+    SELECT COUNT(*) as payed
+    FROM pay
+    WHERE order_no = %(order_no)s;
+    """,
+)
+
+ORDER_TOTALS = query(
+    "order_totals",
+    """
+    SELECT total_products, total_qty, total_price
+    FROM order_summary
+    WHERE order_no = %(order_no)s;
+    """,
+)
+
+ORDER_PLACE = query(
+    "order_place",
+    """
+    WITH new_order AS (
+        INSERT INTO orders (cust_no, date)
+        VALUES (%(cust_no)s, %(date)s)
+        RETURNING order_no
+    )
+    INSERT INTO contains
+    SELECT order_no, %(sku)s, %(qty)s FROM new_order;
+    """,
+)
+
+# Adds the line, or its quantity to an existing one, unless the order is paid.
+ORDER_ADD_PRODUCT = query(
+    "order_add_product",
+    """
+    INSERT INTO contains
+    SELECT %(order_no)s::integer, %(sku)s, %(qty)s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM pay
+        WHERE order_no = %(order_no)s)
+    ON CONFLICT (order_no, SKU)
+    DO UPDATE SET qty = contains.qty + EXCLUDED.qty
+    RETURNING order_no;
+    """,
+)
+
+# Only inserts when the paying customer is the one who placed the order.
+ORDER_PAY = query(
+    "order_pay",
+    """
+    INSERT INTO pay
+    SELECT order_no, cust_no FROM orders
+    WHERE order_no = %(order_no)s AND cust_no = %(cust_no)s
+    RETURNING order_no;
+    """,
+)
+
+
+# JSON API
+
+API_PRODUCT_LISTING = query(
+    "api_product_listing",
+    """
+    SELECT SKU, name, description, price, ean
+    FROM product
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+API_PRODUCTS = query(
+    "api_products",
+    """
+    SELECT SKU, name, description, price, ean
+    FROM product
+    WHERE SKU = ANY(%(skus)s);
+    """,
+)
+
+API_PRODUCTS_CREATE = query(
+    "api_products_create",
+    """
+    INSERT INTO product (SKU, name, description, price, ean)
+    SELECT sku, name, description, price, ean
+    FROM jsonb_to_recordset(%(items)s)
+        AS r(sku VARCHAR, name VARCHAR, description VARCHAR, price NUMERIC, ean NUMERIC)
+    RETURNING SKU;
+    """,
+)
+
+API_PRODUCT_UPDATE = query(
+    "api_product_update",
+    """
+    UPDATE product
+    SET price = COALESCE(%(price)s, price),
+        description = CASE WHEN %(set_desc)s THEN %(desc)s ELSE description END
+    WHERE SKU = %(sku)s
+    RETURNING SKU, name, description, price, ean;
+    """,
+)
+
+API_SUPPLIER_LISTING = query(
+    "api_supplier_listing",
+    """
+    SELECT TIN, name, address, SKU, date
+    FROM supplier
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+API_SUPPLIERS = query(
+    "api_suppliers",
+    """
+    SELECT TIN, name, address, SKU, date
+    FROM supplier
+    WHERE TIN = ANY(%(tins)s);
+    """,
+)
+
+API_SUPPLIERS_CREATE = query(
+    "api_suppliers_create",
+    """
+    INSERT INTO supplier (TIN, name, address, SKU, date)
+    SELECT tin, name, address, sku, date
+    FROM jsonb_to_recordset(%(items)s)
+        AS r(tin VARCHAR, name VARCHAR, address VARCHAR, sku VARCHAR, date DATE)
+    RETURNING TIN;
+    """,
+)
+
+API_CUSTOMERS = query(
+    "api_customers",
+    """
+    SELECT cust_no, name, email, phone, address
+    FROM customer
+    WHERE cust_no = ANY(%(cust_nos)s);
+    """,
+)
+
+API_CUSTOMERS_CREATE = query(
+    "api_customers_create",
+    """
+    INSERT INTO customer (name, email, phone, address)
+    SELECT name, email, phone, address
+    FROM jsonb_to_recordset(%(items)s)
+        AS r(name VARCHAR, email VARCHAR, phone VARCHAR, address VARCHAR)
+    RETURNING cust_no, email;
+    """,
+)
+
+API_ORDER_LISTING = query(
+    "api_order_listing",
+    """
+    SELECT order_no, cust_no, date, total_products, total_qty, total_price
+    FROM orders LEFT JOIN order_summary USING (order_no)
+    {where}
+    ORDER BY {order}
+    """,
+)
+
+API_ORDERS = query(
+    "api_orders",
+    """
+    SELECT order_no, cust_no, date, total_products, total_qty, total_price
+    FROM orders LEFT JOIN order_summary USING (order_no)
+    WHERE order_no = ANY(%(order_nos)s);
+    """,
+)
+
+API_ORDER = query(
+    "api_order",
+    """
+    SELECT order_no, cust_no, date, total_products, total_qty,
+        total_price, pay.cust_no IS NOT NULL AS payed
+    FROM orders
+        LEFT JOIN order_summary USING (order_no)
+        LEFT JOIN pay USING (order_no)
+    WHERE order_no = %(order_no)s;
+    """,
+)
+
+API_ORDER_LINES = query(
+    "api_order_lines",
+    """
+    SELECT SKU, name, qty, price
+    FROM contains JOIN product USING (SKU)
+    WHERE order_no = %(order_no)s;
+    """,
+)
+
+API_ORDER_CREATE = query(
+    "api_order_create",
+    """
+    WITH new_order AS (
+        INSERT INTO orders (cust_no, date)
+        VALUES (%(cust_no)s, %(date)s)
+        RETURNING order_no
+    ), new_lines AS (
+        INSERT INTO contains
+        SELECT order_no, sku, SUM(qty)
+        FROM new_order, jsonb_to_recordset(%(lines)s) AS l(sku VARCHAR, qty INTEGER)
+        GROUP BY order_no, sku
+    )
+    SELECT order_no FROM new_order;
+    """,
+)
+
+API_ORDER_ADD_LINES = query(
+    "api_order_add_lines",
+    """
+    INSERT INTO contains
+    SELECT %(order_no)s, sku, SUM(qty)
+    FROM jsonb_to_recordset(%(lines)s) AS l(sku VARCHAR, qty INTEGER)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM pay
+        WHERE order_no = %(order_no)s)
+    GROUP BY sku
+    ON CONFLICT (order_no, SKU)
+    DO UPDATE SET qty = contains.qty + EXCLUDED.qty
+    RETURNING SKU, qty;
+    """,
+)
+
+API_ORDER_PAY = query(
+    "api_order_pay",
+    """
+    INSERT INTO pay
+    SELECT order_no, cust_no FROM orders
+    WHERE order_no = %(order_no)s AND cust_no = %(cust_no)s
+    RETURNING order_no, cust_no;
+    """,
+)
+
+
+# Change tracking (migrations/0004_table_versions.sql)
+
+TABLE_VERSIONS = query(
+    "table_versions",
+    """
+    SELECT COALESCE(SUM(version), 0) AS version, MAX(changed_at) AS changed_at
+    FROM table_version
+    WHERE name = ANY(%(tables)s);
+    """,
+)
+
+
+# Sales reports (migrations/0005_sales_cube.sql)
+
+# Folds the payments and changes made since the last refresh into sales_cube;
+# run by the job workers (jobs.py), never by the report.
+SALES_CUBE_REFRESH = query(
+    "sales_cube_refresh",
+    """
+    SELECT refresh_sales_cube() AS changes;
+    """,
+)
+
+# When the cube was last refreshed, and what is waiting for the next refresh.
+SALES_CUBE_STATUS = query(
+    "sales_cube_status",
+    """
+    SELECT refreshed_at,
+        (SELECT COUNT(*) FROM sales_cube_pending) AS pending_orders,
+        (SELECT COUNT(*) FROM sales_cube_stale) AS stale_products
+    FROM sales_cube_refresh;
+    """,
+)
+
+SALES_LATEST_YEAR = query(
+    "sales_latest_year",
+    """
+    SELECT MAX(year) AS year FROM sales_cube;
+    """,
+)
+
+# One row per rollup entry; `dimension` names the column it is grouped by.
+SALES_ROLLUPS = query(
+    "sales_rollups",
+    """
+    SELECT
+        CASE
+            WHEN GROUPING(month) = 0 THEN 'month'
+            WHEN GROUPING(day_of_week) = 0 THEN 'day_of_week'
+            WHEN GROUPING(city) = 0 THEN 'city'
+            ELSE 'total'
+        END AS dimension,
+        year, month, day_of_week, city,
+        SUM(qty) AS qty, SUM(total_price) AS total_price
+    FROM sales_cube
+    WHERE year = %(year)s AND (%(sku)s::VARCHAR IS NULL OR sku = %(sku)s)
+    GROUP BY GROUPING SETS ((year), (year, month), (year, day_of_week), (year, city))
+    ORDER BY dimension, month, day_of_week, total_price DESC, city;
+    """,
+)
+
+
+def sales_rollups(rows):
+    """Group the rows of SALES_ROLLUPS by their dimension."""
+
+    rollups = {"total": [], "month": [], "day_of_week": [], "city": []}
+    for row in rows:
+        rollups[row.dimension].append(row)
+    return rollups
+
+
+# Background jobs (migrations/0007_jobs.sql)
+
+JOB_ENQUEUE = query(
+    "job_enqueue",
+    """
+    INSERT INTO job (kind, title, params)
+    VALUES (%(kind)s, %(title)s, %(params)s)
+    RETURNING id;
+    """,
+)
+
+# The uploaded file of a job is stored in numbered parts (migrations/0011).
+JOB_DATA_APPEND = query(
+    "job_data_append",
+    """
+    INSERT INTO job_data (job_id, part, data)
+    VALUES (%(job)s, %(part)s, %(data)s);
+    """,
+)
+
+JOB_DATA_PART = query(
+    "job_data_part",
+    """
+    SELECT data FROM job_data
+    WHERE job_id = %(job)s AND part = %(part)s;
+    """,
+)
+
+# Takes the oldest queued job, or a running one whose worker stopped
+# beating; jobs locked by another worker's claim are skipped, not waited on.
+JOB_CLAIM = query(
+    "job_claim",
+    """
+    UPDATE job
+    SET state = 'running', attempts = attempts + 1,
+        started_at = COALESCE(started_at, now()), heartbeat_at = now()
+    WHERE id = (
+        SELECT id FROM job
+        WHERE state = 'queued'
+            OR (state = 'running'
+                AND heartbeat_at < now() - make_interval(secs => %(stale)s))
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id, kind, params, attempts;
+    """,
+)
+
+JOB_HEARTBEAT = query(
+    "job_heartbeat",
+    """
+    UPDATE job SET heartbeat_at = now()
+    WHERE id = ANY(%(jobs)s) AND state = 'running';
+    """,
+)
+
+JOB_PROGRESS = query(
+    "job_progress",
+    """
+    UPDATE job SET progress = progress + %(done)s
+    WHERE id = %(job)s;
+    """,
+)
+
+# A job stopped between two chunks goes back to the queue without using up
+# an attempt.
+JOB_RELEASE = query(
+    "job_release",
+    """
+    UPDATE job SET state = 'queued', attempts = attempts - 1
+    WHERE id = %(job)s;
+    """,
+)
+
+JOB_DONE = query(
+    "job_done",
+    """
+    WITH dropped AS (DELETE FROM job_data WHERE job_id = %(job)s)
+    UPDATE job SET state = 'done', result = %(result)s, finished_at = now()
+    WHERE id = %(job)s;
+    """,
+)
+
+JOB_FAILED = query(
+    "job_failed",
+    """
+    WITH dropped AS (DELETE FROM job_data WHERE job_id = %(job)s)
+    UPDATE job SET state = 'failed', error = %(error)s, finished_at = now()
+    WHERE id = %(job)s;
+    """,
+)
+
+JOB_BY_ID = query(
+    "job_by_id",
+    """
+    SELECT id, kind, title, params, state, progress, total, result, error,
+        attempts, created_at, started_at, finished_at
+    FROM job
+    WHERE id = %(job)s;
+    """,
+)
+
+JOB_RECENT = query(
+    "job_recent",
+    """
+    SELECT id, kind, title, state, progress, total, created_at, finished_at
+    FROM job
+    ORDER BY id DESC
+    LIMIT %(limit)s;
+    """,
+)
+
+# The totals count what is left plus what earlier attempts already did.
+JOB_CUSTOMER_DELETE_TOTAL = query(
+    "job_customer_delete_total",
+    """
+    UPDATE job SET total = progress + (
+        SELECT COUNT(*) FROM orders WHERE cust_no = %(cust_no)s)
+    WHERE id = %(job)s;
+    """,
+)
+
+JOB_PRODUCT_DELETE_TOTAL = query(
+    "job_product_delete_total",
+    """
+    UPDATE job SET total = progress + (
+        SELECT COUNT(*) FROM contains WHERE SKU = %(product_sku)s)
+    WHERE id = %(job)s;
+    """,
+)
+
+CUSTOMER_ORDERS_CHUNK = query(
+    "customer_orders_chunk",
+    """
+    SELECT order_no FROM orders
+    WHERE cust_no = %(cust_no)s
+    ORDER BY order_no
+    LIMIT %(limit)s;
+    """,
+)
+
+# Deletes the orders of one chunk in the order of CUSTOMER_DELETE.
+CUSTOMER_DELETE_ORDERS = (
+    query(
+        "customer_delete_chunk_processes",
+        """
+        DELETE FROM process
+        WHERE order_no = ANY(%(orders)s);
+        """,
+    ),
+    query(
+        "customer_delete_chunk_lines",
+        """
+        DELETE FROM contains
+        WHERE order_no = ANY(%(orders)s);
+        """,
+    ),
+    query(
+        "customer_delete_chunk_payments",
+        """
+        DELETE FROM pay
+        WHERE order_no = ANY(%(orders)s);
+        """,
+    ),
+    query(
+        "customer_delete_chunk_orders",
+        """
+        DELETE FROM orders
+        WHERE order_no = ANY(%(orders)s);
+        """,
+    ),
+)
+
+# Deletes one chunk of the product's order lines and counts it in the job.
+PRODUCT_DELETE_LINES = query(
+    "product_delete_chunk_lines",
+    """
+    WITH deleted AS (
+        DELETE FROM contains
+        WHERE (order_no, SKU) IN (
+            SELECT order_no, SKU FROM contains
+            WHERE SKU = %(product_sku)s
+            LIMIT %(limit)s)
+        RETURNING 1)
+    UPDATE job SET progress = progress + (SELECT COUNT(*) FROM deleted)
+    WHERE id = %(job)s
+    RETURNING (SELECT COUNT(*) FROM deleted) AS deleted;
+    """,
+)
+
+
+# Captured query plans (migrations/0008_query_plans.sql)
+
+PLAN_INSERT = query(
+    "plan_insert",
+    """
+    INSERT INTO query_plan (query_name, route, params, seconds, analyzed, explain_seconds, scans, plan)
+    VALUES (%(query_name)s, %(route)s, %(params)s, %(seconds)s, %(analyzed)s,
+        %(explain_seconds)s, %(scans)s, %(plan)s);
+    """,
+)
+
+# Keeps the latest %(keep)s captures of the query.
+PLAN_PRUNE = query(
+    "plan_prune",
+    """
+    DELETE FROM query_plan
+    WHERE query_name = %(query_name)s AND id <= (
+        SELECT id FROM query_plan
+        WHERE query_name = %(query_name)s
+        ORDER BY id DESC
+        OFFSET %(keep)s
+        LIMIT 1);
+    """,
+)
+
+# One row per query: its latest capture, the scans of the one before, and
+# whether they differ.
+PLAN_REPORT = query(
+    "plan_report",
+    """
+    WITH ranked AS (
+        SELECT query_name, route, params, scans, captured_at,
+            row_number() OVER (PARTITION BY query_name ORDER BY id DESC) AS n
+        FROM query_plan
+    ), stats AS (
+        SELECT query_name, COUNT(*) AS captures, COUNT(DISTINCT scans) AS plans,
+            AVG(seconds) AS mean_seconds, MAX(seconds) AS max_seconds
+        FROM query_plan
+        GROUP BY query_name
+    )
+    SELECT latest.query_name, latest.route, latest.params, latest.scans,
+        latest.captured_at, previous.scans AS previous_scans,
+        COALESCE(previous.scans <> latest.scans, false) AS changed,
+        stats.captures, stats.plans, stats.mean_seconds, stats.max_seconds
+    FROM ranked latest
+    JOIN stats ON stats.query_name = latest.query_name
+    LEFT JOIN ranked previous
+        ON previous.query_name = latest.query_name AND previous.n = 2
+    WHERE latest.n = 1
+    ORDER BY changed DESC, stats.max_seconds DESC;
+    """,
+)
+
+PLAN_HISTORY = query(
+    "plan_history",
+    """
+    SELECT id, route, params, seconds, analyzed, explain_seconds, scans, plan, captured_at
+    FROM query_plan
+    WHERE query_name = %(query_name)s
+    ORDER BY id DESC
+    LIMIT %(limit)s;
+    """,
+)
+
+
+# Readiness
+
+HEALTH_CHECK = query(
+    "health_check",
+    """
+    SELECT 1;
+    """,
+)
+
+# Seconds the server is behind its primary: 0 on a primary or a replica
+# that has replayed all it received, NULL if it has never replayed anything.
+REPLICA_LAG = query(
+    "replica_lag",
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8
+    END AS lag;
+    """,
+)
+
+
+# User-facing messages for the constraints the write paths rely on.
+CONSTRAINT_ERRORS = {
+    "product_pkey": "There is already a product with that SKU.",
+    "product_ean_key": "There is already a product with that ean.",
+    "supplier_pkey": "There is already a supplier with that TIN.",
+    "supplier_sku_fkey": "There isn't a product with that SKU.",
+    "customer_email_key": "There is already a customer with that email.",
+    "orders_cust_no_fkey": "There isn't a customer with that number.",
+    "contains_order_no_fkey": "There isn't an order with that number.",
+    "contains_sku_fkey": "There isn't a product with that SKU.",
+    "pay_pkey": "Order is already payed.",
+    "pay_order_no_fkey": "There isn't an order with that number.",
+    "pay_cust_no_fkey": "There isn't a customer with that number.",
+}
+
+
+def constraint_error(e):
+    """Translate a psycopg integrity/data error into a user-facing message."""
+
+    if isinstance(e, psycopg.DataError):
+        return "One of the values is not valid."
+    return CONSTRAINT_ERRORS.get(
+        e.diag.constraint_name, "The operation conflicts with existing data."
+    )
+
+
+Page = namedtuple("Page", ["rows", "prev_cursor", "next_cursor", "size"])
+
+
+def page_size(args):
+    size = args.get("size", "")
+    if not (size.isascii() and size.isdigit()) or int(size) == 0:
+        return PAGE_SIZE
+    return min(int(size), MAX_PAGE_SIZE)
+
+
+def keyset(query, key, args, cast=str):
+    """Compose the statement for one page of the listing `query` on `key`.
+
+    The query text must contain `{where}` and `{order}` placeholders. The
+    page position comes from the `after`/`before` arguments in `args`, so
+    every page is a bounded index range scan no matter how deep it is.
+    Returns (statement, params, size, after, before); pass the fetched rows
+    and the last three to page().
+    """
+
+    size = page_size(args)
+    column = sql.Identifier(key)
+    where = sql.SQL("")
+    order = sql.SQL("{} ASC").format(column)
+    params = {"limit": size + 1}
+
+    after = args.get("after")
+    before = args.get("before")
+    try:
+        if before is not None:
+            params["cursor"] = cast(before)
+            where = sql.SQL("WHERE {} < %(cursor)s").format(column)
+            order = sql.SQL("{} DESC").format(column)
+        elif after is not None:
+            params["cursor"] = cast(after)
+            where = sql.SQL("WHERE {} > %(cursor)s").format(column)
+    except ValueError:
+        # A malformed cursor just sends the client back to the first page.
+        after = before = None
+
+    statement = sql.SQL(query.sql + " LIMIT %(limit)s").format(where=where, order=order)
+    return statement, params, size, after, before
+
+
+def page(rows, key, size, after, before):
+    """Build the Page for the rows fetched with a keyset() statement."""
+
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if before is not None:
+        rows.reverse()
+        prev_cursor = getattr(rows[0], key) if has_more else None
+        next_cursor = getattr(rows[-1], key) if rows else None
+    else:
+        prev_cursor = getattr(rows[0], key) if after is not None and rows else None
+        next_cursor = getattr(rows[-1], key) if has_more else None
+
+    return Page(rows, prev_cursor, next_cursor, size)
+
+
+def full_listing(query, key):
+    """Compose the statement for the whole listing `query` in `key` order."""
+
+    return sql.SQL(query.sql).format(
+        where=sql.SQL(""), order=sql.SQL("{} ASC").format(sql.Identifier(key))
+    )
@@ -0,0 +1,674 @@
+"""The HTML views, shared by app.py (Flask) and asgi.py (Quart), and the parts
+of them that api.py uses too.
+
+Each view is a generator. It yields what it needs done as a tuple
+(operation, *arguments) and is sent back the result, then returns the
+answer: a Render, Redirect, Listing, Export or Revalidate. A view that needs
+nothing done just returns its answer. The apps keep only the operations,
+which read and write the database with the sync or async pool (their
+OPERATIONS), and the making of the response from the answer; drive() and
+drive_async() run a view against them:
+
+    write(query, params)             -> (RETURNING row, constraint message)
+    enqueue(kind, title, params, upload) -> job id, see jobs.enqueue()
+    flash(message)
+    invalidate(sku)                  drop the product from the catalogue cache
+    known_missing(sku)               -> whether the product is known not to exist
+    table_version(tables)            -> (version, changed_at) or None
+    page(query, key, cast, params)   -> one keyset page of a listing
+    render_template(name, context)   -> the rendered text
+    product(sku), supplier(tin)      -> the row or None
+    customer(cust_no)                -> (customer, their latest orders)
+    order(order_no)                  -> (order, its lines)
+    is_payed(order_no), payment(order_no) -> whether payed, (payed, totals)
+    delete_supplier(tin)
+    sales_report(year, sku)          -> (year, rollups, status)
+    recent_jobs(), job(job_id)
+    plan_report(), plan_history(query_name)
+
+Both apps hand the views werkzeug-style requests, with the form and the
+files already parsed, and session; operations that fail raise in the view.
+"""
+import hashlib
+import inspect
+import logging
+from collections import namedtuple
+
+import psycopg
+from markupsafe import Markup
+from psycopg.types.json import Jsonb
+from werkzeug.exceptions import abort
+
+import forms
+import metrics
+from exporter import export_dates
+from exporter import EXPORTS
+from exporter import export_statement
+from exporter import FORMATS
+from importer import IMPORTS
+from pooling import RETRY_AFTER
+from queries import CUSTOMER_INSERT
+from queries import CUSTOMER_LISTING
+from queries import ORDER_ADD_PRODUCT
+from queries import ORDER_LISTING
+from queries import ORDER_PAY
+from queries import ORDER_PLACE
+from queries import PAGE_SIZE
+from queries import PRODUCT_INSERT
+from queries import PRODUCT_LISTING
+from queries import PRODUCT_SEARCH
+from queries import PRODUCT_UPDATE
+from queries import SUPPLIER_INSERT
+from queries import SUPPLIER_LISTING
+
+
+log = logging.getLogger(__name__)
+
+# Rendered HTML is flushed to the client in chunks of about this many chars.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Messages of the views, besides those of forms.py and of the constraints
+# (queries.constraint_error()).
+ALREADY_PAYED = "Order is already payed."
+ADD_TO_PAYED = "Cannot add products to an order that is already payed."
+PAYER_ONLY = "An order must be payed by the client who placed it."
+UNKNOWN_PRODUCT = "There isn't a product with that SKU."
+FILE_REQUIRED = "A CSV file is required."
+BUSY = "The server is busy, try again shortly."
+
+TABLE_VERSION_MISSING = "table_version is missing; apply migrations/0004_table_versions.sql."
+SALES_CUBE_MISSING = "sales_cube is missing; apply migrations 0005 and 0010 (python migrate.py)."
+
+# What a view is handed: the request, the session, the templates_version()
+# and the cache of listing fragments (fragments.Fragments) of the app.
+Context = namedtuple("Context", ["request", "session", "templates", "fragments"])
+
+# What a view answers, made into a response by the app.
+Render = namedtuple("Render", ["template", "context", "headers"])
+Redirect = namedtuple("Redirect", ["endpoint", "values"])
+# The whole listing, streamed from a server-side cursor.
+Listing = namedtuple("Listing", ["template", "name", "query", "key"])
+Export = namedtuple("Export", ["statement", "mimetype", "headers"])
+# The answer of a page the client may keep (see etag()), None for a 304.
+Revalidate = namedtuple("Revalidate", ["answer", "etag", "changed_at"])
+
+
+def render(template, headers=None, **context):
+    return Render(template, context, headers or {})
+
+
+def redirect(endpoint, **values):
+    return Redirect(endpoint, values)
+
+
+def drive(view, operations):
+    """Run the view `view`, calling `operations` for what it yields, and
+    return its answer."""
+
+    if not inspect.isgenerator(view):
+        return view
+    result = error = None
+    while True:
+        try:
+            operation = view.send(result) if error is None else view.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        name, *args = operation
+        try:
+            result, error = operations[name](*args), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def drive_async(view, operations):
+    """drive() with coroutine `operations`."""
+
+    if not inspect.isgenerator(view):
+        return view
+    result = error = None
+    while True:
+        try:
+            operation = view.send(result) if error is None else view.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        name, *args = operation
+        try:
+            result, error = await operations[name](*args), None
+        except Exception as e:
+            result, error = None, e
+
+
+def templates_version(jinja_env):
+    """A digest of the templates and settings that shape every page."""
+
+    digest = hashlib.sha1(str(PAGE_SIZE).encode())
+    for name in sorted(jinja_env.list_templates()):
+        source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+        digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def conditional_request(request, session):
+    """Whether the request may be answered with a 304.
+
+    Pages with flashed messages pending are always rendered.
+    """
+
+    return request.method == "GET" and not session.get("_flashes")
+
+
+def etag(templates, version, request):
+    """The ETag of the page: the templates, the version of its tables and
+    the URL with its arguments, so it changes whenever the page could."""
+
+    return hashlib.sha1(f"{templates}:{version}:{request.full_path}".encode()).hexdigest()
+
+
+def not_modified(request, etag):
+    # Only If-None-Match is trusted: Last-Modified has a resolution of one
+    # second, and a change in the same second would go unnoticed.
+    return request.if_none_match.contains_weak(etag)
+
+
+def revalidated(response, etag, changed_at):
+    """Let clients keep `response`, provided they check it on every use."""
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = changed_at
+    response.cache_control.no_cache = True
+    return response
+
+
+def fragment_key(templates, request, version):
+    """The key of the rendered rows of the requested listing page."""
+
+    args = request.args
+    return (
+        templates,
+        request.endpoint,
+        args.get("after"),
+        args.get("before"),
+        args.get("size"),
+        version,
+    )
+
+
+def cached_fragment(fragments, key, route):
+    """The fragment cached under `key`, or None; counted per route."""
+
+    fragment, result = fragments.get(key)
+    metrics.FRAGMENT_LOOKUPS.inc(route=route, result=result)
+    return fragment
+
+
+class ChunkBuffer:
+    """Joins the small chunks of a streamed template into larger ones."""
+
+    def __init__(self, size=STREAM_CHUNK_SIZE):
+        self.size = size
+        self._chunks = []
+        self._buffered = 0
+
+    def add(self, chunk):
+        """Buffer `chunk`; return the buffered text once there is enough."""
+
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self.size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        text = "".join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        return text
+
+
+def shed(request, error, log):
+    """Count and log a request shed for want of a connection; return the
+    headers of its 503."""
+
+    metrics.REQUESTS_SHED.inc(route=request.endpoint or "unmatched")
+    log.warning(f"Shedding {request.method} {request.path}: {error}")
+    return {"Retry-After": str(RETRY_AFTER)}
+
+
+# The jobs the views queue, as (kind, title, params); see jobs.HANDLERS.
+
+
+def product_delete_job(sku):
+    return "product_delete", f"Delete product {sku}", {"sku": sku}
+
+
+def customer_delete_job(cust_no):
+    return "customer_delete", f"Delete customer {cust_no}", {"cust_no": cust_no}
+
+
+def import_job(entity, filename):
+    return "import", f"Import {entity} from {filename}", {"entity": entity}
+
+
+def job_row(kind, title, params):
+    """The parameters of queries.JOB_ENQUEUE."""
+
+    return {"kind": kind, "title": title, "params": Jsonb(params)}
+
+
+def job_headers(job):
+    """Have the status page of a job reload itself until the job is over."""
+
+    return {"Refresh": "2"} if job.state in ("queued", "running") else {}
+
+
+def conditional(context, tables, view):
+    """Run `view` unless the client's copy of the page is still current.
+
+    The ETag covers the version of `tables` (see db.table_version()), the
+    URL with its arguments and the templates; see etag().
+    """
+
+    request = context.request
+    if not conditional_request(request, context.session):
+        return (yield from view)
+    current = yield "table_version", tables
+    if current is None:
+        return (yield from view)
+    version, changed_at = current
+    tag = etag(context.templates, version, request)
+    if not_modified(request, tag):
+        return Revalidate(None, tag, changed_at)
+    return Revalidate((yield from view), tag, changed_at)
+
+
+def listing_fragment(context, tables, template, name, query, key, cast=str):
+    """Render the rows of the requested listing page, or reuse them.
+
+    The fragment is cached under the route, the page cursor and the version
+    of `tables`, so it is rendered again only once they change.
+    """
+
+    request = context.request
+    cache_key = None
+    current = yield "table_version", tables
+    if current is not None:
+        cache_key = fragment_key(context.templates, request, current[0])
+        fragment = cached_fragment(context.fragments, cache_key, request.endpoint)
+        if fragment is not None:
+            return fragment
+    page = yield "page", query, key, cast, None
+    text = yield "render_template", template, {"page": page, name: page.rows}
+    if cache_key is None:
+        return Markup(text)
+    return context.fragments.put(cache_key, text)
+
+
+def listing(context, tables, name, query, key, cast=str):
+    """Show a page of the listing `name`, or all of it with ?stream=1."""
+
+    if context.request.args.get("stream"):
+        return Listing(f"{name}/index.html", name, query, key)
+    fragment = yield from listing_fragment(
+        context, tables, f"{name}/listing.html", name, query, key, cast
+    )
+    return render(f"{name}/index.html", listing=fragment)
+
+
+def product_index(context):
+    """Show all the products."""
+
+    view = listing(context, ("product",), "products", PRODUCT_LISTING, "sku")
+    return (yield from conditional(context, ("product",), view))
+
+
+def product_search(context):
+    """Find products by SKU, EAN, the start of their name or a part of their
+    name or description."""
+
+    values, error = forms.product_search(context.request.args)
+    if not values["sku"]:
+        return redirect("product_index")
+    if error is not None:
+        yield "flash", error
+        return redirect("product_index")
+
+    page = yield "page", PRODUCT_SEARCH, "sku", str, values
+
+    return render("products/index.html", products=page.rows, page=page, search=values["sku"])
+
+
+def product_register(context):
+    """Register a new product."""
+
+    if context.request.method == "POST":
+        values, error = forms.product_register(context.request.form)
+
+        if error is not None:
+            yield "flash", error
+        else:
+            _, error = yield "write", PRODUCT_INSERT, values
+            if error is not None:
+                yield "flash", error
+                return redirect("product_register")
+            yield "invalidate", values["SKU"]
+            return redirect("product_index")
+
+    return render("products/register.html")
+
+
+def product_delete(context, product_sku):
+    """Queue the deletion of the product and show its progress."""
+
+    job_id = yield "enqueue", *product_delete_job(product_sku), None
+    return redirect("job_status", job_id=job_id)
+
+
+def product_update(context, product_sku):
+    """Update the product price or description."""
+
+    if context.request.method == "POST":
+        values, error = forms.product_update(context.request.form)
+
+        if error is None:
+            _, error = yield "write", PRODUCT_UPDATE, {"product_sku": product_sku, **values}
+        if error is None:
+            yield "invalidate", product_sku
+            return redirect("product_index")
+        yield "flash", error
+
+    product = yield "product", product_sku
+
+    return render("products/update.html", product=product)
+
+
+def supplier_index(context):
+    """Show all the suppliers."""
+
+    view = listing(context, ("supplier",), "suppliers", SUPPLIER_LISTING, "tin")
+    return (yield from conditional(context, ("supplier",), view))
+
+
+def supplier_register(context):
+    """Register a new supplier."""
+
+    if context.request.method == "POST":
+        values, error = forms.supplier_register(context.request.form)
+        if error is None and (yield "known_missing", values["SKU"]):
+            error = UNKNOWN_PRODUCT
+
+        if error is not None:
+            yield "flash", error
+        else:
+            _, error = yield "write", SUPPLIER_INSERT, values
+            if error is not None:
+                yield "flash", error
+                return redirect("supplier_register")
+            return redirect("supplier_index")
+
+    return render("suppliers/register.html")
+
+
+def supplier_delete(context, supplier_tin):
+    """Delete the supplier."""
+
+    yield "delete_supplier", supplier_tin
+    return redirect("supplier_index")
+
+
+def supplier_info(context, tin):
+    """Show supplier information."""
+
+    supplier = yield "supplier", tin
+
+    return render("suppliers/update.html", supplier=supplier)
+
+
+def customer_index(context):
+    """Show all the customers."""
+
+    return (yield from listing(
+        context, ("customer",), "customers", CUSTOMER_LISTING, "cust_no", cast=int
+    ))
+
+
+def customer_register(context):
+    """Register a new customer."""
+
+    if context.request.method == "POST":
+        values, error = forms.customer_register(context.request.form)
+
+        if error is not None:
+            yield "flash", error
+        else:
+            _, error = yield "write", CUSTOMER_INSERT, values
+            if error is not None:
+                yield "flash", error
+                return redirect("customer_register")
+            return redirect("customer_index")
+
+    return render("customers/register.html")
+
+
+def customer_delete(context, cust_no):
+    """Queue the deletion of the customer and show its progress."""
+
+    job_id = yield "enqueue", *customer_delete_job(cust_no), None
+    return redirect("job_status", job_id=job_id)
+
+
+def customer_info(context, cust_no):
+    """Show customer information."""
+
+    customer, orders = yield "customer", cust_no
+
+    return render("customers/update.html", customer=customer, orders=orders)
+
+
+def orders_index(context):
+    """Show all the orders."""
+
+    return (yield from listing(
+        context, ("orders", "order_summary"), "orders", ORDER_LISTING, "order_no", cast=int
+    ))
+
+
+def place_order(context):
+    """Place a new order."""
+
+    if context.request.method == "POST":
+        values, error = forms.place_order(context.request.form)
+        if error is None and (yield "known_missing", values["sku"]):
+            error = UNKNOWN_PRODUCT
+
+        if error is not None:
+            yield "flash", error
+        else:
+            _, error = yield "write", ORDER_PLACE, values
+            if error is not None:
+                yield "flash", error
+                return redirect("place_order")
+            return redirect("orders_index")
+
+    return render("orders/register.html")
+
+
+def add_product(context, order_no):
+    """Add a new product to an existing order."""
+
+    if context.request.method == "POST":
+        values, error = forms.add_product(context.request.form)
+        if error is None and (yield "known_missing", values["sku"]):
+            error = UNKNOWN_PRODUCT
+
+        if error is not None:
+            yield "flash", error
+        else:
+            added, error = yield "write", ORDER_ADD_PRODUCT, {"order_no": order_no, **values}
+            if error is not None:
+                yield "flash", error
+                return redirect("add_product", order_no=order_no)
+            if added is None:
+                yield "flash", ADD_TO_PAYED
+            return redirect("order_info", order_no=order_no)
+
+    if (yield "is_payed", order_no):
+        yield "flash", ADD_TO_PAYED
+        return redirect("order_info", order_no=order_no)
+
+    return render("orders/addproduct.html", order_no=order_no)
+
+
+def order_info(context, order_no):
+    """Show order information."""
+
+    def view():
+        order, products = yield "order", order_no
+        return render("orders/update.html", order=order, products=products)
+
+    return (yield from conditional(context, ("orders", "contains", "product"), view()))
+
+
+def pay_order(context, order_no):
+    """Pay the order."""
+
+    if context.request.method == "POST":
+        values, error = forms.pay_order(context.request.form)
+
+        if error is None:
+            payed, error = yield "write", ORDER_PAY, {"order_no": order_no, **values}
+            if error is None and payed is None:
+                error = PAYER_ONLY
+        if error is not None:
+            yield "flash", error
+        return redirect("order_info", order_no=order_no)
+
+    payed, order_totals = yield "payment", order_no
+
+    if payed:
+        yield "flash", ALREADY_PAYED
+        return redirect("order_info", order_no=order_no)
+
+    return render("orders/pay.html", order_totals=order_totals, order_no=order_no)
+
+
+def bulk_import(context, entity):
+    """Import products, customers or suppliers from a CSV file.
+
+    The file is loaded by a background job; the page redirects to its status.
+    The upload is handed to the job part by part, never read whole.
+    """
+
+    if context.request.method == "POST":
+        upload = context.request.files.get("file")
+        if not upload or not upload.filename:
+            yield "flash", FILE_REQUIRED
+        else:
+            job_id = yield "enqueue", *import_job(entity, upload.filename), upload
+            return redirect("job_status", job_id=job_id)
+
+    return render(
+        "import.html",
+        entity=entity,
+        columns=IMPORTS[entity].columns,
+        index=f"{entity[:-1]}_index",
+    )
+
+
+def export(context, entity, fmt):
+    """Stream a whole table or view as CSV or NDJSON.
+
+    Exports with a date can be narrowed with ?date_from= and ?date_to=
+    (YYYY-MM-DD, both inclusive).
+    """
+
+    if entity not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+
+    try:
+        date_from, date_to = export_dates(context.request.args)
+    except ValueError as e:
+        abort(400, str(e))
+
+    return Export(
+        export_statement(entity, fmt, date_from, date_to),
+        FORMATS[fmt],
+        {"Content-Disposition": f"attachment; filename={entity}.{fmt}"},
+    )
+
+
+def sales_dashboard(context):
+    """Show the sales of a year by month, day of the week and city.
+
+    ?year= picks the year (the latest with sales by default) and ?sku=
+    narrows the report to one product. The cube is refreshed by the job
+    workers; the page says when it last was.
+    """
+
+    year = context.request.args.get("year", type=int)
+    sku = context.request.args.get("sku") or None
+    try:
+        year, rollups, status = yield "sales_report", year, sku
+    except psycopg.errors.UndefinedTable:
+        log.warning(SALES_CUBE_MISSING)
+        abort(503)
+    return render("reports/sales.html", year=year, rollups=rollups, status=status)
+
+
+def job_index(context):
+    """Show the latest background jobs."""
+
+    jobs = yield ("recent_jobs",)
+    return render("jobs/index.html", jobs=jobs)
+
+
+def job_status(context, job_id):
+    """Show the progress of a background job, refreshing until it is over."""
+
+    job = yield "job", job_id
+    if job is None:
+        abort(404)
+    return render("jobs/status.html", job_headers(job), job=job)
+
+
+def plan_index(context):
+    """Show the captured plans by query, the queries whose plan changed first."""
+
+    queries = yield ("plan_report",)
+    return render("admin/plans.html", queries=queries)
+
+
+def plan_info(context, query_name):
+    """Show the latest captured plans of a query."""
+
+    captures = yield "plan_history", query_name
+    return render("admin/plan.html", query_name=query_name, captures=captures)
+
+
+# (rule, methods, view) of the views above; the endpoint is the view's name.
+ROUTES = (
+    ("/products", ("GET",), product_index),
+    ("/products/search", ("GET",), product_search),
+    ("/products/register", ("GET", "POST"), product_register),
+    ("/products/<product_sku>/delete", ("POST",), product_delete),
+    ("/products/<product_sku>/update", ("GET", "POST"), product_update),
+    ("/suppliers", ("GET",), supplier_index),
+    ("/suppliers/register", ("GET", "POST"), supplier_register),
+    ("/supplier/<supplier_tin>/delete", ("POST",), supplier_delete),
+    ("/suppliers/<tin>/update", ("GET",), supplier_info),
+    ("/customers", ("GET",), customer_index),
+    ("/customers/register", ("GET", "POST"), customer_register),
+    ("/customers/<cust_no>/delete", ("POST",), customer_delete),
+    ("/customers/<cust_no>/update", ("GET",), customer_info),
+    ("/orders", ("GET",), orders_index),
+    ("/orders/register", ("GET", "POST"), place_order),
+    ("/orders/<order_no>/addproduct", ("GET", "POST"), add_product),
+    ("/orders/<order_no>/update", ("GET",), order_info),
+    ("/orders/<order_no>/pay", ("GET", "POST"), pay_order),
+    ("/<any(products, customers, suppliers):entity>/import", ("GET", "POST"), bulk_import),
+    ("/export/<entity>.<fmt>", ("GET",), export),
+    ("/reports/sales", ("GET",), sales_dashboard),
+    ("/jobs", ("GET",), job_index),
+    ("/jobs/<int:job_id>", ("GET",), job_status),
+    ("/admin/plans", ("GET",), plan_index),
+    ("/admin/plans/<query_name>", ("GET",), plan_info),
+)